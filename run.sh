@@ -15,7 +15,37 @@ else
   DB_SAVE_ARG=""
 fi
 
-python src/sql_server.py $DB_PORT_ARG $DB_SAVE_ARG >> $LOG_FILE 2>&1 &
+if [[ -n ${DB_BATCH_SIZE} ]]; then
+  DB_BATCH_SIZE_ARG="--batch-size $DB_BATCH_SIZE"
+else
+  DB_BATCH_SIZE_ARG=""
+fi
+
+if [[ -n ${DB_BATCH_LATENCY} ]]; then
+  DB_BATCH_LATENCY_ARG="--batch-latency $DB_BATCH_LATENCY"
+else
+  DB_BATCH_LATENCY_ARG=""
+fi
+
+if [[ -n ${DB_STORE} ]]; then
+  DB_STORE_ARG="--store $DB_STORE"
+else
+  DB_STORE_ARG=""
+fi
+
+if [[ -n ${DB_WORKERS} ]]; then
+  DB_WORKERS_ARG="--workers $DB_WORKERS"
+else
+  DB_WORKERS_ARG=""
+fi
+
+if [[ -n ${DB_PARTITION} ]]; then
+  DB_PARTITION_ARG="--partition $DB_PARTITION"
+else
+  DB_PARTITION_ARG=""
+fi
+
+python src/sql_server.py $DB_PORT_ARG $DB_SAVE_ARG $DB_BATCH_SIZE_ARG $DB_BATCH_LATENCY_ARG $DB_STORE_ARG $DB_WORKERS_ARG $DB_PARTITION_ARG >> $LOG_FILE 2>&1 &
 echo "kill $!" >> kill.sh
 echo "echo Stopped Database" >> kill.sh
 echo Started Database
@@ -32,7 +62,13 @@ else
   FILTER_RULE_FILE_ARG=""
 fi
 
-python src/filter_server.py $FILTER_PORT_ARG $FILTER_RULE_FILE_ARG >> $LOG_FILE 2>&1 &
+if [[ -n ${FILTER_WORKERS} ]]; then
+  FILTER_WORKERS_ARG="--workers $FILTER_WORKERS"
+else
+  FILTER_WORKERS_ARG=""
+fi
+
+python src/filter_server.py $FILTER_PORT_ARG $FILTER_RULE_FILE_ARG $FILTER_WORKERS_ARG >> $LOG_FILE 2>&1 &
 echo "kill $!" >> kill.sh
 echo "echo Stopped Filter" >> kill.sh
 echo Started Filter 
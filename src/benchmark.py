@@ -0,0 +1,312 @@
+'A load generator that pretends to be a number of Kinect producers.'
+
+### Measuring the filter and database normally takes a real sensor
+### hooked up to the producer. This program stands in for any number
+### of producers. Each one sends synthetic frames laid out the same
+### way the producer's video_to_bmp lays them out, at a fixed rate, to
+### a filter or database server. When it's done, it reports how many
+### frames went through, how long they took, how many the filter
+### rejected, and how fast the save directory grew. Every run is
+### appended to a results file along with the commit it was run
+### against, so runs can be compared across commits.
+
+import argparse
+import httplib
+import json
+import os
+import os.path
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+from util import *
+from frame_stream import FrameHeader, bmp_header
+
+## These match the constants at the top of the producer.
+VIDEO_WIDTH = 640
+VIDEO_HEIGHT = 480
+VIDEO_PIXEL_SIZE = 3
+DEPTH_PIXEL_SIZE = 2
+
+## Frames are built from a block of random bytes. With the noise
+## pattern, every frame starts at a different place in the block so no
+## two frames are the same. With the static pattern, every frame is the
+## same, like a camera pointed at an empty room.
+class FrameSource(object):
+    'Makes synthetic frames.'
+    def __init__(self, stream = 'video', pattern = 'noise'):
+        self.stream = stream
+        self.pattern = pattern
+        if stream == 'video':
+            self.header = bmp_header(VIDEO_WIDTH, VIDEO_HEIGHT)
+            self.pixel_size = VIDEO_PIXEL_SIZE
+        else:
+            self.header = ''
+            self.pixel_size = DEPTH_PIXEL_SIZE
+        self.size = VIDEO_WIDTH * VIDEO_HEIGHT * self.pixel_size
+        self.noise = os.urandom(self.size) * 2
+
+    def pixels(self, n):
+        'The pixel data of the Nth frame.'
+        start = 0 if self.pattern == 'static' else (n * 4099) % self.size
+        return self.noise[start:start + self.size]
+
+    def frame(self, n):
+        'The Nth frame, as the producer sends it.'
+        return self.header + self.pixels(n)
+
+    def stream_frame(self, n):
+        'The Nth frame with its frame stream header.'
+        return FrameHeader(self.stream, VIDEO_WIDTH, VIDEO_HEIGHT, self.pixel_size,
+                           int(time.time() * 1000)).pack() + self.pixels(n)
+
+class Results(object):
+    'Everything measured during a run.'
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.sent = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+        self.bytes_sent = 0
+
+    def record(self, latency, size, accepted, error = False):
+        with self.lock:
+            self.sent += 1
+            if error:
+                self.errors += 1
+                return
+            self.latencies.append(latency)
+            self.bytes_sent += size
+            if accepted:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+    def reject(self, n):
+        'Count N frames that were recorded as accepted as rejected instead.'
+        with self.lock:
+            self.accepted -= n
+            self.rejected += n
+
+def percentile(ordered, fraction):
+    'The value at FRACTION of the way through the sorted list ORDERED.'
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+## Each producer is a thread that sends a frame every 1 / RATE seconds.
+## If a frame takes longer than that, the next one is sent right away
+## instead of sleeping, the same as a producer that falls behind. The
+## real producer opens a new connection for every frame, so that's the
+## default here too. The filter answers a frame it drops because of a
+## delay with the body 'Failure', which is counted as a rejection.
+## With the stream protocol, a producer sends all of its frames as one
+## chunked frame stream instead. There is no answer for each frame, so
+## a frame's latency is how long it took to send, and frames the
+## filter reports dropping at the end are counted as rejections then.
+class Producer(threading.Thread):
+    'A thread that sends frames at a fixed rate.'
+    def __init__(self, n, url, source, rate, duration, results, source_address = None, keep_alive = False, protocol = 'request'):
+        threading.Thread.__init__(self, name = 'Producer-%d' % (n,))
+        self.daemon = True
+        self.url = urlparse.urlparse(url)
+        self.source = source
+        self.rate = rate
+        self.duration = duration
+        self.results = results
+        self.source_address = (source_address, 0) if source_address else None
+        self.keep_alive = keep_alive
+        self.protocol = protocol
+
+    def connect(self):
+        return httplib.HTTPConnection(self.url.hostname,
+                                      self.url.port or 80,
+                                      timeout = 30,
+                                      source_address = self.source_address)
+
+    def schedule(self):
+        'Yield the number of every frame to send, when it is due.'
+        start = time.time()
+        n = 0
+        while True:
+            due = start + n / self.rate
+            if due - start >= self.duration:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            yield n
+            n += 1
+
+    def run(self):
+        if self.protocol == 'stream':
+            self.run_stream()
+            return
+        connection = None
+        for n in self.schedule():
+            frame = self.source.frame(n)
+            sent = time.time()
+            try:
+                if connection is None:
+                    connection = self.connect()
+                connection.request('PUT', self.url.path or '/', frame,
+                                   {'Content-Type' : 'application/octet-stream',
+                                    'X-Stream' : self.source.stream})
+                response = connection.getresponse()
+                body = response.read()
+                self.results.record(time.time() - sent,
+                                    len(frame),
+                                    response.status == 200 and body != 'Failure',
+                                    error = response.status >= 500)
+            except (socket.error, httplib.HTTPException):
+                self.results.record(time.time() - sent, len(frame), False, error = True)
+                connection = None
+            if not self.keep_alive and connection is not None:
+                connection.close()
+                connection = None
+
+    def run_stream(self):
+        sent_frames = 0
+        try:
+            connection = self.connect()
+            connection.putrequest('POST', urlparse.urljoin(self.url.path or '/', 'stream'))
+            connection.putheader('Content-Type', 'application/octet-stream')
+            connection.putheader('Transfer-Encoding', 'chunked')
+            connection.endheaders()
+            for n in self.schedule():
+                frame = self.source.stream_frame(n)
+                sent = time.time()
+                connection.send('%x\r\n%s\r\n' % (len(frame), frame))
+                self.results.record(time.time() - sent, len(frame), True)
+                sent_frames += 1
+            connection.send('0\r\n\r\n')
+            response = connection.getresponse()
+            answer = json.loads(response.read())
+            self.results.reject(answer.get('rejected', 0))
+        except (socket.error, httplib.HTTPException, ValueError):
+            self.results.reject(sent_frames)
+            with self.results.lock:
+                self.results.errors += 1
+
+def directory_size(path):
+    'The number of bytes in every file under PATH.'
+    total = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(directory, file_name))
+            except OSError:
+                pass
+    return total
+
+def current_commit():
+    'The commit the working tree is at, or None if it is not a git repository.'
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    'Run a benchmark described by ARGS and return its summary.'
+    results = Results()
+    source = FrameSource(args.stream, args.pattern)
+    addresses = args.source_address or [None]
+    producers = [Producer(n, args.url, source, args.rate, args.duration, results,
+                          source_address = addresses[n % len(addresses)],
+                          keep_alive = args.keep_alive,
+                          protocol = args.protocol)
+                 for n in range(args.producers)]
+    size_before = directory_size(args.watch) if args.watch else None
+    start = time.time()
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    elapsed = time.time() - start
+    if args.settle:
+        time.sleep(args.settle)
+    latencies = sorted(results.latencies)
+    summary = {'commit' : current_commit(),
+               'started' : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+               'url' : args.url,
+               'producers' : args.producers,
+               'rate' : args.rate,
+               'stream' : args.stream,
+               'pattern' : args.pattern,
+               'keep_alive' : args.keep_alive,
+               'protocol' : args.protocol,
+               'duration' : elapsed,
+               'sent' : results.sent,
+               'accepted' : results.accepted,
+               'rejected' : results.rejected,
+               'errors' : results.errors,
+               'throughput' : results.accepted / elapsed,
+               'megabytes_per_second_sent' : results.bytes_sent / elapsed / 1e6,
+               'latency_p50' : percentile(latencies, 0.5),
+               'latency_p99' : percentile(latencies, 0.99),
+               'latency_p999' : percentile(latencies, 0.999)}
+    if args.watch:
+        summary['megabytes_per_second_written'] = (directory_size(args.watch) - size_before) / elapsed / 1e6
+    return summary
+
+def print_summary(summary, out = sys.stdout):
+    for key in sorted(summary):
+        value = summary[key]
+        if isinstance(value, float):
+            value = '%.6g' % (value,)
+        out.write('%-28s %s\n' % (key, value))
+
+## Runs are compared by grouping them by everything that describes the
+## load, and showing how the measurements changed from one commit to
+## the next within each group.
+LOAD_KEYS = ('url', 'producers', 'rate', 'stream', 'pattern', 'keep_alive', 'protocol')
+COMPARED_KEYS = ('throughput', 'latency_p50', 'latency_p99', 'latency_p999', 'rejected', 'errors')
+
+def compare(path, out = sys.stdout):
+    'Print how the measurements in the results file at PATH changed between runs with the same load.'
+    groups = {}
+    with open(path) as f_obj:
+        for line in f_obj:
+            if line.strip():
+                summary = json.loads(line)
+                groups.setdefault(tuple(summary.get(key) for key in LOAD_KEYS), []).append(summary)
+    for load, runs in sorted(groups.items()):
+        out.write('%s\n' % (', '.join('%s=%s' % pair for pair in zip(LOAD_KEYS, load)),))
+        out.write('  %-10s %-20s' % ('commit', 'started') + ''.join('%14s' % (key,) for key in COMPARED_KEYS) + '\n')
+        for summary in runs:
+            values = [summary.get(key) for key in COMPARED_KEYS]
+            out.write('  %-10s %-20s' % (summary.get('commit'), summary.get('started')) +
+                      ''.join('%14s' % ('-' if value is None else '%.6g' % (value,)) for value in values) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Send synthetic Kinect frames to a filter or database server and measure how it keeps up.')
+    parser.add_argument('--url', help = 'The server to send frames to.', type = str, default = 'http://localhost:5000/')
+    parser.add_argument('--producers', help = 'The number of producers to pretend to be.', type = int, default = 1)
+    parser.add_argument('--rate', help = 'Frames per second sent by each producer.', type = float, default = 30.0)
+    parser.add_argument('--duration', help = 'Seconds to send frames for.', type = float, default = 10.0)
+    parser.add_argument('--stream', help = 'Send video frames or depth frames.', choices = ('video', 'depth'), default = 'video')
+    parser.add_argument('--pattern', help = 'Send frames that all differ or frames that are all the same.', choices = ('noise', 'static'), default = 'noise')
+    parser.add_argument('--keep-alive', help = 'Reuse one connection per producer instead of connecting for every frame.', action = 'store_true')
+    parser.add_argument('--protocol', help = 'Send every frame in its own request, or all of them in one frame stream.', choices = ('request', 'stream'), default = 'request')
+    parser.add_argument('--source-address', help = 'A local address to send from. Give it more than once to spread producers over several addresses.', action = 'append')
+    parser.add_argument('--watch', help = 'A save directory to measure the write rate of.', type = str, default = None)
+    parser.add_argument('--settle', help = 'Seconds to wait after sending before measuring the save directory.', type = float, default = 1.0)
+    parser.add_argument('--results', help = 'The file to append the results of the run to.', type = str, default = 'benchmark_results.jsonl')
+    parser.add_argument('--compare', help = 'Compare the runs in the results file instead of running.', action = 'store_true')
+    args = parser.parse_args()
+    if args.compare:
+        compare(args.results)
+        sys.exit(0)
+    summary = run(args)
+    print_summary(summary)
+    with open(args.results, 'a') as f_obj:
+        f_obj.write(json.dumps(summary, sort_keys = True) + '\n')
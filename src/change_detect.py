@@ -0,0 +1,138 @@
+'Decides if a frame differs enough from the last one forwarded from its source.'
+
+### A sensor pointed at a room where nothing is happening sends the
+### same picture over and over. A rule with a minimum change only lets
+### a frame through if enough of it differs from the last frame that
+### was forwarded from the same source. Frames are compared on a small
+### sample of their pixels: every STRIDE-th pixel of every STRIDE-th
+### row, turned to brightness for video, and scaled to between 0 and
+### 1. A sampled pixel counts as changed if it moved by more than
+### TOLERANCE, which keeps sensor noise from counting as change. The
+### change of a frame is the fraction of its sampled pixels that
+### changed.
+###
+### Frames sent on their own are video if they start with a BMP
+### header. Anything else the size of a depth frame is taken to be a
+### depth frame. Frames from a frame stream say what they are in their
+### header.
+
+import struct
+import threading
+
+## NumPy is optional. Without it the sampled pixels are compared in a
+## plain Python loop, which is slower but gives the same result. Most
+## rules have no minimum change, so NumPy isn't imported until the
+## first frame is sampled, rather than making every filter start slower.
+numpy = None
+_numpy_imported = False
+
+def _import_numpy():
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_imported = True
+
+STRIDE = 8
+TOLERANCE = 0.05
+DEPTH_WIDTH = 640
+DEPTH_HEIGHT = 480
+DEPTH_MAX = 2047.0 # Kinect depth samples are 11 bits.
+
+class Sample(object):
+    'The sampled pixels of a frame, each between 0 and 1.'
+    def __init__(self, kind, values):
+        self.kind = kind
+        self.values = values
+
+def _layout(data, header = None):
+    'The (kind, offset, width, height, row size, pixel size) of the pixels in DATA, or None if they cannot be found.'
+    if header is not None:
+        pixel_size = header.pixel_size
+        return header.stream, 0, header.width, header.height, header.width * pixel_size, pixel_size
+    if data[:2] == 'BM' and len(data) >= 54:
+        offset, = struct.unpack_from('<I', data, 10)
+        width, height = struct.unpack_from('<ii', data, 18)
+        bits, = struct.unpack_from('<H', data, 28)
+        pixel_size = bits // 8
+        row_size = (bits * width + 31) // 32 * 4
+        if pixel_size and offset + row_size * abs(height) <= len(data):
+            return 'video', offset, width, abs(height), row_size, pixel_size
+    if len(data) == DEPTH_WIDTH * DEPTH_HEIGHT * 2:
+        return 'depth', 0, DEPTH_WIDTH, DEPTH_HEIGHT, DEPTH_WIDTH * 2, 2
+    return None
+
+def sample(data, header = None, stride = STRIDE):
+    'The Sample of the frame DATA, or None if its layout is unknown. HEADER is its FrameHeader if it came in a frame stream.'
+    layout = _layout(data, header)
+    if layout is None:
+        return None
+    kind, offset, width, height, row_size, pixel_size = layout
+    _import_numpy()
+    if numpy is not None:
+        if kind == 'depth':
+            rows = numpy.frombuffer(data, dtype = '<u2', count = row_size * height // 2, offset = offset)
+            pixels = rows.reshape(height, row_size // 2)[::stride, :width:stride]
+            return Sample(kind, pixels.astype(numpy.float32) / DEPTH_MAX)
+        rows = numpy.frombuffer(data, dtype = numpy.uint8, count = row_size * height, offset = offset)
+        pixels = rows.reshape(height, row_size)[::stride, :width * pixel_size].reshape(-1, width, pixel_size)
+        return Sample(kind, pixels[:, ::stride, :3].mean(axis = 2, dtype = numpy.float32) / 255.0)
+    values = []
+    for row in xrange(0, height, stride):
+        start = offset + row * row_size
+        for column in xrange(0, width, stride):
+            at = start + column * pixel_size
+            if kind == 'depth':
+                values.append(struct.unpack_from('<H', data, at)[0] / DEPTH_MAX)
+            else:
+                values.append(sum(ord(c) for c in data[at:at + min(pixel_size, 3)]) / (255.0 * min(pixel_size, 3)))
+    return Sample(kind, values)
+
+def change(a, b):
+    'The fraction of the pixels sampled in A and B that differ by more than TOLERANCE. 1.0 if they can not be compared.'
+    if a.kind != b.kind or len(a.values) != len(b.values) or not len(a.values):
+        return 1.0
+    if numpy is not None:
+        return float(numpy.count_nonzero(numpy.abs(a.values - b.values) > TOLERANCE)) / a.values.size
+    return sum(1 for x, y in zip(a.values, b.values) if abs(x - y) > TOLERANCE) / float(len(a.values))
+
+## Request threads for different sources don't share anything, and a
+## source only has one frame in the filter at a time in practice, so the
+## lock only guards the dictionary itself.
+class ChangeDetector(object):
+    'Remembers the last frame forwarded from every source.'
+    def __init__(self, stride = STRIDE):
+        self.stride = stride
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def sample(self, data, header = None):
+        'The Sample of the frame DATA.'
+        return sample(data, header, self.stride)
+
+    def change(self, source, frame_sample):
+        'How much FRAME_SAMPLE differs from the last frame forwarded from SOURCE, between 0 and 1.'
+        with self.lock:
+            last = self.last.get(source)
+        if last is None or frame_sample is None:
+            return 1.0
+        return change(frame_sample, last)
+
+    def remember(self, source, frame_sample):
+        'Record that a frame with FRAME_SAMPLE was forwarded from SOURCE.'
+        if frame_sample is None:
+            return
+        with self.lock:
+            self.last[source] = frame_sample
+
+    def known_sources(self):
+        'A list of every source with a remembered frame.'
+        with self.lock:
+            return list(self.last)
+
+    def forget(self, source):
+        'Drop the last frame of SOURCE.'
+        with self.lock:
+            self.last.pop(source, None)
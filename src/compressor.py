@@ -0,0 +1,171 @@
+'Compresses frames on a pool of worker processes before they are stored.'
+
+### Compressing a frame takes long enough that doing it in the request
+### handler would slow down every sender, and Python threads can't
+### compress in parallel. When compression is turned on, the request
+### handler writes the frame to a staging directory and hands it to the
+### compressor in this module. A pool of worker processes encodes the
+### frame, and once it's encoded it's saved to the frame store and its
+### record is saved. A frame's record is only saved once the frame is
+### stored in its final form, so readers never see a frame half way
+### through being compressed. The frame is begun in the journal before
+### it's staged, so a frame the server stops before storing is found
+### when it starts again.
+
+import os
+import os.path
+import io
+import shutil
+import threading
+import multiprocessing
+import logging
+
+import frame_codec
+
+def compress_file(path, codec, reference_path):
+    'Encode the frame at PATH with CODEC, against the key frame at REFERENCE_PATH if not None. Returns a (success, codec, data or error) triple.'
+    ## This runs in a worker process. Exceptions raised here would only
+    ## come out when the result is asked for, and the result is never
+    ## asked for, so they are returned instead.
+    try:
+        with open(path, 'rb') as f_obj:
+            data = f_obj.read()
+        if frame_codec.needs_reference(codec):
+            reference = None
+            if reference_path is not None:
+                with open(reference_path, 'rb') as f_obj:
+                    reference = f_obj.read()
+            if not frame_codec.can_delta(data, reference):
+                codec = 'zlib'
+                reference = None
+            return True, codec, frame_codec.encode(codec, data, reference)
+        return True, codec, frame_codec.encode(codec, data)
+    except Exception, e:
+        return False, codec, repr(e)
+
+## Codecs that encode against a key frame need the key frame's original
+## bytes. Each stream of each sender has its own key frame, since a
+## frame can only be encoded against one of the same kind. Every
+## KEYFRAME_INTERVAL frames from a stream, a frame becomes
+## the new key frame. It's stored on its own with deflate, and a hard
+## link to its staged file is kept in the keyframes directory for the
+## workers to read. An old key frame's file is removed once no frame
+## waiting to be encoded needs it.
+class KeyFrame(object):
+    'A frame other frames from the same stream of a sender are encoded against.'
+    def __init__(self, file_name, path):
+        self.file_name = file_name
+        self.path = path
+        self.uses = 0
+        self.pending = 0
+        self.retired = False
+
+class Compressor(object):
+    'Encodes staged frames on worker processes, then stores them and saves their records.'
+    def __init__(self, directory, store, save_record, video_codec = 'zlib', depth_codec = 'depth-delta',
+                 processes = None, keyframe_interval = 30, max_pending = None, journal = None):
+        'STORE is the frame store encoded frames are saved to, and SAVE_RECORD is called with the FrameMetaData of every stored frame. Frames that are not stored are aborted in JOURNAL.'
+        self.staging = os.path.join(directory, 'staging')
+        self.keyframe_directory = os.path.join(self.staging, 'keyframes')
+        for path in (self.staging, self.keyframe_directory):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.store = store
+        self.save_record = save_record
+        self.codecs = {'video' : video_codec, 'depth' : depth_codec}
+        self.processes = processes or multiprocessing.cpu_count()
+        self.keyframe_interval = keyframe_interval
+        self.slots = threading.BoundedSemaphore(max_pending or 4 * self.processes)
+        self.keyframes = {} # (origin machine, stream) to its KeyFrame.
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def start(self):
+        'Start the worker processes. This should happen before any threads are started.'
+        self.pool = multiprocessing.Pool(self.processes)
+        return self
+
+    def close(self):
+        'Finish encoding every submitted frame and stop the worker processes.'
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        with self.lock:
+            for key in self.keyframes.values():
+                key.retired = True
+                self._release_key(key)
+            self.keyframes = {}
+
+    def staging_path(self, file_name):
+        'Where the frame FILE_NAME should be written before it is submitted.'
+        return os.path.join(self.staging, file_name)
+
+    def _reference(self, frame, codec):
+        'Pick the key frame FRAME is encoded against. Returns a codec and key frame pair.'
+        source = (frame.origin_machine, frame.stream)
+        with self.lock:
+            key = self.keyframes.get(source)
+            if key is not None and key.uses < self.keyframe_interval:
+                key.uses += 1
+                key.pending += 1
+                return codec, key
+            new_key = KeyFrame(frame.file_name, os.path.join(self.keyframe_directory, frame.file_name))
+            if hasattr(os, 'link'):
+                os.link(self.staging_path(frame.file_name), new_key.path)
+            else:
+                shutil.copyfile(self.staging_path(frame.file_name), new_key.path)
+            self.keyframes[source] = new_key
+            if key is not None:
+                key.retired = True
+                self._release_key(key)
+            return 'zlib', None
+
+    def _release_key(self, key):
+        'Remove the file of KEY if nothing needs it anymore. Must hold the lock.'
+        if key.retired and key.pending == 0:
+            try:
+                os.unlink(key.path)
+            except OSError:
+                pass
+
+    def submit(self, frame):
+        'Encode and store the staged FRAME. Blocks while too many frames are waiting.'
+        codec = self.codecs.get(frame.stream, self.codecs['video'])
+        key = None
+        if frame_codec.needs_reference(codec):
+            codec, key = self._reference(frame, codec)
+        self.slots.acquire()
+        self.pool.apply_async(compress_file,
+                              (self.staging_path(frame.file_name), codec, key.path if key else None),
+                              callback = lambda result: self._finish(frame, key, result))
+
+    def _finish(self, frame, key, result):
+        'Store an encoded frame and save its record. Runs on the pool\'s result thread.'
+        success, codec, data = result
+        path = self.staging_path(frame.file_name)
+        stored = False
+        try:
+            if not success:
+                logging.error('Could not encode %s with %s, storing it as is. %s', frame.file_name, codec, data)
+                codec = 'raw'
+                with open(path, 'rb') as f_obj:
+                    data = f_obj.read()
+            frame.location = self.store.save(io.BytesIO(data), len(data), frame.file_name, frame.stream)
+            stored = True
+            frame.codec = codec
+            frame.reference = key.file_name if key is not None and frame_codec.needs_reference(codec) else None
+            self.save_record(frame)
+        except Exception, e:
+            logging.error('Could not store %s. %s', frame.file_name, repr(e))
+            if not stored and self.journal is not None:
+                self.journal.abort(frame.file_name)
+        finally:
+            os.unlink(path)
+            self.slots.release()
+            if key is not None:
+                with self.lock:
+                    key.pending -= 1
+                    self._release_key(key)
@@ -0,0 +1,149 @@
+'A pool of persistent connections to the frames database.'
+
+### Opening a sqlite connection means opening the file, reading the
+### schema, and throwing away every prepared statement when it's
+### closed again. Doing that for every frame is wasted work. The pool in
+### this module keeps connections open between requests so that each
+### request borrows a connection that is already set up, along with
+### the statements that connection has already prepared.
+
+import sqlite3
+import threading
+import logging
+import time
+
+## When the database server runs on several processes, their writers
+## take turns holding the database's write lock. A connection that finds
+## the lock taken waits up to BUSY_TIMEOUT seconds for it instead of
+## failing straight away. A READONLY connection refuses to write, and
+## leaves the journal mode of the database alone.
+def connect(db_path, cached_statements = 100, busy_timeout = 30.0, readonly = False):
+    'Open a connection to the database at DB_PATH with write ahead logging turned on.'
+    db = sqlite3.connect(db_path,
+                         timeout = busy_timeout,
+                         check_same_thread = False,
+                         cached_statements = cached_statements)
+    if readonly:
+        db.execute('PRAGMA query_only=ON')
+        return db
+    db.execute('PRAGMA journal_mode=WAL')
+    ## In WAL mode, a NORMAL sync only syncs when the log is
+    ## checkpointed, which is still safe from corruption.
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+class PoolExhaustedException(Exception):
+    'No connection became free before the timeout.'
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+    def __repr__(self):
+        return 'All %d database connections were in use for %s seconds.' % (self.max_size, self.timeout)
+
+## A connection is only ever used by one thread at a time; it's either
+## sitting idle in the pool or borrowed by a single request. That's why
+## the connections can be opened with check_same_thread turned off.
+## The pool never has more than MAX_SIZE connections open. A connection
+## that has been idle for longer than CHECK_INTERVAL seconds is tested
+## before it's handed out, and replaced if the test fails.
+class ConnectionPool(object):
+    'A bounded pool of reusable database connections.'
+    def __init__(self, db_path, max_size = 8, timeout = 10.0, check_interval = 30.0,
+                 cached_statements = 100, row_factory = None, readonly = False):
+        self.db_path = db_path
+        self.readonly = readonly
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.cached_statements = cached_statements
+        self.row_factory = row_factory
+        self.idle = [] # (connection, time released) pairs.
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.counts = {'created' : 0,
+                       'reused' : 0,
+                       'discarded' : 0,
+                       'checked' : 0,
+                       'in_use' : 0,
+                       'timeouts' : 0}
+
+    def _open(self):
+        db = connect(self.db_path, self.cached_statements, readonly = self.readonly)
+        if self.row_factory is not None:
+            db.row_factory = self.row_factory
+        return db
+
+    def _is_healthy(self, db):
+        'True if the connection DB still answers queries.'
+        with self.lock:
+            self.counts['checked'] += 1
+        try:
+            db.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error, e:
+            logging.warning('Discarding broken database connection. %s', e)
+            return False
+
+    def acquire(self):
+        'Borrow a connection from the pool, opening a new one if none are idle.'
+        ## The semaphore's acquire method in Python 2 doesn't take a
+        ## timeout, so poll it until the deadline.
+        deadline = time.time() + self.timeout
+        while not self.slots.acquire(False):
+            if time.time() >= deadline:
+                with self.lock:
+                    self.counts['timeouts'] += 1
+                raise PoolExhaustedException(self.max_size, self.timeout)
+            time.sleep(0.001)
+        try:
+            with self.lock:
+                self.counts['in_use'] += 1
+            ## Idle connections are only touched by the thread that
+            ## popped them, so checking them doesn't need the lock.
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    db, released = self.idle.pop()
+                if time.time() - released < self.check_interval or self._is_healthy(db):
+                    with self.lock:
+                        self.counts['reused'] += 1
+                    return db
+                with self.lock:
+                    self.counts['discarded'] += 1
+                db.close()
+            db = self._open()
+            with self.lock:
+                self.counts['created'] += 1
+            return db
+        except:
+            with self.lock:
+                self.counts['in_use'] -= 1
+            self.slots.release()
+            raise
+
+    def release(self, db, discard = False):
+        'Return a borrowed connection to the pool. A DISCARDed connection is closed instead.'
+        with self.lock:
+            self.counts['in_use'] -= 1
+            if discard:
+                self.counts['discarded'] += 1
+                db.close()
+            else:
+                self.idle.append((db, time.time()))
+        self.slots.release()
+
+    def close(self):
+        'Close every idle connection.'
+        with self.lock:
+            for db, _ in self.idle:
+                db.close()
+            self.idle = []
+
+    def stats(self):
+        'A dictionary of counters describing how the pool has been used.'
+        with self.lock:
+            stats = dict(self.counts)
+            stats['idle'] = len(self.idle)
+            stats['max_size'] = self.max_size
+        return stats
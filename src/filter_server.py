@@ -1,37 +1,57 @@
 import logging
-import requests
 import json
 import datetime
 import argparse
-import ipaddress
-import sqlite3
+import atexit
 
 from flask import Flask
 from flask import request
 from flask import g
+from flask import jsonify
 
 from util import *
-
+from forwarder import Forwarder, CouldNotForwardException, OVERFLOW_POLICIES, STRATEGIES, destination_url
+from rate_limit import DelayTracker, SharedDelayTracker
+from rate_control import RateController
+from change_detect import ChangeDetector
+from rule_index import PrefixIndex
+from rule_watcher import RuleWatcher
+from rule_snapshot import RuleSnapshots
+import frame_stream
+import prefork
+import metrics
+import profiling
+from profiling import span
+
+## The ipaddress module is only needed once rules or addresses are
+## parsed, so it's imported then instead of when this module is, the
+## same as requests in the forwarder.
+ipaddress = None
+
+def _import_ipaddress():
+    global ipaddress
+    if ipaddress is None:
+        import ipaddress
 
 ## This function handles the core logic of the server. If a rule
 ## exists for a connection and enough time has elapsed, the data is
-## forwarded to the destination address.
-def can_send(in_address):
-    'True if the a message from the given address can be forwarded.'
-    rule_table = get_rule_table()
-    rule = rule_table.get(in_address)
-    delay_table = get_delay_table()
-    time_of_last_forward = delay_table.get(rule._in, datetime.datetime.now() - rule.delay)
-    logging.info('%s >= %s', time_since(time_of_last_forward), rule.delay)
-    if time_since(time_of_last_forward) >= rule.delay:
-        delay_table.update(rule._in, datetime.datetime.now())
-        return True
-    else:
-        return False
-    
-
-
-
+## forwarded to the destination address. In adaptive mode, the delay is
+## set by how well the rule's destinations are keeping up, and the
+## rule's own delay is the shortest it can be. See rate_control.py.
+## A sensor sends video and depth frames from the same address, so each
+## of its streams has a delay of its own.
+def can_send(in_address, rule = None, stream = None):
+    'True if the a message from the given address and STREAM can be forwarded.'
+    if rule is None:
+        rule = get_rule_table().get(in_address)
+    delay = rule.delay.total_seconds()
+    controller = get_rate_controller()
+    if controller is not None and rule.out != 'NULL':
+        delay = controller.delay([destination_url(out, out_port) for out, out_port in rule.destinations],
+                                 delay)
+    return get_delay_tracker().try_acquire((in_address, stream),
+                                           delay,
+                                           rule.burst)
 
 ## The route rule is a description of how data from an incoming
 ## address will be handled. This object maps directly to the
@@ -42,14 +62,35 @@ def can_send(in_address):
 ## input port, the port the server is running on. The delay value is
 ## the minimum amount of time between input requests allowed. If data
 ## is sent from the same ip address before the delay has elapsed, the
-## data will be dropped.
+## data will be dropped. If burst is set, the delay is an average
+## instead; a source that has been quiet can send up to burst messages
+## at once. If async_forward is true, the sender is
+## answered as soon as the data is queued to be forwarded, without
+## waiting for the destination to answer. If min_change is set, a frame
+## is only forwarded if at least that fraction of it differs from the
+## last frame forwarded from the same address. A rule can have more
+## destinations than its out address and port. All of them are in
+## destinations as (out, out_port) pairs, the rule's own first, and the
+## strategy decides which of them each frame goes to. See forwarder.py
+## for the strategies. The delay can be given as a timedelta or as a
+## number of seconds.
 class RouteRule(object):
     'A rule for forwarding data.'
-    def __init__(self, _in, out, out_port, delay = datetime.timedelta(seconds = 0)):
+    def __init__(self, _in, out, out_port, delay = datetime.timedelta(seconds = 0), burst = None, async_forward = False, min_change = None,
+                 destinations = None, strategy = 'replicate'):
         self._in = _in
         self.out = out
         self.out_port = out_port
-        self.delay = delay
+        self.destinations = destinations if destinations is not None else [(out, out_port)]
+        self.strategy = strategy
+        self.delay = delay if isinstance(delay, datetime.timedelta) else datetime.timedelta(seconds = delay)
+        self.burst = burst
+        self.async_forward = async_forward
+        self.min_change = min_change
+    def __eq__(self, other):
+        return isinstance(other, RouteRule) and self.__dict__ == other.__dict__
+    def __ne__(self, other):
+        return not self == other
 
 ## There are many exceptions here to account for all the possible
 ## errors when parsing a rule file. Rule files are a subset of JSON,
@@ -94,23 +135,52 @@ class RuleFieldTypeException(Exception):
     def __repr__(self):
         return 'Parsing error in file %s at line %d. Bad value for key %s. Predicate %s returned false on value %s.' % (self.file_path, self.index, self.key, self.predicate, self.value,)
 
+## A rule's input can be a single address or a whole network. Both are
+## kept in a prefix index so that the most specific rule covering an
+## address is the one used; a single address is just a network with a
+## 128 bit prefix. Since the same few sources send data over and over,
+## the rule found for each address is cached until the table changes.
+## See rule_index.py for details.
+def rule_key(_in):
+    'The key a rule with the input address or network _IN is stored under.'
+    return _in if _in == 'DEFAULT' else _in.exploded
+
 class RuleTable(object):
+    CACHE_SIZE = 65536
     def __init__(self, init_rules = []):
         'Set up an empty rule table, add any rules given in the init function, and set up a null default rule.'
         self.rules = {}
+        self.index = PrefixIndex()
+        self.cache = {}
         for rule in init_rules:
-            self.rules[rule._in.exploded] = rule
+            self.set(rule)
         if not 'DEFAULT' in self.rules:
-            self.rules['DEFAULT'] = RouteRule('DEFAULT', 'NULL', 0)
+            self.rules['DEFAULT'] = RouteRule('DEFAULT', 'NULL', 0, delay = datetime.timedelta(0))
+    def __getstate__(self):
+        'The table without its cache, for saving in a snapshot.'
+        state = dict(self.__dict__)
+        state['cache'] = {}
+        return state
     def set(self, new_rule):
         'Add a new routing rule to the table.'
-        self.rules[new_rule._in.exploded] = new_rule
+        self.rules[rule_key(new_rule._in)] = new_rule
+        if new_rule._in != 'DEFAULT':
+            _import_ipaddress()
+            self.index.insert(ipaddress.ip_network(new_rule._in), new_rule)
+        self.cache = {}
     def get(self, key):
         'Get the routing rule for the given input IP address.'
         try:
-            return self.rules[key.exploded]
+            return self.cache[key]
         except KeyError:
-            return self.rules['DEFAULT']
+            pass
+        rule = self.index.lookup(key)
+        if rule is None:
+            rule = self.rules['DEFAULT']
+        if len(self.cache) >= self.CACHE_SIZE:
+            self.cache = {}
+        self.cache[key] = rule
+        return rule
 
 class MissingRuleValueException(Exception):
     'A routing rule is missing a required binding.'
@@ -119,7 +189,7 @@ class MissingRuleValueException(Exception):
 
 ## These are just some global constants that determine which fields
 ## can and must be in a rule file.
-VALID_KEYS = {'in', 'out', 'delay', 'out_port'}
+VALID_KEYS = {'in', 'out', 'delay', 'out_port', 'burst', 'async', 'min_change', 'destinations', 'strategy'}
 REQUIRED_KEYS = {'out', 'out_port'}
 
 ## These two tests are used for checking that the fields in a rule
@@ -131,17 +201,64 @@ def is_positive_or_zero_integer(n):
 
 def is_positive_integer(n):
     'True if the argument is an intger greater than zero.'
-    return (n == int(n)) and n >= 0
+    return (n == int(n)) and n > 0
+
+def is_positive_or_zero_number(n):
+    'True if the argument is a number greater than or equal to zero.'
+    return n >= 0
+
+def is_valid_ipv6_network(net):
+    'True if NET is an ipv6 network in CIDR notation without any host bits set.'
+    _import_ipaddress()
+    try:
+        return ipaddress.ip_network(unicode(net)).version == 6
+    except ValueError:
+        return False
+
+def is_boolean(b):
+    'True if the argument is a JSON boolean or a string spelling one.'
+    return b in (True, False, 'true', 'false')
+
+def is_fraction(n):
+    'True if the argument is a number from zero to one.'
+    return 0 <= n <= 1
+
+def is_destination_list(destinations):
+    'True if the argument is a list of objects that each have only a valid out address and out_port.'
+    try:
+        return type(destinations) is list and all(type(destination) is dict and
+                                                  set(destination) == {'out', 'out_port'} and
+                                                  is_valid_ipv6_address(destination['out']) and
+                                                  is_positive_integer(int(destination['out_port']))
+                                                  for destination in destinations)
+    except (ValueError, TypeError):
+        return False
+
+def is_strategy(strategy):
+    'True if the argument names a way of spreading frames over destinations.'
+    return strategy in STRATEGIES
+
+def parse_rule_input(_in):
+    'Turn the value of a rule\'s in field into an address, a network, or DEFAULT.'
+    if _in == 'DEFAULT':
+        return _in
+    _import_ipaddress()
+    if '/' in _in:
+        return ipaddress.ip_network(unicode(_in))
+    else:
+        return ipaddress.ip_address(unicode(_in))
 
 ## Most of the code in this module is in or supporting this
 ## load_rule_file function. The function opens a file at the given
 ## path, parses it, checks for type errors, and returns a list of rule
 ## objects.
-def load_rule_file(file_path):
-    'Load the routing rules in FILE_PATH.'
+def load_rule_file(file_path, text = None):
+    'Load the routing rules in FILE_PATH. TEXT is the contents of the file if they have already been read.'
     try:
-        with file(file_path) as f_obj:
-            rules = json.load(f_obj)
+        if text is None:
+            with file(file_path) as f_obj:
+                text = f_obj.read()
+        rules = json.loads(text)
     except ValueError:
         raise BadRuleFileException(file_path)
     if type(rules) is not list:
@@ -157,10 +274,13 @@ def load_rule_file(file_path):
         for key in rule.keys():
             if key not in VALID_KEYS:
                 raise UnknownRuleValueException(file_path, index, key)
-        ## Test that the optional input IP address is valid if it exists.
-        ## If it does not exist, set it to a sane default.
+        ## Test that the optional input IP address or network is valid if
+        ## it exists. If it does not exist, set it to a sane default.
         try:
-            assert is_valid_ipv6_address(rule['in'])
+            if '/' in rule['in']:
+                assert is_valid_ipv6_network(rule['in'])
+            else:
+                assert is_valid_ipv6_address(rule['in'])
         except KeyError:
             rule['in'] = 'DEFAULT'
         except AssertionError:
@@ -168,12 +288,30 @@ def load_rule_file(file_path):
                                          index,
                                          'in',
                                          rule['in'],
-                                         is_valid_ipv6_address)
+                                         is_valid_ipv6_network if '/' in rule['in'] else is_valid_ipv6_address)
+        ## Test that the optional list of more destinations is valid if
+        ## it exists. Each one is an object with its own out and
+        ## out_port. If the rule has no out and out_port of its own, the
+        ## first destination in the list takes their place.
+        try:
+            assert is_destination_list(rule['destinations'])
+        except KeyError:
+            rule['destinations'] = []
+        except AssertionError:
+            raise RuleFieldTypeException(file_path,
+                                         index,
+                                         'destinations',
+                                         rule['destinations'],
+                                         is_destination_list)
+        if 'out' not in rule and 'out_port' not in rule and rule['destinations']:
+            first = rule['destinations'].pop(0)
+            rule['out'] = first['out']
+            rule['out_port'] = first['out_port']
         ## Test that the mandatory output IP address exists and is valid.
         try:
             assert is_valid_ipv6_address(rule['out'])
         except KeyError:
-            MissingRuleValueException(file_path, index, key)
+            raise MissingRuleValueException(file_path, index, 'out')
         except AssertionError:
             raise RuleFieldTypeException(file_path,
                                          index,
@@ -195,8 +333,10 @@ def load_rule_file(file_path):
                                           is_positive_integer)
         ## Test the the optional delay address is valid if it exists.
         ## If it does not exist, set it to a sane default.
+        ## The delay is in seconds, but it doesn't have to be a whole
+        ## number of them.
         try:
-            assert is_positive_or_zero_integer(int(rule['delay']))
+            assert is_positive_or_zero_number(float(rule['delay']))
         except KeyError:
             rule['delay'] = 0
         except (AssertionError, ValueError):
@@ -204,16 +344,78 @@ def load_rule_file(file_path):
                                          index,
                                          'delay',
                                          rule['delay'],
-                                         is_positive_or_zero_integer)
-    return RuleTable(RouteRule(_in = ipaddress.ip_address(rule['in']) if rule['in'] != 'DEFAULT' else 'DEFAULT',
+                                         is_positive_or_zero_number)
+        ## Test that the optional burst size is valid if it exists.
+        ## If it does not exist, the delay is a fixed minimum.
+        try:
+            assert is_positive_integer(int(rule['burst']))
+        except KeyError:
+            rule['burst'] = None
+        except (AssertionError, ValueError):
+            raise RuleFieldTypeException(file_path,
+                                         index,
+                                         'burst',
+                                         rule['burst'],
+                                         is_positive_integer)
+        ## Test that the optional async flag is valid if it exists.
+        ## If it does not exist, wait for the destination like before.
+        try:
+            assert is_boolean(rule['async'])
+        except KeyError:
+            rule['async'] = False
+        except AssertionError:
+            raise RuleFieldTypeException(file_path,
+                                         index,
+                                         'async',
+                                         rule['async'],
+                                         is_boolean)
+        ## Test that the optional strategy is valid if it exists. If it
+        ## does not exist, frames go to every destination.
+        try:
+            assert is_strategy(rule['strategy'])
+        except KeyError:
+            rule['strategy'] = 'replicate'
+        except AssertionError:
+            raise RuleFieldTypeException(file_path,
+                                         index,
+                                         'strategy',
+                                         rule['strategy'],
+                                         is_strategy)
+        ## Test that the optional minimum change is valid if it exists.
+        ## If it does not exist, frames are forwarded whatever they hold.
+        try:
+            assert is_fraction(float(rule['min_change']))
+        except KeyError:
+            rule['min_change'] = None
+        except (AssertionError, ValueError):
+            raise RuleFieldTypeException(file_path,
+                                         index,
+                                         'min_change',
+                                         rule['min_change'],
+                                         is_fraction)
+    _import_ipaddress()
+    return RuleTable(RouteRule(_in = parse_rule_input(rule['in']),
                                out = ipaddress.ip_address(rule['out']),
                                out_port = rule['out_port'],
-                               delay = datetime.timedelta(seconds = int(rule['delay'])))
+                               delay = datetime.timedelta(seconds = float(rule['delay'])),
+                               burst = int(rule['burst']) if rule['burst'] is not None else None,
+                               async_forward = rule['async'] in (True, 'true'),
+                               min_change = float(rule['min_change']) if rule['min_change'] is not None else None,
+                               destinations = [(ipaddress.ip_address(destination['out']), destination['out_port'])
+                                               for destination in [rule] + rule['destinations']],
+                               strategy = rule['strategy'])
                      for rule in rules)
 
-def time_since(epoch):
-    'Return the time elapsed since the given date time argument.'
-    return datetime.datetime.now() - epoch
+## Parsed rule tables are saved as snapshots, so the filter only parses
+## a rule file the first time it sees its contents. Starting again with
+## the same file, and every worker but the first to reload a changed
+## file, load the snapshot instead. See rule_snapshot.py for details.
+RULE_SNAPSHOTS = None
+def load_rules(file_path):
+    'Load the routing rules in FILE_PATH, from a snapshot if there is one.'
+    if RULE_SNAPSHOTS is None:
+        return load_rule_file(file_path)
+    return RULE_SNAPSHOTS.load(file_path, load_rule_file)
 
 class NoRuleFileException(Exception):
     def __init__(self, path):
@@ -226,62 +428,64 @@ def get_rule_table():
     'Load the current rule file.'    
     return RULE_TABLE
 
-
-def make_delay(cursor, row):
-    ip_address_str, duration_str = row
-    return Delay(ipaddress.IPv6Address(ip_address_str),
-                 datetime.datetime.strptime(duration_str, '%Y-%m-%dT%H:%M:%S'))
-
-
-## Initialize delay table with Schema.
-DELAY_TABLE = sqlite3.connect(':memory:')
-with file('delay_schema.sql') as f_obj:
-    DELAY_TABLE.cursor().execute(f_obj.read())
-DELAY_TABLE.row_factory = make_delay # Changes the way queries are represented.    
-
-class Delay(object):
-    def __init__(self, ip_address, duration):
-        self.ip_address = ip_address
-        self.duration = duration
-    def get_ip(self):
-        return self.ip_address
-    def get_duration(self):
-        return self.duration
-
-class DelayTable(object):
-    'A connection to a delay table database.'
-    def __init__(self, db):
-        self.db = db
-    def get(self, ip_addr, default):
-        'Get the delay on the given IP address. The \'ip_addr\' argument is an IPv6Address object. Returns default if no value with given IP address could be found.'
-        cursor = self.db.cursor()
-        cursor.execute('SELECT * FROM delay WHERE origin_machine=?',
-                       (ip_addr.exploded,))
-        result = cursor.fetchone()
-        if result:
-            return result.get_duration()
-        else:
-            logging.info('Could not find %s in delay table. Returning default value instead.', ip_addr)
-            return default
-    
-    def update(self, ip_addr, time):
-        'Update the delay on the given IP address. Creates a new row if address doesn\'t already have a delay. The \'ip_addr\' argument is an IPv6Address object and the \'time\' argument is a datetime object.'
-        cursor = self.db.cursor()
-        exists = self.get(ip_addr, None) ## Note, ip_addr does not need to be exploded here, because it's calling a public method.
-        if not exists:
-            cursor.execute('INSERT INTO delay (origin_machine, time_elapsed) VALUES (?, ?)',
-                           (ip_addr.exploded,
-                            time.replace(microsecond = 0).isoformat(),))
-        else:
-            cursor.execute('UPDATE delay SET time_elapsed=? WHERE origin_machine=?',
-                           (time.replace(microsecond = 0).isoformat(),
-                            ip_addr.exploded,))
-
-
-def get_delay_table():
-    return DelayTable(DELAY_TABLE)
+## The rule table can be replaced while the server is running. Request
+## handlers only ever read the global once per request, and assigning
+## it is atomic, so a request sees either the old table or the new one.
+## A source keeps its place in the delay tracker, and its last frame,
+## if the rule that applies to it is the same in both tables. Otherwise
+## it starts over under its new rule. Both are kept by (address, stream)
+## pairs.
+def install_rule_table(new_table):
+    'Swap in NEW_TABLE as the current rule table.'
+    global RULE_TABLE
+    old_table, RULE_TABLE = RULE_TABLE, new_table
+    if old_table is None:
+        return
+    for tracker in (get_delay_tracker(), get_change_detector()):
+        for source in tracker.known_sources():
+            if old_table.get(source[0]) != new_table.get(source[0]):
+                tracker.forget(source)
+
+## The forwarder keeps connections to every destination open between
+## requests. See forwarder.py for details.
+FORWARDER = None
+def get_forwarder():
+    'Get the forwarder used to send data to destinations.'
+    return FORWARDER
+
+
+## The delay tracker remembers when each source last had data
+## forwarded. See rate_limit.py for details.
+DELAY_TRACKER = DelayTracker()
+def get_delay_tracker():
+    'Get the tracker of forwarding delays.'
+    return DELAY_TRACKER
+
+## The rate controller sets delays from how well each destination is
+## keeping up. It's None unless the filter is run in adaptive mode.
+## Every worker process has its own.
+RATE_CONTROLLER = None
+def get_rate_controller():
+    'Get the controller of adaptive delays, or None if delays are fixed.'
+    return RATE_CONTROLLER
+
+## The change detector remembers the last frame forwarded from each
+## source with a minimum change. Every worker process has its own. See
+## change_detect.py for details.
+CHANGE_DETECTOR = ChangeDetector()
+def get_change_detector():
+    'Get the detector of frames that changed too little.'
+    return CHANGE_DETECTOR
 
 app = Flask(__name__) # Create the web application.
+metrics.instrument(app) # Count and time requests, and serve /metrics.
+profiling.instrument(app) # Trace sampled requests, and serve /debug.
+
+RATE_LIMITED = metrics.counter('kinect_rate_limited_total', 'Messages dropped because their source sent too soon.', ('source',))
+NULL_ROUTED = metrics.counter('kinect_null_routed_total', 'Messages dropped because their rule has no destination.', ('source',))
+UNCHANGED = metrics.counter('kinect_unchanged_total', 'Frames dropped because they barely differed from the last one forwarded.', ('source',))
+FRAME_CHANGE = metrics.histogram('kinect_frame_change', 'The fraction of a frame that changed, for sources with a minimum change.',
+                                 buckets = (0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0))
 
 @app.errorhandler(500)
 def internal_logging(exception):
@@ -303,8 +507,20 @@ def internal_logging(exception):
         logging.error(repr(e))
         if e.predicate == is_valid_ipv6_address:
             logging.debug('Is the bad value not a valid ipv6 address? A plain ipv4 address will not work.')
+        elif e.predicate == is_valid_ipv6_network:
+            logging.debug('Is the bad value not a valid ipv6 network? Are there bits set after the prefix?')
         elif e.predicate == is_valid_ipv6_address == is_positive_or_zero_integer:
             logging.debug('Is the bad value not a positive integer or zero?')
+        elif e.predicate == is_positive_or_zero_number:
+            logging.debug('Is the bad value not a positive number or zero?')
+        elif e.predicate == is_boolean:
+            logging.debug('Is the bad value not true or false?')
+        elif e.predicate == is_fraction:
+            logging.debug('Is the bad value not a number from zero to one?')
+        elif e.predicate == is_destination_list:
+            logging.debug('Is the bad value not a list of objects with only out and out_port?')
+        elif e.predicate == is_strategy:
+            logging.debug('Is the bad value not one of %s?', ', '.join(STRATEGIES))
         else:
             logging.debug('Is the value not valid in some way?')
     except NoRuleFileException, e:
@@ -318,44 +534,227 @@ def internal_logging(exception):
         logging.debug('Nothing is known about the last error.')
     return '500'
 
+## Parsing the sender's address happens on every request, but there
+## are only ever a few senders. The parsed addresses are kept so each
+## one is only parsed once.
+_ADDRESSES = {}
+def parse_address(text):
+    'The ipaddress object for the address TEXT.'
+    try:
+        return _ADDRESSES[text]
+    except KeyError:
+        if len(_ADDRESSES) >= RuleTable.CACHE_SIZE:
+            _ADDRESSES.clear()
+        _import_ipaddress()
+        address = _ADDRESSES[text] = ipaddress.ip_address(unicode(text))
+        return address
+
+## The change check comes before the delay, so a frame that's dropped
+## for barely changing doesn't use up its source's delay. A frame is
+## only remembered as the last one from its source once it has been
+## forwarded. Frames are only compared with the last one from the same
+## stream, since a depth frame is nothing like a video frame.
+def check_change(source, rule, data, header = None):
+    'A (changed enough, sample) pair for the frame DATA from the (address, stream) pair SOURCE under RULE. HEADER is its FrameHeader if it came in a frame stream.'
+    if rule.min_change is None:
+        return True, None
+    detector = get_change_detector()
+    frame_sample = detector.sample(data, header)
+    change = detector.change(source, frame_sample)
+    FRAME_CHANGE.observe(change)
+    return change >= rule.min_change, frame_sample
+
+## The database needs to know which stream a frame is from and when the
+## sensor took it, so those headers are passed on with the frame.
+FORWARDED_HEADERS = ('X-Stream', 'X-Sensor-Time')
+
+def forwarded_headers():
+    'The headers of the current request that are passed on with its frame.'
+    return dict((key, request.headers[key]) for key in FORWARDED_HEADERS if key in request.headers)
+
+def request_stream():
+    'The stream the X-Stream header of the current request names, or None if it names none.'
+    stream = request.headers.get('X-Stream')
+    return stream if stream in frame_stream.STREAMS else None
 
-class CouldNotForwardException(Exception):
-    def __init__(self, destination):
-        self.destination = destination
-    def __repr__(self):
-        return 'Could not connect to %s' % (self.destination,)
-    
 @app.route('/', methods = ('POST', 'PUT'))
 def filter():
-    remote_addr = ipaddress.ip_address(unicode(request.remote_addr))
-    if not can_send(remote_addr):
-        logging.info('Rejected message from %s due to delay limit.', remote_addr)
-        return 'Failure'
-    rule_table = get_rule_table()
-    rule = rule_table.get(remote_addr)
+    with span('find rule'):
+        remote_addr = parse_address(request.remote_addr)
+        rule = get_rule_table().get(remote_addr)
+    ## A rule with nowhere to send frames never touches the change
+    ## detector or the delay tracker.
     if rule.out == 'NULL':
-        logging.info('Source %s had NULL destination, message not routed.', remote_addr)
+        NULL_ROUTED.inc(1, (request.remote_addr,))
+        FRAME_LOG('Source %s had NULL destination, message not routed.', remote_addr)
         return 'Failure'
-    url = 'http://[%s]:%s/' % (rule.out.exploded, rule.out_port)
-    try:
-        requests.post(url, data = request.data)
-    except requests.ConnectionError:
-        raise CouldNotForwardException(url)
-    logging.info('Forwarded message from %s to %s',
-                 remote_addr, rule.out)
+    stream = request_stream()
+    with span('read body'):
+        data = request.data
+    with span('change check'):
+        changed, frame_sample = check_change((remote_addr, stream), rule, data)
+    if not changed:
+        UNCHANGED.inc(1, (request.remote_addr,))
+        FRAME_LOG('Rejected message from %s because it barely changed.', remote_addr)
+        return 'Failure'
+    with span('delay check'):
+        allowed = can_send(remote_addr, rule, stream)
+    if not allowed:
+        RATE_LIMITED.inc(1, (request.remote_addr,))
+        FRAME_LOG('Rejected message from %s due to delay limit.', remote_addr)
+        return 'Failure'
+    with span('forward'):
+        accepted = get_forwarder().forward(rule, data, remote_addr, forwarded_headers())
+    if not accepted:
+        FRAME_LOG('Message from %s was not taken by %s.', remote_addr, rule.out)
+        return 'Failure'
+    get_change_detector().remember((remote_addr, stream), frame_sample)
+    FRAME_LOG('Forwarded message from %s to %s',
+              remote_addr, rule.out)
     return 'Success'
 
+## A frame stream is passed through frame by frame. Each frame in it is
+## held to the same change and delay as a frame sent on its own, and the frames
+## that pass are sent on to the destination as one chunked stream of
+## their own, while the rest of the stream is still arriving. Streams
+## are always forwarded while the sender waits, whether or not its rule
+## waits, and go to a single destination picked by the rule's strategy.
+## See frame_stream.py for details.
+@app.route('/stream', methods = ('POST', 'PUT'))
+def filter_stream():
+    remote_addr = parse_address(request.remote_addr)
+    rule = get_rule_table().get(remote_addr)
+    if rule.out == 'NULL':
+        NULL_ROUTED.inc(1, (request.remote_addr,))
+        FRAME_LOG('Source %s had NULL destination, stream not routed.', remote_addr)
+        return jsonify(forwarded = 0, rejected = 0), 400
+    counts = {'forwarded' : 0, 'rejected' : 0}
+    def passed():
+        for header, pixels in frame_stream.read_frames(request.stream):
+            changed, frame_sample = check_change((remote_addr, header.stream), rule, pixels, header)
+            if not changed:
+                UNCHANGED.inc(1, (request.remote_addr,))
+                counts['rejected'] += 1
+                continue
+            if not can_send(remote_addr, rule, header.stream):
+                RATE_LIMITED.inc(1, (request.remote_addr,))
+                counts['rejected'] += 1
+                continue
+            get_change_detector().remember((remote_addr, header.stream), frame_sample)
+            counts['forwarded'] += 1
+            yield header.pack()
+            yield pixels
+    try:
+        response = get_forwarder().choose(rule, remote_addr)[0].send_stream(passed())
+    except (frame_stream.BadFrameHeaderException, frame_stream.TruncatedStreamException), e:
+        logging.error(repr(e))
+        return jsonify(error = repr(e), **counts), 400
+    FRAME_LOG('Forwarded %d frames of a stream from %s to %s',
+              counts['forwarded'], remote_addr, rule.out)
+    return jsonify(**counts), response.status_code
+
+## The forwarder keeps latency counts for each destination and the
+## depth of its queue. They're served as JSON so they can be checked on
+## a running server.
+@app.route('/forwarding', methods = ('GET',))
+def forwarding_stats():
+    'Statistics about data forwarded to destinations.'
+    return jsonify(get_forwarder().stats())
+
+## Setting up the server is split in two. The rule table and the delay
+## tracker are set up once by configure, before any worker processes
+## are forked. The delay tracker is made in shared memory when there is
+## more than one worker, so a source can't send once per worker. The
+## forwarder and the rule watcher start threads, so they're started by
+## start in every process that serves requests. Every worker watches
+## the rule file and reloads it on its own.
+def configure(args):
+    'Set up the parts of the filter shared by every worker from the parsed command line ARGS.'
+    global RULE_PATH, PORT, DELAY_TRACKER, RULE_SNAPSHOTS
+    logging.basicConfig(level = getattr(logging, args.log_level))
+    FRAME_LOG.configure(getattr(logging, args.frame_log_level), args.frame_log_sample)
+    RULE_PATH = args.rule_path
+    PORT = args.port
+    if args.workers > 1:
+        DELAY_TRACKER = SharedDelayTracker(args.shared_sources)
+    if args.rule_snapshots:
+        RULE_SNAPSHOTS = RuleSnapshots(args.rule_snapshots)
+    install_rule_table(load_rules(RULE_PATH))
+    if args.workers > 1:
+        metrics.clear_shared(retrieve_file('metrics-%d' % (PORT,)))
+
+def start(args):
+    'Start the rule watcher and forwarder of this process from the parsed command line ARGS.'
+    global FORWARDER, RATE_CONTROLLER
+    if prefork.WORKER is not None:
+        atexit.register(metrics.share(retrieve_file('metrics-%d' % (PORT,)), prefork.WORKER).stop)
+    profiling.configure(args.trace_sample, args.profile_directory, args.profile_interval)
+    if args.rule_poll > 0:
+        watcher = RuleWatcher(RULE_PATH,
+                              load_rules,
+                              install_rule_table,
+                              interval = args.rule_poll).start()
+        atexit.register(watcher.stop)
+    if args.adaptive:
+        RATE_CONTROLLER = RateController(target_latency = args.target_latency,
+                                         max_error_rate = args.max_error_rate,
+                                         min_rate = args.min_rate,
+                                         max_rate = args.max_rate,
+                                         increase = args.rate_increase,
+                                         decrease = args.rate_decrease,
+                                         window = args.rate_window)
+        metrics.gauge('kinect_adaptive_rate', 'Frames a second each source may forward to a destination in adaptive mode.',
+                      ('destination',), function = RATE_CONTROLLER.rates)
+    FORWARDER = Forwarder(threads = args.forward_threads,
+                          max_in_flight = args.max_in_flight,
+                          timeout = args.forward_timeout,
+                          queue_size = args.queue_size,
+                          overflow = args.overflow,
+                          spill_directory = args.spill_directory,
+                          spill_size = args.spill_size,
+                          retries = args.retries,
+                          backoff = args.retry_backoff,
+                          controller = RATE_CONTROLLER).start()
+    ## Forward anything still queued before shutting down.
+    atexit.register(FORWARDER.close)
+    metrics.gauge('kinect_forward_queue_depth', 'Frames waiting to be forwarded, by destination and where they are kept.',
+                  ('destination', 'place'), function = FORWARDER.queue_depths)
+
 if __name__ == '__main__':
-    logging.basicConfig(level = logging.DEBUG)
     parser = argparse.ArgumentParser(description = 'HTTP filter that forwards HTTP requests but gives them a fixed delay')
     parser.add_argument('--rule-path', help = 'The path to the rule file for this program.', type = str, default = retrieve_file('.RULE'))
     parser.add_argument('--port', help = 'The port to run the server on.', type = is_port_number, default = 5000)
+    parser.add_argument('--rule-snapshots', help = 'The directory parsed rule files are saved in. An empty value turns snapshots off.', type = str, default = retrieve_file('rule-snapshots'))
+    parser.add_argument('--rule-poll', help = 'Seconds between checks of the rule file for changes. Zero turns reloading off.', type = float, default = 1.0)
+    parser.add_argument('--forward-threads', help = 'The number of threads forwarding queued data to each destination.', type = int, default = 4)
+    parser.add_argument('--max-in-flight', help = 'The most forwards to one destination at a time.', type = int, default = 4)
+    parser.add_argument('--forward-timeout', help = 'The most seconds to wait on a destination.', type = float, default = 10.0)
+    parser.add_argument('--queue-size', help = 'The most frames kept in memory waiting for each destination.', type = int, default = 256)
+    parser.add_argument('--overflow', help = 'What happens to a frame when its destination\'s queue is full.', choices = OVERFLOW_POLICIES, default = 'drop-newest')
+    parser.add_argument('--spill-directory', help = 'A directory to keep frames in once a queue\'s memory is full. No frames are spilled if not given.', type = str, default = None)
+    parser.add_argument('--spill-size', help = 'The most frames spilled to disk for each destination.', type = int, default = 4096)
+    parser.add_argument('--retries', help = 'The number of times a failed forward is tried again.', type = int, default = 5)
+    parser.add_argument('--retry-backoff', help = 'Seconds to wait before the first retry. The wait doubles with every retry.', type = float, default = 0.1)
+    parser.add_argument('--adaptive', help = 'Set delays from how well destinations keep up. Rule delays become the shortest allowed.', action = 'store_true')
+    parser.add_argument('--target-latency', help = 'In adaptive mode, the most seconds a forward should take on average.', type = float, default = 0.05)
+    parser.add_argument('--max-error-rate', help = 'In adaptive mode, the largest fraction of forwards that can fail before slowing down.', type = float, default = 0.05)
+    parser.add_argument('--min-rate', help = 'In adaptive mode, the fewest frames a second each source may forward.', type = float, default = 1.0)
+    parser.add_argument('--max-rate', help = 'In adaptive mode, the most frames a second each source may forward.', type = float, default = 30.0)
+    parser.add_argument('--rate-increase', help = 'In adaptive mode, frames a second added to the rate after a window without congestion.', type = float, default = 1.0)
+    parser.add_argument('--rate-decrease', help = 'In adaptive mode, the fraction the rate is multiplied by after a congested window.', type = float, default = 0.5)
+    parser.add_argument('--rate-window', help = 'In adaptive mode, the seconds of forwards looked at before each change to the rate.', type = float, default = 1.0)
+    parser.add_argument('--log-level', help = 'The lowest level of message logged.', choices = LOG_LEVELS, default = 'DEBUG')
+    parser.add_argument('--frame-log-level', help = 'The level messages logged for every frame are logged at.', choices = LOG_LEVELS, default = 'INFO')
+    parser.add_argument('--frame-log-sample', help = 'Only log one of every this many per frame messages.', type = int, default = 1)
+    parser.add_argument('--workers', help = 'The number of processes serving requests.', type = int, default = 1)
+    parser.add_argument('--trace-sample', help = 'Time the stages of one of every this many requests. Zero traces none.', type = int, default = 0)
+    parser.add_argument('--profile-directory', help = 'The directory profiles are saved in.', type = str, default = retrieve_file('profiles'))
+    parser.add_argument('--profile-interval', help = 'Seconds between samples of the profiler.', type = float, default = 0.005)
+    parser.add_argument('--shared-sources', help = 'The most sources the delay tracker shared by the workers can hold.', type = int, default = 65536)
     args = parser.parse_args()
-    RULE_PATH = args.rule_path
-    PORT = args.port
     print args.port
-    RULE_TABLE = load_rule_file(RULE_PATH)
-    app.run(host = '::', port = PORT)
+    configure(args)
+    prefork.serve(app, '::', PORT, args.workers, lambda: start(args))
     'There was a parsing error found inside of a routing rule.'
     def __init__(self, file_path, index):
         self.file_path = file_path
@@ -0,0 +1,603 @@
+'Forwards frames from the filter to their destinations over kept-alive connections.'
+
+### Posting a frame with requests.post opens a new TCP connection for
+### every frame and holds the request handler until the destination
+### answers. The forwarder in this module keeps a session with a pool
+### of open connections for every destination and can hand frames off
+### to sender threads, so a rule can choose to have the producer
+### answered before the frame reaches the database. Every destination
+### has its own bounded queue and sender threads, so one slow
+### destination doesn't hold up the others. A frame the destination
+### can't take right away is retried with a growing wait between tries,
+### so a short stall in the database doesn't lose frames. A rule can
+### have several destinations, and a strategy for spreading frames over
+### them. A destination that keeps failing is left out for a while.
+
+import os
+import os.path
+import re
+import bisect
+import hashlib
+import itertools
+import collections
+import threading
+import logging
+import time
+
+import metrics
+
+## Importing requests is a good part of the time the filter takes to
+## start, and nothing needs it until the first destination is made, so
+## it's imported then instead of when this module is.
+requests = None
+
+def _import_requests():
+    global requests
+    if requests is None:
+        import requests
+        import requests.adapters
+
+FORWARD_SECONDS = metrics.histogram('kinect_forward_seconds', 'Time taken for a destination to answer a forward.', ('destination',))
+FORWARD_FAILURES = metrics.counter('kinect_forward_failures_total', 'Forwards that failed or were turned away.', ('destination', 'reason'))
+FORWARD_BYTES = metrics.counter('kinect_forward_bytes_total', 'Bytes forwarded to a destination.', ('destination',))
+FORWARD_DROPPED = metrics.counter('kinect_forward_dropped_total', 'Frames that were never forwarded.', ('destination', 'reason'))
+FORWARD_RETRIES = metrics.counter('kinect_forward_retries_total', 'Forwards tried again after failing.', ('destination',))
+FORWARD_EJECTIONS = metrics.counter('kinect_forward_ejections_total', 'Times a destination was left out for failing.', ('destination',))
+
+class CouldNotForwardException(Exception):
+    def __init__(self, destination):
+        self.destination = destination
+    def __repr__(self):
+        return 'Could not connect to %s' % (self.destination,)
+
+def destination_url(out, out_port):
+    'The URL data forwarded to the OUT address and OUT_PORT is posted to.'
+    return 'http://[%s]:%s/' % (out.exploded, out_port)
+
+class QueueFullException(Exception):
+    'A frame could not be queued because the queue was full.'
+    def __init__(self, size):
+        self.size = size
+    def __repr__(self):
+        return 'The queue of %d frames is full.' % (self.size,)
+
+OVERFLOW_POLICIES = ('drop-newest', 'drop-oldest', 'block')
+
+## A frame queue holds up to SIZE frames in memory. If it's given a
+## spill directory, up to SPILL_SIZE more are written to files there
+## once memory is full, and read back when their turn comes. Frames
+## keep their order no matter where they're kept. When both are full,
+## the overflow policy decides what happens to a new frame:
+##  drop-newest  The new frame is turned away.
+##  drop-oldest  The oldest waiting frame is thrown out to make room.
+##  block        The sender waits up to the timeout for room, then the
+##               new frame is turned away.
+## Spilled frames are only meant to ride out a stall. They aren't read
+## back after a restart. Every frame is queued with the headers it's
+## forwarded with, which say which stream it's from and when the sensor
+## took it. They're small, so a spilled frame keeps its headers in
+## memory.
+class _Spilled(object):
+    'A queued frame that was written to a file.'
+    def __init__(self, path):
+        self.path = path
+
+class FrameQueue(object):
+    'A bounded first in first out queue of frames that can spill to disk.'
+    def __init__(self, size = 256, overflow = 'drop-newest', spill_directory = None, spill_size = 0):
+        self.size = size
+        self.overflow = overflow
+        self.spill_directory = spill_directory
+        self.spill_size = spill_size if spill_directory else 0
+        self.items = collections.deque()
+        self.in_memory = 0
+        self.on_disk = 0
+        self.spilled = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        if self.spill_directory and not os.path.isdir(self.spill_directory):
+            os.makedirs(self.spill_directory)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+    def _append(self, data, headers):
+        'Add DATA and its HEADERS to the end of the queue if there is room. True if there was. Must hold the lock.'
+        if self.in_memory < self.size:
+            self.items.append((data, headers))
+            self.in_memory += 1
+        elif self.on_disk < self.spill_size:
+            self.spilled += 1
+            path = os.path.join(self.spill_directory, '%012d.frame' % (self.spilled,))
+            with open(path, 'wb') as f_obj:
+                f_obj.write(data)
+            self.items.append((_Spilled(path), headers))
+            self.on_disk += 1
+        else:
+            return False
+        self.condition.notify()
+        return True
+
+    def _pop(self):
+        'Take the oldest frame off of the queue. Must hold the lock.'
+        item = self.items.popleft()
+        if isinstance(item[0], _Spilled):
+            self.on_disk -= 1
+        else:
+            self.in_memory -= 1
+        self.condition.notify_all()
+        return item
+
+    @staticmethod
+    def _load(item):
+        'The (data, headers) pair of a frame taken off of the queue.'
+        data, headers = item
+        if not isinstance(data, _Spilled):
+            return item
+        try:
+            with open(data.path, 'rb') as f_obj:
+                return f_obj.read(), headers
+        finally:
+            os.unlink(data.path)
+
+    def put(self, data, timeout = None, headers = None):
+        'Queue the frame DATA with its HEADERS. Returns the number of older frames dropped to make room. Raises QueueFullException if DATA was turned away.'
+        dropped = []
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while not self._append(data, headers):
+                if self.overflow == 'drop-oldest' and self.items:
+                    dropped.append(self._pop())
+                    continue
+                remaining = None if deadline is None else deadline - time.time()
+                if self.overflow != 'block' or self.closed or (remaining is not None and remaining <= 0):
+                    raise QueueFullException(self.size + self.spill_size)
+                self.condition.wait(remaining)
+        for item, _ in dropped:
+            if isinstance(item, _Spilled):
+                os.unlink(item.path)
+        return len(dropped)
+
+    def get(self):
+        'Wait for the oldest frame and take it off of the queue. Returns its (data, headers) pair, or None once the queue is closed and empty.'
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self._pop()
+        return self._load(item)
+
+    def close(self):
+        'Wake every waiting thread. Frames still queued can still be taken.'
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'queued_memory' : self.in_memory,
+                    'queued_disk' : self.on_disk}
+
+## A destination is one downstream server. Each destination gets its
+## own session so that connections to it are reused, and a limit on
+## the number of frames that can be on their way to it at once. A
+## frame that can't get a slot before the timeout is not forwarded.
+## The latency of every forward is recorded for reporting.
+## Frames that don't need to be forwarded while their sender waits go
+## on the destination's queue, and its sender threads forward them. A
+## forward that fails, or that the destination answers with a server
+## error, is tried again up to RETRIES more times, waiting BACKOFF
+## seconds before the first retry and twice as long before each one
+## after that, up to MAX_BACKOFF.
+## If the filter adapts its delays, every frame sent on its own is
+## reported to the rate controller with how long it took, waiting for a
+## slot included, and if it worked. Streams aren't reported, since they
+## last as long as their sender keeps sending. See rate_control.py.
+## A destination that fails EJECT_AFTER forwards in a row is ejected:
+## new frames aren't sent to it for EJECT_SECONDS. After that it's
+## given frames again, and if the first one fails it's ejected again
+## straight away. Any forward that works puts it back in good health.
+MAX_BACKOFF = 5.0
+EJECT_AFTER = 3
+EJECT_SECONDS = 10.0
+
+class Destination(object):
+    'A downstream server that frames are forwarded to.'
+    def __init__(self, url, max_in_flight = 4, timeout = 10.0, queue = None, retries = 5, backoff = 0.1, controller = None):
+        _import_requests()
+        self.url = url
+        self.controller = controller
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections = 1,
+                                                                    pool_maxsize = max_in_flight))
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.queue = queue if queue is not None else FrameQueue()
+        self.retries = retries
+        self.backoff = backoff
+        self.closing = False
+        self.workers = []
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.lock = threading.Lock()
+        self.counts = {'sent' : 0,
+                       'failed' : 0,
+                       'rejected' : 0,
+                       'in_flight' : 0,
+                       'retried' : 0,
+                       'dropped' : 0,
+                       'latency_total' : 0.0,
+                       'latency_max' : 0.0,
+                       'latency_last' : 0.0}
+
+    def _count(self, key, n = 1):
+        with self.lock:
+            self.counts[key] += n
+
+    def _health(self, ok):
+        'Record if a forward worked, and eject the destination if too many in a row have not.'
+        with self.lock:
+            if ok:
+                if self.ejected_until:
+                    logging.info('%s is working again.', self.url)
+                self.failures = 0
+                self.ejected_until = 0.0
+                return
+            self.failures += 1
+            if self.failures < EJECT_AFTER:
+                return
+            self.ejected_until = time.time() + EJECT_SECONDS
+        FORWARD_EJECTIONS.inc(1, (self.url,))
+        logging.warning('%s failed %d times in a row, leaving it out for %s seconds.',
+                        self.url, self.failures, EJECT_SECONDS)
+
+    def healthy(self):
+        'True unless the destination has been ejected.'
+        return time.time() >= self.ejected_until
+
+    def _wait_for_slot(self):
+        'Wait up to the timeout for a free in flight slot. True if one was taken.'
+        deadline = time.time() + self.timeout
+        while not self.slots.acquire(False):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def _post(self, data, path = '', headers = None):
+        'Post DATA with HEADERS to PATH on the destination and wait for the answer.'
+        labels = (self.url,)
+        if not self._wait_for_slot():
+            self._count('rejected')
+            FORWARD_FAILURES.inc(1, (self.url, 'busy'))
+            raise CouldNotForwardException(self.url)
+        self._count('in_flight')
+        start = time.time()
+        try:
+            response = self.session.post(self.url + path, data = data, headers = headers, timeout = self.timeout)
+        except requests.RequestException:
+            self._count('failed')
+            self._health(False)
+            FORWARD_FAILURES.inc(1, (self.url, 'connection'))
+            raise CouldNotForwardException(self.url)
+        finally:
+            self._count('in_flight', -1)
+            self.slots.release()
+        self._health(response.status_code < 500)
+        latency = time.time() - start
+        FORWARD_SECONDS.observe(latency, labels)
+        if not response.ok:
+            FORWARD_FAILURES.inc(1, (self.url, 'status'))
+        with self.lock:
+            if response.ok:
+                self.counts['sent'] += 1
+            else:
+                self.counts['failed'] += 1
+            self.counts['latency_total'] += latency
+            self.counts['latency_max'] = max(self.counts['latency_max'], latency)
+            self.counts['latency_last'] = latency
+        return response
+
+    def send(self, data, headers = None):
+        'Post DATA with HEADERS to the destination and wait for the answer.'
+        start = time.time()
+        try:
+            response = self._post(data, headers = headers)
+        except CouldNotForwardException:
+            if self.controller is not None:
+                self.controller.observe(self.url, time.time() - start, False)
+            raise
+        if self.controller is not None:
+            self.controller.observe(self.url, time.time() - start, response.status_code < 500)
+        FORWARD_BYTES.inc(len(data), (self.url,))
+        return response
+
+    ## A frame stream is posted chunked, one chunk per piece given, as
+    ## the pieces are made. It holds one in flight slot until it ends.
+    def send_stream(self, chunks, path = 'stream'):
+        'Post the pieces of data CHUNKS yields to PATH on the destination as one chunked request.'
+        sent = [0]
+        def counted():
+            for chunk in chunks:
+                sent[0] += len(chunk)
+                yield chunk
+        try:
+            return self._post(counted(), path)
+        finally:
+            FORWARD_BYTES.inc(sent[0], (self.url,))
+
+    def start(self, threads):
+        'Start THREADS sender threads for the queue.'
+        for n in range(threads):
+            worker = threading.Thread(target = self._run, name = 'Sender-%s-%d' % (self.url, n))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def close(self):
+        'Forward any queued frames, trying each only once, and stop the sender threads.'
+        self.closing = True
+        self.queue.close()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _drop(self, reason, n = 1):
+        self._count('dropped', n)
+        FORWARD_DROPPED.inc(n, (self.url, reason))
+
+    def enqueue(self, data, headers = None):
+        'Queue DATA and its HEADERS to be forwarded by a sender thread.'
+        try:
+            dropped = self.queue.put(data, self.timeout, headers)
+        except QueueFullException:
+            self._drop('full')
+            raise CouldNotForwardException(self.url)
+        if dropped:
+            self._drop('oldest', dropped)
+
+    def deliver(self, data, headers = None):
+        'Forward DATA with HEADERS, trying again after failures. True if the destination took it.'
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                if self.send(data, headers).status_code < 500:
+                    return True
+            except CouldNotForwardException:
+                pass
+            if attempt == self.retries or self.closing:
+                break
+            self._count('retried')
+            FORWARD_RETRIES.inc(1, (self.url,))
+            time.sleep(delay)
+            delay = min(2 * delay, MAX_BACKOFF)
+        self._drop('retries')
+        return False
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if not self.deliver(*item):
+                logging.error('Gave up forwarding a frame to %s.', self.url)
+
+    def stats(self):
+        'A dictionary of counters describing the frames forwarded to this destination.'
+        with self.lock:
+            stats = dict(self.counts)
+        finished = stats['sent'] + stats['failed']
+        stats['latency_mean'] = stats['latency_total'] / finished if finished else 0.0
+        stats['healthy'] = self.healthy()
+        stats.update(self.queue.stats())
+        if self.controller is not None:
+            stats.update(self.controller.stats(self.url))
+        return stats
+
+## Rules with several destinations spread frames over them with one of
+## these strategies:
+##  replicate    Every frame goes to every destination.
+##  round-robin  Frames go to each destination in turn.
+##  hash-source  All frames from a source go to the same destination.
+##  hash-time    All frames from the same HASH_TIME_SECONDS long stretch
+##               of time go to the same destination.
+## The hashed strategies use consistent hashing, so when a destination
+## is ejected only the frames that would have gone to it move, and they
+## move back once it recovers. Ejected destinations are left out unless
+## every destination of the rule has been ejected, in which case they
+## are all tried anyway.
+STRATEGIES = ('replicate', 'round-robin', 'hash-source', 'hash-time')
+HASH_TIME_SECONDS = 60
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+    'Consistent hashing of keys onto a set of URLs.'
+    REPLICAS = 64 # Points on the ring for each URL, which evens out the share each gets.
+    def __init__(self, urls):
+        points = sorted((_hash('%s#%d' % (url, n)), url) for url in urls for n in range(self.REPLICAS))
+        self.hashes = [point for point, _ in points]
+        self.urls = [url for _, url in points]
+        self.count = len(set(urls))
+
+    def walk(self, key):
+        'Every URL, starting with the one KEY belongs to and then in the order KEY falls back to them.'
+        start = bisect.bisect(self.hashes, _hash(key))
+        found = []
+        for i in xrange(len(self.urls)):
+            url = self.urls[(start + i) % len(self.urls)]
+            if url not in found:
+                found.append(url)
+                if len(found) == self.count:
+                    break
+        return found
+
+## The forwarder owns every destination. Frames from rules that don't
+## wait are put on their destination's queue, and the sender is
+## answered right away. A frame from a rule that waits is forwarded
+## while the sender waits. If the destination can't be reached or
+## answers with a server error, the frame is put on the queue to be
+## tried again later instead of being lost. The frame will still be
+## delivered, so the sender is told it was taken, and only told it
+## wasn't if the queue turns it away as well. When a frame goes to more than one destination, the
+## sender only waits on the first, and the copies for the rest are
+## queued. A frame only fails to be forwarded if every queue it should
+## go on turns it away, which depends on the overflow policy. Queued frames are spilled to a
+## directory of their own for each destination under SPILL_DIRECTORY,
+## if one is given. Every destination reports its forwards to the
+## CONTROLLER, if one is given.
+def _spill_name(url):
+    'A file name for the destination at URL.'
+    return re.sub('[^0-9A-Za-z]+', '_', url).strip('_')
+
+class Forwarder(object):
+    'Forwards frames to the destinations of routing rules.'
+    def __init__(self, threads = 4, max_in_flight = 4, timeout = 10.0, queue_size = 256, overflow = 'drop-newest',
+                 spill_directory = None, spill_size = 4096, retries = 5, backoff = 0.1, controller = None):
+        self.threads = threads
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.spill_directory = spill_directory
+        self.spill_size = spill_size
+        self.retries = retries
+        self.backoff = backoff
+        self.controller = controller
+        self.destinations = {}
+        self.rings = {}
+        self.turns = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        'Start sender threads for every destination, now and as they are added.'
+        with self.lock:
+            self.started = True
+            for destination in self.destinations.values():
+                destination.start(self.threads)
+        return self
+
+    def close(self):
+        'Send any queued frames and stop the sender threads.'
+        with self.lock:
+            self.started = False
+            destinations = self.destinations.values()
+        for destination in destinations:
+            destination.close()
+
+    def _make_destination(self, url):
+        spill_directory = None
+        if self.spill_directory:
+            spill_directory = os.path.join(self.spill_directory, str(os.getpid()), _spill_name(url))
+        queue = FrameQueue(self.queue_size, self.overflow, spill_directory, self.spill_size)
+        return Destination(url, self.max_in_flight, self.timeout, queue, self.retries, self.backoff, self.controller)
+
+    def destination(self, out, out_port):
+        'The destination frames for the OUT address and OUT_PORT are forwarded to.'
+        url = destination_url(out, out_port)
+        with self.lock:
+            try:
+                return self.destinations[url]
+            except KeyError:
+                destination = self.destinations[url] = self._make_destination(url)
+                if self.started:
+                    destination.start(self.threads)
+                return destination
+
+    def _ring(self, urls):
+        with self.lock:
+            ring = self.rings.get(urls)
+            if ring is None:
+                ring = self.rings[urls] = HashRing(urls)
+            return ring
+
+    def _turn(self, urls):
+        with self.lock:
+            turns = self.turns.get(urls)
+            if turns is None:
+                turns = self.turns[urls] = itertools.count()
+            return next(turns)
+
+    def choose(self, rule, source):
+        'The destinations a frame from SOURCE under RULE goes to, the one to wait on first.'
+        destinations = [self.destination(out, out_port) for out, out_port in rule.destinations]
+        healthy = [destination for destination in destinations if destination.healthy()] or destinations
+        if rule.strategy == 'replicate':
+            for destination in destinations:
+                if destination not in healthy:
+                    FORWARD_DROPPED.inc(1, (destination.url, 'ejected'))
+            return healthy
+        if len(healthy) == 1:
+            return healthy
+        urls = tuple(destination.url for destination in destinations)
+        if rule.strategy == 'round-robin':
+            return [healthy[self._turn(urls) % len(healthy)]]
+        if rule.strategy == 'hash-source':
+            key = str(source)
+        else:
+            key = str(int(time.time() // HASH_TIME_SECONDS))
+        by_url = dict((destination.url, destination) for destination in healthy)
+        for url in self._ring(urls).walk(key):
+            if url in by_url:
+                return [by_url[url]]
+        return healthy[:1]
+
+    def forward(self, rule, data, source = None, headers = None):
+        'Forward DATA from SOURCE with HEADERS to the destinations of RULE. Returns before they answer if the rule does not wait. True if the frame was taken by the destination the sender waits on, or queued to be.'
+        destinations = self.choose(rule, source)
+        if not rule.async_forward:
+            first, destinations = destinations[0], destinations[1:]
+        queued = 0
+        for destination in destinations:
+            try:
+                destination.enqueue(data, headers)
+                queued += 1
+            except CouldNotForwardException:
+                pass # Counted as dropped by the destination.
+        if rule.async_forward:
+            if not queued:
+                raise CouldNotForwardException(', '.join(destination.url for destination in destinations))
+            return True
+        try:
+            response = first.send(data, headers)
+        except CouldNotForwardException, e:
+            logging.warning('%s, queueing the frame to try again.', repr(e))
+            return self._requeue(first, data, headers)
+        if response.status_code >= 500:
+            logging.warning('%s answered %d, queueing the frame to try again.', first.url, response.status_code)
+            return self._requeue(first, data, headers)
+        return response.ok
+
+    @staticmethod
+    def _requeue(destination, data, headers):
+        'Queue DATA and its HEADERS for DESTINATION after it failed to take them. False if the queue turned them away.'
+        try:
+            destination.enqueue(data, headers)
+        except CouldNotForwardException:
+            return False # Counted as dropped by the destination.
+        return True
+
+    def queue_depths(self):
+        'A dictionary of the frames waiting in memory and on disk for each destination, keyed by (url, place) pairs.'
+        with self.lock:
+            destinations = dict(self.destinations)
+        depths = {}
+        for url, destination in destinations.items():
+            stats = destination.queue.stats()
+            depths[(url, 'memory')] = stats['queued_memory']
+            depths[(url, 'disk')] = stats['queued_disk']
+        return depths
+
+    def stats(self):
+        'A dictionary describing every destination and its queue.'
+        with self.lock:
+            destinations = dict(self.destinations)
+        stats = dict((url, destination.stats()) for url, destination in destinations.items())
+        return {'queue_depth' : sum(s['queued_memory'] + s['queued_disk'] for s in stats.values()),
+                'dropped' : sum(s['dropped'] for s in stats.values()),
+                'destinations' : stats}
@@ -0,0 +1,127 @@
+'Reads stored frames as NumPy arrays for offline analysis.'
+
+### Stored video frames are BMP files laid out the way the producer's
+### video_to_bmp writes them: a 54 byte header, then rows of blue,
+### green, and red bytes, bottom row first, each row padded to a
+### multiple of four bytes. Depth frames are rows of little endian 16
+### bit samples, top row first, with no header. The functions in this
+### module turn a stored frame into an array without copying it. The
+### frame's file, or the segment it's in, is mapped into memory, and
+### the array is a view of the mapping with its rows flipped and its
+### padding skipped by its strides. Compressed frames have to be
+### decoded first, so they're the only ones that are copied.
+### Batches of frames picked by a query on their records are read into
+### one array of shape (N, height, width, 3) for video, or (N, height,
+### width) for depth, which can be allocated once and reused.
+
+import os.path
+import mmap
+import struct
+
+import numpy
+
+from replay import FrameReader, session_frames
+
+class UnknownLayoutException(Exception):
+    'A frame is neither a BMP nor the size of a depth frame.'
+    def __init__(self, file_name, length):
+        self.file_name = file_name
+        self.length = length
+    def __repr__(self):
+        return 'Frame %s is not a BMP or a depth frame, it is %d bytes.' % (self.file_name, self.length)
+
+DEPTH_WIDTH = 640
+DEPTH_HEIGHT = 480
+
+## A BMP with a positive height is stored bottom row first. The
+## producer always writes them that way, but a negative height, for a
+## top row first BMP, is handled too.
+def layout(data):
+    'The (stream, offset, width, height, row size, pixel size, bottom up) of the frame DATA, or None if it is unknown.'
+    if data[:2] == 'BM' and len(data) >= 54:
+        offset, = struct.unpack_from('<I', data, 10)
+        width, height = struct.unpack_from('<ii', data, 18)
+        bits, = struct.unpack_from('<H', data, 28)
+        pixel_size = bits // 8
+        row_size = (bits * width + 31) // 32 * 4
+        if pixel_size >= 3 and offset + row_size * abs(height) <= len(data):
+            return 'video', offset, width, abs(height), row_size, pixel_size, height > 0
+    if len(data) == DEPTH_WIDTH * DEPTH_HEIGHT * 2:
+        return 'depth', 0, DEPTH_WIDTH, DEPTH_HEIGHT, DEPTH_WIDTH * 2, 2, False
+    return None
+
+## Every step below is a view. Splitting a row into pixels, reversing
+## the rows or the channels, and dropping padding or an alpha channel
+## only change the array's shape, strides, and starting point.
+def frame_view(data, file_name = None, rgb = False):
+    'A read only array of the frame DATA, top row first. Video is (height, width, 3) in blue, green, red order, or red, green, blue if RGB is set. Depth is (height, width).'
+    found = layout(data)
+    if found is None:
+        raise UnknownLayoutException(file_name, len(data))
+    stream, offset, width, height, row_size, pixel_size, bottom_up = found
+    if stream == 'depth':
+        return numpy.frombuffer(data, dtype = '<u2', count = width * height, offset = offset).reshape(height, width)
+    rows = numpy.frombuffer(data, dtype = numpy.uint8, count = row_size * height, offset = offset).reshape(height, row_size)
+    pixels = rows[:, :width * pixel_size].reshape(height, width, pixel_size)[:, :, :3]
+    if bottom_up:
+        pixels = pixels[::-1]
+    if rgb:
+        pixels = pixels[:, :, ::-1]
+    return pixels
+
+def map_file(path):
+    'A read only memory map of the whole file at PATH.'
+    with open(path, 'rb') as f_obj:
+        return mmap.mmap(f_obj.fileno(), 0, access = mmap.ACCESS_READ)
+
+## The record of a frame says where it's stored. A frame in its own file
+## gets a mapping of its own, and a frame in a segment is a view of the
+## segment's mapping, which is shared by every frame in it.
+class FrameArrays(object):
+    'Reads the stored frames in a save directory as arrays.'
+    def __init__(self, save_location, rgb = False):
+        self.save_location = save_location
+        self.rgb = rgb
+        self.reader = FrameReader(save_location)
+
+    def stored(self, frame):
+        'The bytes of the StoredFrame FRAME, mapped from disk if it was stored uncompressed.'
+        if frame.codec != 'raw':
+            return self.reader.read(frame)
+        if frame.location is None:
+            return map_file(os.path.join(self.save_location, frame.file_name))
+        return self.reader.segments.read(frame.file_name, frame.location)
+
+    def view(self, frame):
+        'The array of the StoredFrame FRAME. Only a compressed frame is copied.'
+        return frame_view(self.stored(frame), frame.file_name, self.rgb)
+
+    def frames(self, start = 0, end = None, origin_machine = None, stream = None):
+        'The StoredFrames received in [START, END), oldest first, from ORIGIN_MACHINE and of STREAM if they are not None.'
+        return [frame for frame in session_frames(self.save_location, start, end, origin_machine)
+                if stream is None or frame.stream == stream]
+
+    ## A batch is copied straight from the mappings into OUT, one frame
+    ## at a time, so it never takes more memory than OUT itself. Reading
+    ## the same number of frames again can reuse the same OUT.
+    def read_batch(self, frames, out = None):
+        'Read FRAMES into OUT, or into a new array of the right shape if OUT is None. Returns OUT.'
+        for n, frame in enumerate(frames):
+            view = self.view(frame)
+            if out is None:
+                out = numpy.empty((len(frames),) + view.shape, dtype = view.dtype)
+            out[n] = view
+        return out
+
+    def batches(self, frames, size = 64):
+        'Yield a (StoredFrames, array) pair for every SIZE frames of FRAMES, reusing the array for every full batch.'
+        out = None
+        for first in range(0, len(frames), size):
+            batch = frames[first:first + size]
+            if out is not None and len(batch) != len(out):
+                out = None
+            out = self.read_batch(batch, out)
+            yield batch, out
+
+    def close(self):
+        self.reader.close()
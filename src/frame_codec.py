@@ -0,0 +1,120 @@
+'Lossless codecs for stored frame images.'
+
+### Frames arrive as uncompressed images. Every codec in this module
+### is lossless, so a decoded frame is exactly the bytes the sender
+### sent. The codecs are:
+###  raw          The frame as it was sent.
+###  zlib         The frame compressed with deflate.
+###  zstd         The frame compressed with zstandard. Only available
+###               if the zstandard package is installed.
+###  depth-delta  For depth frames. The frame is stored as the
+###               difference between its 16 bit samples and the
+###               samples of an earlier key frame from the same sender,
+###               compressed with deflate. Depth changes little from
+###               frame to frame, so the differences are mostly zero.
+###               Decoding needs the key frame, which is stored with
+###               one of the other codecs.
+
+import zlib
+import array
+import sys
+
+## NumPy and zstandard are optional. Without NumPy the depth samples are
+## subtracted in a plain Python loop, which is slower but gives the
+## same result. Without zstandard the zstd codec is not offered.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class UnknownCodecException(Exception):
+    'A frame was stored with a codec this program does not know.'
+    def __init__(self, codec):
+        self.codec = codec
+    def __repr__(self):
+        return 'Unknown codec %s.' % (self.codec,)
+
+class MissingReferenceException(Exception):
+    'A frame needs a key frame to be decoded, but none was given.'
+    def __init__(self, codec):
+        self.codec = codec
+    def __repr__(self):
+        return 'The codec %s needs a key frame.' % (self.codec,)
+
+ZLIB_LEVEL = 1 # Fast. Higher levels barely shrink images more.
+ZSTD_LEVEL = 3
+
+def available_codecs():
+    'The names of every codec that can be used on this machine.'
+    codecs = ['raw', 'zlib', 'depth-delta']
+    if zstandard is not None:
+        codecs.append('zstd')
+    return codecs
+
+def needs_reference(codec):
+    'True if frames encoded with CODEC are encoded against a key frame.'
+    return codec == 'depth-delta'
+
+## Depth samples are little endian 16 bit integers. Subtracting and
+## adding them wraps around at 2 ** 16, so the difference of any two
+## frames can be undone exactly.
+def _samples(data):
+    samples = array.array('H')
+    samples.fromstring(str(data))
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples
+
+def _to_bytes(samples):
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples.tostring()
+
+def _combine16(a, b, sign):
+    'The 16 bit samples of A plus SIGN times the samples of B, wrapping around.'
+    if numpy is not None:
+        x = numpy.frombuffer(a, dtype = '<u2')
+        y = numpy.frombuffer(b, dtype = '<u2')
+        return (x + y if sign > 0 else x - y).astype('<u2').tostring()
+    x = _samples(a)
+    y = _samples(b)
+    for i in xrange(len(x)):
+        x[i] = (x[i] + sign * y[i]) & 0xffff
+    return _to_bytes(x)
+
+def can_delta(data, reference):
+    'True if DATA can be encoded as a depth delta of REFERENCE.'
+    return reference is not None and len(data) == len(reference) and len(data) % 2 == 0
+
+def encode(codec, data, reference = None):
+    'Encode the frame DATA with CODEC. REFERENCE is the key frame for codecs that need one.'
+    if codec == 'raw':
+        return data
+    elif codec == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level = ZSTD_LEVEL).compress(data)
+    elif codec == 'depth-delta':
+        if not can_delta(data, reference):
+            raise MissingReferenceException(codec)
+        return zlib.compress(_combine16(data, reference, -1), ZLIB_LEVEL)
+    raise UnknownCodecException(codec)
+
+def decode(codec, data, reference = None):
+    'Decode the frame DATA stored with CODEC. REFERENCE is the decoded key frame for codecs that need one.'
+    if codec == 'raw':
+        return data
+    elif codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'depth-delta':
+        if reference is None:
+            raise MissingReferenceException(codec)
+        return _combine16(zlib.decompress(data), reference, 1)
+    raise UnknownCodecException(codec)
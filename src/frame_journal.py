@@ -0,0 +1,318 @@
+'A write ahead journal that ties stored frame images to their records.'
+
+### A frame is stored in two steps; its image goes to disk, then its
+### record goes to the frame writer, which saves it with the next batch.
+### A crash between the two, or before the batch is committed, used to
+### leave an image nobody could find, or with fsync turned off, a record
+### pointing at an image the disk never got. The journal in this module
+### is a log every server process appends to as it stores frames. A
+### frame is begun before its image is written, its record is logged
+### once the image is stored, and it's marked committed once the writer
+### has saved the record. When the server starts, the journals left by
+### the last run are read back, and any frame that wasn't committed is
+### either finished or set aside. See recover for details.
+### Each line of a journal is a JSON object. A crash can cut the last
+### line short, so lines that don't parse are skipped.
+
+import os
+import os.path
+import json
+import zlib
+import threading
+import logging
+import time
+
+from util import fsync_path
+
+## How the images of frames are made durable before their records are
+## visible. Each frame syncs its image before its record is queued.
+## Each batch syncs the images of its frames before its records are
+## committed. Periodic syncs every image written in the last INTERVAL
+## seconds, which is the fastest, but lets a record be committed before
+## its image is on disk. Frames that weren't synced yet are checked
+## against their checksum when the server starts again.
+FSYNC_POLICIES = ('frame', 'batch', 'periodic')
+
+MAX_SIZE = 16 * 1024 * 1024 # Bytes in a journal before a new one is started.
+
+## Checksums are worked out as the image is read from the sender, so
+## checking a frame later never needs a second pass over the data when
+## it's stored.
+class ChecksumReader(object):
+    'Wraps a stream and keeps the CRC-32 and length of everything read from it.'
+    def __init__(self, stream):
+        self.stream = stream
+        self.checksum = 0
+        self.length = 0
+
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        self.checksum = zlib.crc32(data, self.checksum)
+        self.length += len(data)
+        return data
+
+def record_entry(frame):
+    'The journal entry for the stored FRAME.'
+    entry = {'name' : frame.file_name,
+             'origin' : frame.origin_machine,
+             'time' : frame.time,
+             'codec' : frame.codec,
+             'reference' : frame.reference,
+             'checksum' : frame.checksum,
+             'length' : frame.length,
+             'stream' : frame.stream,
+             'sensor_time' : frame.sensor_time}
+    if frame.location is not None:
+        entry['segment'] = [frame.location.segment, frame.location.offset, frame.location.length]
+    if frame.header is not None:
+        entry['header'] = [frame.header.stream, frame.header.width, frame.header.height,
+                           frame.header.pixel_size, frame.header.sensor_time, frame.header.length]
+    return entry
+
+## A journal file is only deleted once every frame logged in it, and in
+## every older file, is done with, since a frame begun in one file can
+## be stored and committed in the ones after it. The newest file is the
+## one appended to; full ones are kept alongside it until then.
+class JournalFile(object):
+    'One file of a journal, and the frames logged in it that are not committed yet.'
+    def __init__(self, path):
+        self.path = path
+        self.f_obj = open(path, 'ab')
+        self.pending = set()
+
+class FrameJournal(object):
+    'The write ahead journal of the frames one server process stores.'
+    def __init__(self, directory, store, policy = 'batch', interval = 1.0, max_size = MAX_SIZE):
+        'STORE is the frame store whose images are synced by the BATCH and PERIODIC policies.'
+        self.directory = directory
+        self.store = store
+        self.policy = policy
+        self.interval = interval
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.files = []
+        self.owners = {} # Frame name to the JournalFile it was logged in.
+        self.sequence = 0
+        self.unsynced = [] # (sequence, name, location) of frames logged since the last periodic sync.
+        self.syncing = [] # The same, for frames being synced right now.
+        self.committed_unsynced = set() # Frames committed before a periodic sync covered them.
+        self.id = '%s-%d' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        self.count = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._start_file()
+
+    def _start_file(self):
+        self.count += 1
+        path = os.path.join(self.directory, '%s-%d.wal' % (self.id, self.count))
+        self.files.append(JournalFile(path))
+        fsync_path(self.directory)
+
+    def _append(self, entry, sync = False):
+        'Append ENTRY to the current file. Must hold the lock. Returns the file.'
+        current = self.files[-1]
+        current.f_obj.write(json.dumps(entry) + '\n')
+        current.f_obj.flush()
+        if sync:
+            os.fsync(current.f_obj.fileno())
+        return current
+
+    def _settle(self):
+        'Delete the oldest files while all of their frames are done with, stopping at the current file. Must hold the lock.'
+        while len(self.files) > 1 and not self.files[0].pending:
+            journal_file = self.files.pop(0)
+            journal_file.f_obj.close()
+            os.remove(journal_file.path)
+
+    def start(self):
+        'Start syncing on a background thread if the policy is periodic.'
+        if self.policy == 'periodic':
+            self.thread = threading.Thread(target = self._run, name = 'FrameJournal')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def begin(self, file_name):
+        'Log that the image of the frame FILE_NAME is about to be written.'
+        with self.lock:
+            journal_file = self._append({'begin' : file_name})
+            journal_file.pending.add(file_name)
+            self.owners[file_name] = journal_file
+
+    def _release(self, names):
+        'Forget the frames NAMES, which need nothing more from the journal. Must hold the lock.'
+        for name in names:
+            journal_file = self.owners.pop(name, None)
+            if journal_file is not None:
+                journal_file.pending.discard(name)
+        self._settle()
+
+    def abort(self, file_name):
+        'Log that the image of the frame FILE_NAME was not stored, and whatever of it was written is gone.'
+        with self.lock:
+            self._append({'abort' : file_name})
+            self._release([file_name])
+
+    def stored(self, frame):
+        'Log the record of FRAME once its image is stored. Its record can be queued once this returns.'
+        with self.lock:
+            self.sequence += 1
+            entry = record_entry(frame)
+            entry['sequence'] = self.sequence
+            journal_file = self._append(entry, sync = self.policy == 'frame')
+            if frame.file_name not in self.owners:
+                journal_file.pending.add(frame.file_name)
+                self.owners[frame.file_name] = journal_file
+            if self.policy == 'periodic':
+                self.unsynced.append((self.sequence, frame.file_name, frame.location))
+            if journal_file.f_obj.tell() >= self.max_size:
+                self._start_file()
+
+    def before_commit(self, frames):
+        'Make the images of FRAMES durable, if the policy says it is done a batch at a time. Called before their records are committed.'
+        if self.policy != 'batch':
+            return
+        self.store.sync([(frame.file_name, frame.location) for frame in frames])
+        with self.lock:
+            for journal_file in self.files:
+                os.fsync(journal_file.f_obj.fileno())
+
+    ## With the frame and batch policies an image is always synced
+    ## before its record is committed, so a committed frame is done
+    ## with. With the periodic policy a frame is only done with once it
+    ## has been both committed and synced, whichever comes last.
+    def committed(self, frames):
+        'Log that the records of FRAMES were committed.'
+        names = [frame.file_name for frame in frames]
+        with self.lock:
+            self._append({'commit' : names, 'synced' : self.policy != 'periodic'})
+            if self.policy == 'periodic':
+                unsynced = set(name for _, name, _ in self.unsynced + self.syncing)
+                self.committed_unsynced.update(name for name in names if name in unsynced)
+                names = [name for name in names if name not in unsynced]
+            self._release(names)
+
+    def sync(self):
+        'Make every image logged so far durable, and log that it is.'
+        with self.lock:
+            unsynced, self.unsynced = self.unsynced, []
+            self.syncing = unsynced
+        if not unsynced:
+            return
+        try:
+            self.store.sync([(name, location) for _, name, location in unsynced])
+        except:
+            with self.lock:
+                self.unsynced[:0] = unsynced
+                self.syncing = []
+            raise
+        with self.lock:
+            self.syncing = []
+            self._append({'synced' : unsynced[-1][0]}, sync = True)
+            names = [name for _, name, _ in unsynced if name in self.committed_unsynced]
+            self.committed_unsynced.difference_update(names)
+            self._release(names)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sync()
+            except (IOError, OSError), e:
+                logging.error('Could not sync stored frames. %s', e)
+
+    def close(self):
+        'Stop syncing and close the journal. Files with frames that were never committed are left for recovery.'
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        if self.policy == 'periodic':
+            self.sync()
+        with self.lock:
+            done = not any(journal_file.pending for journal_file in self.files)
+            for journal_file in self.files:
+                journal_file.f_obj.close()
+                if done:
+                    os.remove(journal_file.path)
+            self.files = []
+
+## An entry handed back by recovery is a frame that was begun or stored
+## but can't be trusted to be whole. RECORD is its logged record, or
+## None if its image was never finished. A frame is trusted once its
+## record was committed and its image was synced, either before the
+## commit or by a periodic sync.
+class UnfinishedFrame(object):
+    'A frame from a journal that was not known to be safely stored.'
+    def __init__(self, name, record = None):
+        self.name = name
+        self.record = record
+
+def read_journal(path):
+    'The entries of the journal file at PATH that could be parsed.'
+    entries = []
+    with open(path, 'rb') as f_obj:
+        for line in f_obj:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.warning('Skipping a damaged line in journal %s.', path)
+    return entries
+
+## A frame can be begun in one file of a journal and stored or committed
+## in the next, so all the files of a journal are read together.
+def unfinished_frames(paths):
+    'The UnfinishedFrame of every frame in the journal made of the files at PATHS that is not trusted.'
+    begun = set()
+    records = {}
+    committed = set()
+    synced_commits = set()
+    synced = 0
+    for path in paths:
+        for entry in read_journal(path):
+            if 'begin' in entry:
+                begun.add(entry['begin'])
+            elif 'abort' in entry:
+                begun.discard(entry['abort'])
+            elif 'name' in entry:
+                records[entry['name']] = entry
+            elif 'commit' in entry:
+                committed.update(entry['commit'])
+                if entry.get('synced'):
+                    synced_commits.update(entry['commit'])
+            elif 'synced' in entry:
+                synced = max(synced, entry['synced'])
+    unfinished = [UnfinishedFrame(name) for name in begun if name not in records]
+    unfinished.extend(UnfinishedFrame(name, record) for name, record in records.items()
+                      if not (name in committed and (name in synced_commits or record['sequence'] <= synced)))
+    return unfinished
+
+def journals(directory):
+    'The paths of the files of every journal in DIRECTORY, grouped by journal, oldest first.'
+    if not os.path.isdir(directory):
+        return []
+    groups = {}
+    for name in os.listdir(directory):
+        if name.endswith('.wal'):
+            journal_id, count = name[:-len('.wal')].rsplit('-', 1)
+            groups.setdefault(journal_id, []).append((int(count), os.path.join(directory, name)))
+    return [[path for _, path in sorted(groups[journal_id])] for journal_id in sorted(groups)]
+
+## Recovery only reads the journals, never the whole store, so it takes
+## as long as the last run's unfinished frames, not as long as the
+## number of frames saved. FINISH is called with the list of
+## UnfinishedFrames of each journal and decides what happens to them.
+## A journal is only deleted once FINISH returns, so a crash during
+## recovery just means recovering again.
+def recover(directory, finish):
+    'Hand the unfinished frames of every journal in DIRECTORY to FINISH, then delete the journals. Returns the number of frames handled.'
+    handled = 0
+    for paths in journals(directory):
+        unfinished = unfinished_frames(paths)
+        if unfinished:
+            finish(unfinished)
+        handled += len(unfinished)
+        for path in paths:
+            os.remove(path)
+    return handled
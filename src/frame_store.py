@@ -0,0 +1,212 @@
+'Backends for storing frame images on disk.'
+
+### Frames used to always be saved one file per frame, named after the
+### frame's UUID, in a single directory. After a day of capture that is
+### millions of files in one directory. This module keeps that layout
+### as one backend and adds another that appends frames to large
+### segment files instead. With the segment backend, the database
+### records which segment each frame is in, where it starts, and how
+### long it is.
+### Both backends have the same three methods. The save method reads a
+### frame of a given stream, video or depth, from a file like object
+### and returns where it was put, the read method
+### takes a frame's name and location and returns its bytes, and the
+### sync method makes frames that were saved durable. A store made with
+### FSYNC set syncs every frame as it's saved instead.
+
+import os
+import os.path
+import mmap
+import threading
+import tempfile
+import shutil
+import time
+
+from util import *
+
+## Where a frame is inside a segment. The one file per frame backend
+## doesn't need a location, since the file name is the frame's name.
+class SegmentLocation(object):
+    'The segment, offset, and length of a stored frame.'
+    def __init__(self, segment, offset, length):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+class FileStore(object):
+    'Saves every frame in its own file named after the frame.'
+    def __init__(self, directory, fsync = False):
+        self.directory = directory
+        self.fsync = fsync
+
+    def save(self, stream, length, file_name, stream_type = 'video'):
+        'Save LENGTH bytes from STREAM as the frame FILE_NAME. LENGTH is None if unknown.'
+        write_stream_atomically(stream, os.path.join(self.directory, file_name), length, sync = self.fsync)
+        return None
+
+    def sync(self, frames):
+        'Sync the files of FRAMES, a list of (name, location) pairs, and their names to disk.'
+        if not frames:
+            return
+        for file_name, _ in frames:
+            fsync_path(os.path.join(self.directory, file_name))
+        fsync_path(self.directory)
+
+    def read(self, file_name, location = None):
+        'The bytes of the frame FILE_NAME.'
+        with open(os.path.join(self.directory, file_name), 'rb') as f_obj:
+            return f_obj.read()
+
+    def close(self):
+        pass
+
+## Segments are named after the time they were started, the id of the
+## process that started them, and the stream they hold, so several server processes can
+## share a directory without writing to the same segment. A new segment
+## is started when the current one would grow past MAX_SIZE bytes or
+## has been open for MAX_AGE seconds.
+## Appending is split in two so that a slow sender doesn't hold up
+## everyone else. First, space for the frame is reserved at the end of
+## the current segment while holding a lock. Then, the frame is written
+## into that space through its own file handle without the lock. If a
+## sender's length isn't known ahead of time, its frame is spooled to a
+## temporary file first so the size is known before space is reserved.
+## A frame that fails part way leaves a hole in its segment, but no
+## record points at the hole.
+## Every stream has a segment of its own being appended to, with its own
+## lock, so depth and video frames arriving together never wait on each
+## other, and each segment holds frames of just one stream.
+class SegmentLane(object):
+    'The segment the frames of one stream are appended to.'
+    def __init__(self, stream_type):
+        self.stream_type = stream_type
+        self.lock = threading.Lock()
+        self.segment = None
+        self.end = 0
+        self.started = 0
+
+class SegmentStore(object):
+    'Appends frames to large rolling segment files.'
+    SUFFIX = '.seg'
+    def __init__(self, directory, max_size = 1024 * 1024 * 1024, max_age = 3600.0, fsync = False):
+        self.directory = os.path.join(directory, 'segments')
+        self.fsync = fsync
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.lanes = {}
+        self.count = 0
+        self.maps = {}
+        self.maps_lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, segment):
+        'The path of the segment file named SEGMENT.'
+        return os.path.join(self.directory, segment + self.SUFFIX)
+
+    def _lane(self, stream_type):
+        with self.lock:
+            lane = self.lanes.get(stream_type)
+            if lane is None:
+                lane = self.lanes[stream_type] = SegmentLane(stream_type)
+            return lane
+
+    def _start_segment(self, lane):
+        'Start a new segment for LANE. Must hold the lock of LANE.'
+        with self.lock:
+            self.count += 1
+            count = self.count
+        lane.segment = '%s-%d-%d-%s' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid(), count, lane.stream_type)
+        lane.end = 0
+        lane.started = time.time()
+        os.close(os.open(self.path(lane.segment), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644))
+        if self.fsync:
+            fsync_path(self.directory)
+
+    def _reserve(self, length, stream_type):
+        'Reserve LENGTH bytes at the end of the current segment of STREAM_TYPE. Returns its location.'
+        lane = self._lane(stream_type)
+        with lane.lock:
+            if (lane.segment is None or
+                (lane.end and lane.end + length > self.max_size) or
+                time.time() - lane.started >= self.max_age):
+                self._start_segment(lane)
+            location = SegmentLocation(lane.segment, lane.end, length)
+            lane.end += length
+            return location
+
+    def save(self, stream, length, file_name, stream_type = 'video'):
+        'Append LENGTH bytes from STREAM to a segment of STREAM_TYPE frames as the frame FILE_NAME. LENGTH is None if unknown.'
+        if length is None:
+            with tempfile.TemporaryFile(dir = self.directory) as spool:
+                shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+                length = spool.tell()
+                spool.seek(0)
+                return self._append(spool, length, file_name, stream_type)
+        return self._append(stream, length, file_name, stream_type)
+
+    def _append(self, stream, length, file_name, stream_type):
+        location = self._reserve(length, stream_type)
+        fd = os.open(self.path(location.segment), os.O_WRONLY)
+        try:
+            os.lseek(fd, location.offset, os.SEEK_SET)
+            written = 0
+            while written < length:
+                chunk = stream.read(min(CHUNK_SIZE, length - written))
+                if not chunk:
+                    raise IncompleteWriteException(file_name, length, written)
+                write_fully(fd, chunk)
+                written += len(chunk)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        return location
+
+    def sync(self, frames):
+        'Sync the segments holding FRAMES, a list of (name, location) pairs, to disk.'
+        segments = set(location.segment for _, location in frames if location is not None)
+        for segment in segments:
+            fsync_path(self.path(segment))
+        if segments:
+            fsync_path(self.directory)
+
+    ## Readers map a whole segment into memory once and hand out views
+    ## of it, so reading a frame doesn't copy it. A segment that is
+    ## still being written to can grow past its map, in which case it's
+    ## mapped again.
+    def _map(self, segment, end):
+        with self.maps_lock:
+            segment_map = self.maps.get(segment)
+            if segment_map is None or len(segment_map) < end:
+                with open(self.path(segment), 'rb') as f_obj:
+                    segment_map = self.maps[segment] = mmap.mmap(f_obj.fileno(), 0, access = mmap.ACCESS_READ)
+            return segment_map
+
+    def read(self, file_name, location):
+        'A read only view of the bytes of the frame FILE_NAME at LOCATION.'
+        end = location.offset + location.length
+        return buffer(self._map(location.segment, end), location.offset, location.length)
+
+    def remove(self, segment, before):
+        'Delete the segment file SEGMENT if nothing has been written to it since BEFORE seconds since the epoch.'
+        path = self.path(segment)
+        try:
+            if os.path.getmtime(path) >= before:
+                return False
+        except OSError:
+            return False
+        ## The map isn't closed, since a frame in it could still be
+        ## being sent. It's unmapped when the last view of it is gone.
+        with self.maps_lock:
+            self.maps.pop(segment, None)
+        os.remove(path)
+        return True
+
+    def close(self):
+        'Unmap every mapped segment.'
+        with self.maps_lock:
+            for segment_map in self.maps.values():
+                segment_map.close()
+            self.maps = {}
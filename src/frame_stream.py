@@ -0,0 +1,124 @@
+'Reads and writes streams of frames sent over one connection.'
+
+### Sending every frame as its own HTTP request means sending a request
+### line, headers, and a BMP header with every frame, and waiting for
+### an answer before the next one. A frame stream is one long request
+### body holding any number of frames, one after another, each with a
+### small binary header in front of it. The header says which stream
+### the frame is from, how big it is, and when the sensor took it, so
+### video and depth frames can be sent over the same connection.
+### Video frames are sent without their BMP header, as rows of 3 byte
+### pixels with no padding. The database adds the header back, and
+### pads every row to a multiple of four bytes as BMP requires, before
+### storing them, so stored frames are the same no matter how they
+### arrived.
+###
+### Every header is HEADER.size bytes of little endian values:
+###  magic        2 bytes, always KF.
+###  stream       1 byte, 0 for video and 1 for depth.
+###  pixel size   1 byte, bytes per pixel.
+###  width        2 bytes, pixels per row.
+###  height       2 bytes, rows.
+###  sensor time  8 bytes, the timestamp the sensor gave the frame.
+###  length       4 bytes, bytes of pixel data that follow.
+
+import struct
+
+MAGIC = 'KF'
+HEADER = struct.Struct('<2sBBHHQI')
+STREAMS = ('video', 'depth')
+MAX_LENGTH = 64 * 1024 * 1024 # Far bigger than any Kinect frame.
+VIDEO_PIXEL_SIZE = 3 # Blue, green, and red bytes, the only layout a BMP header is made for.
+
+class BadFrameHeaderException(Exception):
+    'A frame stream held something that is not a valid frame header.'
+    def __init__(self, reason):
+        self.reason = reason
+    def __repr__(self):
+        return 'Bad frame header. %s' % (self.reason,)
+
+class TruncatedStreamException(Exception):
+    'A frame stream ended part way through a frame.'
+    def __init__(self, expected, received):
+        self.expected = expected
+        self.received = received
+    def __repr__(self):
+        return 'Expected %d more bytes of frame stream but only received %d.' % (self.expected, self.received)
+
+class FrameHeader(object):
+    'The header in front of every frame in a frame stream.'
+    def __init__(self, stream, width, height, pixel_size, sensor_time, length = None):
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.pixel_size = pixel_size
+        self.sensor_time = sensor_time
+        self.length = width * height * pixel_size if length is None else length
+
+    def pack(self):
+        'The bytes of this header.'
+        return HEADER.pack(MAGIC, STREAMS.index(self.stream), self.pixel_size,
+                           self.width, self.height, self.sensor_time, self.length)
+
+def unpack_header(data):
+    'The FrameHeader packed into DATA.'
+    magic, stream, pixel_size, width, height, sensor_time, length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise BadFrameHeaderException('The header does not start with %s.' % (MAGIC,))
+    if stream >= len(STREAMS):
+        raise BadFrameHeaderException('Unknown stream %d.' % (stream,))
+    if STREAMS[stream] == 'video' and pixel_size != VIDEO_PIXEL_SIZE:
+        raise BadFrameHeaderException('Video frames must have %d byte pixels, not %d.' % (VIDEO_PIXEL_SIZE, pixel_size))
+    if length != width * height * pixel_size or length > MAX_LENGTH:
+        raise BadFrameHeaderException('A %dx%d frame with %d byte pixels can not be %d bytes.' % (width, height, pixel_size, length))
+    return FrameHeader(STREAMS[stream], width, height, pixel_size, sensor_time, length)
+
+def read_exactly(stream, n):
+    'Read N bytes from STREAM. Returns an empty string if STREAM ended before any were read.'
+    chunks = []
+    received = 0
+    while received < n:
+        chunk = stream.read(n - received)
+        if not chunk:
+            if received:
+                raise TruncatedStreamException(n, received)
+            return ''
+        chunks.append(chunk)
+        received += len(chunk)
+    return ''.join(chunks)
+
+def read_frames(stream):
+    'Yield a (FrameHeader, pixel data) pair for every frame in STREAM until it ends.'
+    while True:
+        data = read_exactly(stream, HEADER.size)
+        if not data:
+            return
+        header = unpack_header(data)
+        pixels = read_exactly(stream, header.length)
+        if len(pixels) != header.length:
+            raise TruncatedStreamException(header.length, 0)
+        yield header, pixels
+
+def bmp_row_size(width):
+    'The bytes in each row of a 24 bit BMP WIDTH pixels wide, padding included.'
+    return (24 * width + 31) // 32 * 4
+
+## The image size is that of the padded rows. The producer writes the
+## unpadded size, which is the same for its 640 pixel wide frames.
+def bmp_header(width, height):
+    'The file and DIB headers the producer\'s video_to_bmp writes for a WIDTH by HEIGHT frame.'
+    pixel_array_size = bmp_row_size(width) * height
+    return struct.pack('<2sIHHI', 'BM', pixel_array_size + 54, 0, 0, 54) + \
+           struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0,
+                       pixel_array_size, 0, 0, 0, 0)
+
+def frame_image(header, pixels):
+    'The image stored for a frame with HEADER and PIXELS, the same as if it had been sent on its own.'
+    if header.stream != 'video':
+        return pixels
+    width = header.width * VIDEO_PIXEL_SIZE
+    padding = bmp_row_size(header.width) - width
+    if padding:
+        pixels = ''.join(pixels[start:start + width] + '\0' * padding
+                         for start in xrange(0, len(pixels), width))
+    return bmp_header(header.width, header.height) + pixels
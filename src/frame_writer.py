@@ -0,0 +1,182 @@
+'A background writer that saves frame meta data to the database in batches.'
+
+### Committing a transaction for every frame forces sqlite to sync
+### the disk for every frame. At thirty frames a second per sensor,
+### the number of syncs a disk can do in a second becomes the limit
+### on how fast frames can be saved. The writer in this module takes
+### records off of a queue and saves as many of them as it can in a
+### single transaction, so the cost of a sync is spread across a whole
+### batch of frames.
+
+import sqlite3
+import threading
+import logging
+import time
+import Queue
+
+from db_pool import connect
+from util import FRAME_LOG
+from frame_stream import STREAMS
+import metrics
+
+DB_INSERT_SECONDS = metrics.histogram('kinect_db_insert_seconds', 'Time taken to insert a batch of frame records.')
+DB_COMMIT_SECONDS = metrics.histogram('kinect_db_commit_seconds', 'Time taken to commit a batch of frame records.')
+DB_BATCH_SIZE = metrics.histogram('kinect_db_batch_size', 'Frame records saved per transaction.',
+                                  buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+DB_RECORDS = metrics.counter('kinect_db_records_total', 'Frame records saved to the database.')
+DB_ERRORS = metrics.counter('kinect_db_errors_total', 'Batches of frame records that could not be saved.')
+
+## The writer thread is told to stop by putting this object on the
+## queue. Anything put on the queue before it will still be saved.
+_STOP = object()
+
+## The FrameWriter is the only thing that writes frame records once the
+## server is running. Request handlers call put and return right away,
+## the writer thread does the actual inserts. A batch is written when
+## either BATCH_SIZE records are waiting or the oldest waiting record
+## has waited BATCH_LATENCY seconds, whichever comes first. The queue
+## is bounded so that a slow disk slows down the request handlers
+## instead of filling up memory.
+class FrameWriter(object):
+    'Saves frame records to the database in batches on a background thread.'
+    def __init__(self, db_path, batch_size = 64, batch_latency = 0.05, queue_size = 4096, route = None, journal = None):
+        'ROUTE, if given, is called with each record and returns the path of the database it is saved to instead of DB_PATH. JOURNAL, if given, is the FrameJournal told about every batch.'
+        self.db_path = db_path
+        self.route = route
+        self.journal = journal
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.queue = Queue.Queue(queue_size)
+        self.thread = None
+
+    def start(self):
+        'Start the writer thread.'
+        self.thread = threading.Thread(target = self._run, name = 'FrameWriter')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def put(self, frame):
+        'Queue a FrameMetaData record to be saved.'
+        self.queue.put(frame)
+
+    def flush(self):
+        'Block until every queued record has been committed.'
+        self.queue.join()
+
+    def close(self):
+        'Save any queued records and stop the writer thread.'
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def _next_batch(self):
+        'Wait for a record and collect a batch of records to write. The batch ends with _STOP if the writer should exit.'
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_latency
+        while batch[-1] is not _STOP and len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout = remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _write(self, db, frames):
+        'Save FRAMES to DB in a single transaction.'
+        if self.journal is not None:
+            self.journal.before_commit(frames)
+        try:
+            with DB_INSERT_SECONDS.time():
+                db.executemany('INSERT INTO frames values(?, ?, ?)',
+                               [(frame.file_name, frame.origin_machine, frame.time)
+                                for frame in frames])
+                db.executemany('INSERT INTO segment_frames values(?, ?, ?, ?)',
+                               [(frame.file_name,
+                                 frame.location.segment,
+                                 frame.location.offset,
+                                 frame.location.length)
+                                for frame in frames if frame.location is not None])
+                db.executemany('INSERT INTO frame_codecs values(?, ?, ?)',
+                               [(frame.file_name, frame.codec, frame.reference)
+                                for frame in frames if frame.codec != 'raw'])
+                db.executemany('INSERT INTO frame_sensors values(?, ?, ?, ?, ?)',
+                               [(frame.file_name,
+                                 frame.header.stream,
+                                 frame.header.sensor_time,
+                                 frame.header.width,
+                                 frame.header.height)
+                                for frame in frames if frame.header is not None])
+                for stream in STREAMS:
+                    db.executemany('INSERT INTO %s_frames values(?, ?, ?, ?)' % (stream,),
+                                   [(frame.file_name, frame.origin_machine, frame.time, frame.sensor_time)
+                                    for frame in frames if frame.stream == stream])
+            with DB_COMMIT_SECONDS.time():
+                db.commit()
+        except:
+            db.rollback()
+            raise
+        if self.journal is not None:
+            self.journal.committed(frames)
+        DB_BATCH_SIZE.observe(len(frames))
+        DB_RECORDS.inc(len(frames))
+        FRAME_LOG('Saved %d records to database.', len(frames))
+
+    ## With a partitioned database, the records of a batch can belong to
+    ## more than one database. They're grouped by database and each
+    ## group is saved in its own transaction. Connections are kept open
+    ## for the databases of the last batch only, so the writer lets go
+    ## of a partition once records stop going to it.
+    def _groups(self, frames):
+        'The (database path, records) pairs FRAMES are saved as.'
+        if self.route is None:
+            return [(self.db_path, frames)]
+        groups = {}
+        for frame in frames:
+            groups.setdefault(self.route(frame), []).append(frame)
+        return sorted(groups.items())
+
+    ## Recovery saves the records it repairs before the writer thread is
+    ## started, so it saves them straight away instead of queueing them.
+    def save(self, frames):
+        'Save FRAMES on the calling thread.'
+        for path, group in self._groups(frames):
+            db = connect(path)
+            try:
+                self._write(db, group)
+            finally:
+                db.close()
+
+    def _run(self):
+        connections = {}
+        try:
+            while True:
+                batch = self._next_batch()
+                frames = [frame for frame in batch if frame is not _STOP]
+                try:
+                    groups = self._groups(frames) if frames else []
+                    for path in set(connections) - set(path for path, _ in groups):
+                        connections.pop(path).close()
+                    for path, group in groups:
+                        try:
+                            if path not in connections:
+                                connections[path] = connect(path)
+                            self._write(connections[path], group)
+                        except (sqlite3.Error, IOError, OSError), e:
+                            DB_ERRORS.inc()
+                            logging.error('Could not save %d records to database. %s', len(group), e)
+                except (sqlite3.Error, OSError), e:
+                    DB_ERRORS.inc()
+                    logging.error('Could not find the database for %d records. %s', len(frames), e)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if len(frames) != len(batch):
+                    return
+        finally:
+            for db in connections.values():
+                db.close()
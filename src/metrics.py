@@ -0,0 +1,306 @@
+'Counters, gauges, and histograms served in the Prometheus text format.'
+
+### Logging a line for every frame is the only way to see what the
+### servers are doing, and at frame rate the logging is itself a cost.
+### This module keeps running counts and timings instead, which are
+### cheap to update and are only turned into text when the /metrics
+### URL is requested. The text follows the Prometheus exposition
+### format, so any Prometheus compatible scraper can collect it.
+### Metrics are made with the counter, gauge, and histogram functions,
+### which also register them so they show up in the output. Labels are
+### given as a tuple of values in the same order as the label names
+### the metric was made with.
+### With several worker processes, each keeps its own metrics, and a
+### scrape is answered by whichever worker the kernel hands it to. To
+### make every scrape see the whole server, each worker writes its
+### samples to a directory shared by the workers once a second, with a
+### worker label added, and the worker answering a scrape serves its
+### own samples together with everyone else's. See share for details.
+
+import os
+import os.path
+import bisect
+import json
+import threading
+import time
+import contextlib
+import logging
+
+from flask import g
+from flask import request
+
+class Registry(object):
+    'Every metric served by this process.'
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def samples(self, worker = None):
+        'A dictionary of the sample lines of every registered metric by name, labelled with WORKER if it is not None.'
+        with self.lock:
+            metrics = list(self.metrics)
+        return dict((metric.name, [_label_worker(line, worker) for line in metric.samples()])
+                    for metric in metrics)
+
+    def expose(self):
+        'The text of every registered metric, and the samples of the other workers if they are shared.'
+        with self.lock:
+            metrics = list(self.metrics)
+        samples = [self.samples(SHARED.worker if SHARED is not None else None)]
+        if SHARED is not None:
+            samples.extend(SHARED.others())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for worker_samples in samples:
+                lines.extend(worker_samples.get(metric.name, ()))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra = ()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs),)
+
+def _label_worker(line, worker):
+    'The sample LINE with a worker label of WORKER added, unless it is None.'
+    if worker is None:
+        return line
+    name, rest = line.split(' ', 1)
+    label = 'worker="%s"' % (worker,)
+    if name.endswith('}'):
+        return '%s{%s,%s %s' % (name[:name.index('{')], label, name[name.index('{') + 1:], rest)
+    return '%s{%s} %s' % (name, label, rest)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric(object):
+    kind = 'untyped'
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+class Counter(Metric):
+    'A count that only goes up.'
+    kind = 'counter'
+    def __init__(self, name, help, labels = ()):
+        Metric.__init__(self, name, help, labels)
+        if not self.labels:
+            self.values[()] = 0 # Show a zero instead of nothing.
+
+    def inc(self, amount = 1, labels = ()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, key), _format_value(value))
+                for key, value in values]
+
+## A gauge either has its value set, or has a function that is called
+## to read its value whenever the metrics are served. The function is
+## handy for values that something else already keeps, like the depth
+## of a queue.
+class Gauge(Metric):
+    'A value that can go up and down.'
+    kind = 'gauge'
+    def __init__(self, name, help, labels = (), function = None):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def set(self, value, labels = ()):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            values = sorted(self.function().items()) if self.labels else [((), self.function())]
+        else:
+            with self.lock:
+                values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, key), _format_value(value))
+                for key, value in values]
+
+## Histograms count observations into buckets by upper bound. Only the
+## count for the first bucket an observation fits in is increased. The
+## counts are added up into the cumulative form Prometheus expects when
+## they're served.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(Metric):
+    'Counts of observations in ranges of values.'
+    kind = 'histogram'
+    def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, labels = ()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * len(self.buckets), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, labels = ()):
+        'Observe how many seconds the body of a with statement takes.'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name,
+                                                 _format_labels(self.labels, key, [('le', _format_value(bound))]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, key), _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, key), cumulative))
+        return lines
+
+def counter(name, help, labels = ()):
+    'Make and register a counter.'
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, labels = (), function = None):
+    'Make and register a gauge.'
+    return REGISTRY.register(Gauge(name, help, labels, function))
+
+def histogram(name, help, labels = (), buckets = DEFAULT_BUCKETS):
+    'Make and register a histogram.'
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+## Each worker's samples are a JSON file named after its number, which
+## is written to a temporary name and renamed over the last one, so a
+## reader never sees half of one. A worker that dies leaves its last
+## samples behind until the worker that replaces it, with the same
+## number, writes its own. The files of every worker are cleared with
+## clear_shared before any are started.
+SHARED = None
+
+class SharedSamples(object):
+    'Writes the samples of this worker to DIRECTORY every INTERVAL seconds, and reads those of the others.'
+    def __init__(self, directory, worker, interval = 1.0):
+        self.directory = directory
+        self.worker = worker
+        self.interval = interval
+        self.path = os.path.join(directory, '%s.json' % (worker,))
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def write(self):
+        'Write the samples of this worker now.'
+        part = self.path + '.part'
+        with open(part, 'w') as f_obj:
+            json.dump(REGISTRY.samples(self.worker), f_obj)
+        os.rename(part, self.path)
+
+    def others(self):
+        'The sample dictionaries the other workers last wrote.'
+        samples = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.json') or path == self.path:
+                continue
+            try:
+                with open(path) as f_obj:
+                    samples.append(json.load(f_obj))
+            except (IOError, ValueError):
+                pass # It was being replaced.
+        return samples
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError), e:
+                logging.error('Could not share metrics. %s', e)
+
+    def start(self):
+        self.write()
+        self.thread = threading.Thread(target = self._run, name = 'SharedSamples')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def clear_shared(directory):
+    'Make DIRECTORY, and remove any samples left in it by workers of an earlier run. Called before the workers start.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.part'):
+            os.remove(os.path.join(directory, name))
+
+def share(directory, worker, interval = 1.0):
+    'Share the samples of the worker numbered WORKER with the other workers through DIRECTORY.'
+    global SHARED
+    SHARED = SharedSamples(directory, worker, interval).start()
+    return SHARED
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+## Every request to a server is counted and timed the same way, so the
+## request handling hooks are set up by one function. Requests are
+## labelled by the name of the handler that answered them rather than
+## the URL, so that URLs with a frame's name in them don't each get
+## their own label.
+REQUESTS = counter('kinect_http_requests_total', 'HTTP requests answered.', ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = histogram('kinect_http_request_duration_seconds', 'Time taken to answer HTTP requests.', ('endpoint',))
+REQUEST_BYTES = counter('kinect_http_request_bytes_total', 'Bytes received in HTTP request bodies.', ('endpoint',))
+RESPONSE_BYTES = counter('kinect_http_response_bytes_total', 'Bytes sent in HTTP response bodies of known length.', ('endpoint',))
+
+def instrument(app):
+    'Count and time every request answered by the Flask APP, and serve the metrics at /metrics.'
+    @app.before_request
+    def start_timer():
+        g._metrics_start = time.time()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'none'
+        labels = (endpoint,)
+        REQUEST_SECONDS.observe(time.time() - g._metrics_start, labels)
+        REQUESTS.inc(1, (endpoint, request.method, response.status_code))
+        if request.content_length:
+            REQUEST_BYTES.inc(request.content_length, labels)
+        if response.content_length:
+            RESPONSE_BYTES.inc(response.content_length, labels)
+        return response
+
+    @app.route('/metrics', methods = ('GET',))
+    def metrics():
+        'Every metric of this process in the Prometheus text format.'
+        return REGISTRY.expose(), 200, {'Content-Type' : CONTENT_TYPE}
@@ -0,0 +1,15 @@
+/* Older databases stored the time a frame was received as a 23
+   character string in a subset of ISO8601, in the server's local
+   time. This script rebuilds the frames table with the time as
+   milliseconds since the Unix epoch. The string column can't just
+   be updated in place, because a varchar column turns any integer
+   saved in it back into text.
+*/
+begin;
+alter table frames rename to frames_iso8601;
+create table frames(file_name varchar(36), origin_machine varchar(45), time integer);
+insert into frames
+  select file_name, origin_machine, cast(strftime('%s', time, 'utc') as integer) * 1000
+  from frames_iso8601;
+drop table frames_iso8601;
+commit;
@@ -0,0 +1,288 @@
+'Splits the frames database into one database file per hour or day.'
+
+### With a single database, the frames table and its indexes grow for
+### as long as the server keeps recording. Every insert has to find its
+### place in bigger trees, and a backup has to copy one huge file over
+### and over. This module keeps the records of the frames received in
+### each hour or day in their own database file instead. Frames are
+### written to the partition of the time they were received, and a new
+### partition is made the first time a frame falls into it. Queries for
+### a range of time only open the partitions that overlap it.
+### Once a period is over and every frame from it has had time to be
+### written, its partition is sealed. Sealing compacts the file with a
+### VACUUM, folds the write ahead log back into it, and takes away its
+### write permission. Sealed partitions are only ever opened read only.
+### Partitions older than the retention period are either deleted along
+### with their images, or compressed into an archive directory.
+
+import os
+import os.path
+import re
+import stat
+import time
+import calendar
+import gzip
+import shutil
+import threading
+import logging
+import sqlite3
+
+from db_pool import connect, ConnectionPool
+import metrics
+
+## The lock that keeps two workers from maintaining the partitions at
+## once is an advisory file lock, which only exists on Unix. Without it,
+## every worker does its own maintenance; sealing and expiring the same
+## partition twice is harmless, just wasted work.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+PERIODS = {'hour' : 3600, 'day' : 86400}
+_FORMATS = {'hour' : '%Y%m%d%H', 'day' : '%Y%m%d'}
+_NAME_RE = re.compile('^frames-(\\d{8}|\\d{10})\\.db$')
+
+PARTITIONS_SEALED = metrics.counter('kinect_partitions_sealed_total', 'Database partitions sealed.')
+PARTITIONS_EXPIRED = metrics.counter('kinect_partitions_expired_total', 'Database partitions past the retention period.', ('action',))
+
+## Partitions are named after the UTC time their period starts at, so
+## they sort in time order and the period of a partition can be told
+## from the length of its name.
+class Partition(object):
+    'The database file holding the frames received in one hour or day.'
+    def __init__(self, path, start, end):
+        self.path = path
+        self.start = start # Milliseconds since the epoch, included.
+        self.end = end     # Milliseconds since the epoch, not included.
+
+    def sealed(self):
+        'True if the partition has been sealed and must not be written to.'
+        try:
+            return not os.stat(self.path).st_mode & stat.S_IWUSR
+        except OSError:
+            return False
+
+def partition_name(start, period):
+    'The file name of the PERIOD long partition that starts at START milliseconds since the epoch.'
+    return 'frames-%s.db' % (time.strftime(_FORMATS[period], time.gmtime(start // 1000)),)
+
+def parse_partition(path):
+    'The Partition stored at PATH, or None if PATH is not named like a partition.'
+    match = _NAME_RE.match(os.path.basename(path))
+    if match is None:
+        return None
+    stamp = match.group(1)
+    period = 'day' if len(stamp) == 8 else 'hour'
+    start = calendar.timegm(time.strptime(stamp, _FORMATS[period])) * 1000
+    return Partition(path, start, start + PERIODS[period] * 1000)
+
+class PartitionSet(object):
+    'The partitions of the frames database kept in one directory.'
+    def __init__(self, directory, period = 'day', schema = '', legacy_path = None,
+                 pool_size = 8, row_factory = None, grace = 600.0):
+        'SCHEMA is run on every new partition. LEGACY_PATH is a database from before partitioning, searched before any partition.'
+        self.directory = os.path.join(directory, 'partitions')
+        self.period = period
+        self.period_ms = PERIODS[period] * 1000
+        self.schema = schema
+        self.legacy_path = legacy_path
+        self.pool_size = pool_size
+        self.row_factory = row_factory
+        self.grace = grace # Seconds after a period ends before its partition is sealed.
+        self.created = set()
+        self.pools = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def for_time(self, time_ms):
+        'The Partition frames received at TIME_MS milliseconds since the epoch belong in.'
+        start = time_ms - time_ms % self.period_ms
+        return Partition(os.path.join(self.directory, partition_name(start, self.period)),
+                         start, start + self.period_ms)
+
+    def partitions(self):
+        'Every partition in the directory, oldest first.'
+        found = [parse_partition(os.path.join(self.directory, name))
+                 for name in os.listdir(self.directory)]
+        return sorted((partition for partition in found if partition is not None),
+                      key = lambda partition: partition.start)
+
+    ## A record that reaches the writer after its partition has been
+    ## sealed goes into the partition of the time it's written instead.
+    ## The grace period before sealing is far shorter than a period, so
+    ## such a record is always in the partition right after its own.
+    def writable_path(self, time_ms):
+        'The path of the partition a record of a frame received at TIME_MS is written to, made if needed.'
+        partition = self.for_time(time_ms)
+        if partition.sealed():
+            partition = self.for_time(int(time.time() * 1000))
+        self._create(partition.path)
+        return partition.path
+
+    def _create(self, path):
+        with self.lock:
+            if path in self.created:
+                return
+        if not os.path.exists(path):
+            logging.info('Starting database partition %s.', path)
+        db = connect(path)
+        try:
+            db.executescript(self.schema)
+            db.commit()
+        finally:
+            db.close()
+        with self.lock:
+            self.created.add(path)
+
+    def between(self, start, end = None):
+        'The paths of every database that could hold frames received in [START, END), oldest first.'
+        partitions = self.partitions()
+        paths = [partition.path for partition in partitions
+                 if partition.end > start and (end is None or partition.start < end)]
+        ## Late records are in the partition after their own.
+        if end is not None:
+            paths.extend([partition.path for partition in partitions if partition.start >= end][:1])
+        if self.legacy_path is not None and os.path.exists(self.legacy_path):
+            paths.insert(0, self.legacy_path)
+        return paths
+
+    def pool(self, path):
+        'The connection pool of the database at PATH. Sealed partitions are opened read only.'
+        readonly = path != self.legacy_path and parse_partition(path).sealed()
+        with self.lock:
+            pool = self.pools.get(path)
+            if pool is not None and pool.readonly == readonly:
+                return pool
+            self.pools[path] = ConnectionPool(path,
+                                              max_size = self.pool_size,
+                                              row_factory = self.row_factory,
+                                              readonly = readonly)
+        ## Connections still borrowed from the old pool are closed when
+        ## they're released and the pool is garbage collected.
+        if pool is not None:
+            pool.close()
+        return self.pools[path]
+
+    def _drop_pool(self, path):
+        with self.lock:
+            pool = self.pools.pop(path, None)
+            self.created.discard(path)
+        if pool is not None:
+            pool.close()
+
+    ## Going back to a rollback journal folds the write ahead log into
+    ## the file and removes the log files. A read only file still in
+    ## WAL mode can't be opened by readers, who need to write its shared
+    ## memory file, so the write permission is only taken away once the
+    ## journal mode has changed. That only works if no other process
+    ## has the file open; otherwise the partition is left as it is and
+    ## sealed on a later check.
+    def seal(self, partition):
+        'Compact PARTITION and make it read only. Returns False if it could not be sealed yet.'
+        logging.info('Sealing database partition %s.', partition.path)
+        self._drop_pool(partition.path)
+        db = connect(partition.path)
+        try:
+            db.execute('VACUUM')
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            try:
+                journal_mode = db.execute('PRAGMA journal_mode=DELETE').fetchone()[0]
+            except sqlite3.OperationalError:
+                journal_mode = None
+        finally:
+            db.close()
+        if journal_mode is None or journal_mode.lower() != 'delete':
+            logging.warning('Database partition %s is still in use, sealing it later.', partition.path)
+            return False
+        mode = os.stat(partition.path).st_mode
+        os.chmod(partition.path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        PARTITIONS_SEALED.inc()
+        return True
+
+    def expire(self, partition, archive = None):
+        'Remove PARTITION, after compressing it into the directory ARCHIVE if given.'
+        self._drop_pool(partition.path)
+        if archive is not None:
+            if not os.path.isdir(archive):
+                os.makedirs(archive)
+            target = os.path.join(archive, os.path.basename(partition.path) + '.gz')
+            logging.info('Archiving database partition %s to %s.', partition.path, target)
+            with open(partition.path, 'rb') as source:
+                with gzip.open(target + '.part', 'wb') as destination:
+                    shutil.copyfileobj(source, destination)
+            os.rename(target + '.part', target)
+        else:
+            logging.info('Deleting database partition %s.', partition.path)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(partition.path + suffix)
+            except OSError:
+                pass
+        PARTITIONS_EXPIRED.inc(1, ('archived' if archive is not None else 'deleted',))
+
+    def close(self):
+        'Close every idle connection to every partition.'
+        with self.lock:
+            pools = self.pools.values()
+            self.pools = {}
+        for pool in pools:
+            pool.close()
+
+## Maintenance runs on a background thread of every worker, but only the
+## worker holding the lock file does any work at a time. Sealing and
+## expiring only ever touch partitions of periods that are over, so they
+## never hold up frames being saved to the current one.
+class PartitionMaintainer(object):
+    'Seals finished partitions and expires old ones on a background thread.'
+    def __init__(self, partitions, retention = None, archive = None, on_expire = None, interval = 60.0):
+        'RETENTION is in seconds, or None to keep partitions forever. ON_EXPIRE is given each partition about to be deleted.'
+        self.partitions = partitions
+        self.retention = retention
+        self.archive = archive
+        self.on_expire = on_expire
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        'Start maintaining the partitions.'
+        self.thread = threading.Thread(target = self._run, name = 'PartitionMaintainer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        'Stop maintaining the partitions.'
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def check(self, now = None):
+        'Seal and expire whatever partitions are due.'
+        now = int((time.time() if now is None else now) * 1000)
+        lock = open(os.path.join(self.partitions.directory, '.maintenance'), 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return # Another worker is at it.
+            for partition in self.partitions.partitions():
+                if self.retention is not None and partition.end <= now - self.retention * 1000:
+                    if self.archive is None and self.on_expire is not None:
+                        self.on_expire(partition)
+                    self.partitions.expire(partition, self.archive)
+                elif partition.end + self.partitions.grace * 1000 <= now and not partition.sealed():
+                    self.partitions.seal(partition)
+        finally:
+            lock.close()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except (OSError, IOError, sqlite3.Error), e:
+                logging.error('Could not maintain database partitions. %s', e)
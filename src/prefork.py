@@ -0,0 +1,152 @@
+'Serves a Flask app from several forked worker processes.'
+
+### Flask's own server runs in one process, and only one thread of a
+### Python process runs Python code at a time, so one server can only
+### ever use one core. The server in this module opens the listening
+### socket once, then forks worker processes that each accept
+### connections from that socket with a threaded WSGI server. The
+### kernel hands each new connection to one of the workers. The parent
+### process does nothing but watch its workers, start a new one if one
+### dies, and stop them all when it's told to stop.
+### Anything made before the workers are forked is copied into every
+### worker, so whatever state has to be shared between workers must be
+### made in shared memory before serving starts. Threads don't survive a
+### fork, so anything that starts threads is done by the ON_START
+### function, which runs in every worker after it's forked.
+### Signals meant for the server as a whole, like the SIGUSR2 that
+### toggles the profiler, are sent to the parent, which passes them on
+### to every worker.
+
+import os
+import sys
+import socket
+import signal
+import errno
+import atexit
+import logging
+import time
+
+from werkzeug.serving import make_server
+
+def listen(host, port, backlog = 128):
+    'A socket listening on HOST and PORT.'
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+## The number of the worker this process is, from zero, or None in the
+## parent or when there's only one process. A worker that dies is
+## replaced by one with the same number.
+WORKER = None
+
+## Signals the parent passes on to its workers. A worker ignores them
+## until its ON_START function sets up handlers of its own.
+RELAYED_SIGNALS = (signal.SIGUSR2,)
+
+def _exit_normally(signum, frame):
+    sys.exit(0)
+
+class PreforkServer(object):
+    'Runs a WSGI app on a fixed number of forked worker processes.'
+    RESTART_DELAY = 1.0 # Seconds to wait before replacing a worker, so one that dies on start doesn't spin.
+
+    def __init__(self, app, host, port, workers, on_start = None, backlog = 128):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.on_start = on_start
+        self.backlog = backlog
+        self.children = {}
+        self.stopping = False
+        self.socket = None
+
+    def serve(self):
+        'Start the workers and keep them running until a SIGTERM or SIGINT.'
+        self.socket = listen(self.host, self.port, self.backlog)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for signum in RELAYED_SIGNALS:
+            signal.signal(signum, self._relay)
+        for n in range(self.workers):
+            self._spawn(n)
+        logging.info('Serving on %s port %d with %d workers.', self.host, self.port, self.workers)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            n = self.children.pop(pid, None)
+            if n is None or self.stopping:
+                continue
+            logging.error('Worker %d (process %d) exited with status %d, starting another.', n, pid, status)
+            time.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self._spawn(n)
+        self.socket.close()
+
+    def _stop(self, signum, frame):
+        'Tell every worker to finish up.'
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _relay(self, signum, frame):
+        'Pass the signal SIGNUM on to every worker.'
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _spawn(self, n):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = n
+            return
+        ## In the worker. It must never return into the parent's loop,
+        ## so it leaves with os._exit after running the exit handlers
+        ## itself.
+        global WORKER
+        WORKER = n
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, _exit_normally)
+            signal.signal(signal.SIGINT, _exit_normally)
+            for signum in RELAYED_SIGNALS:
+                signal.signal(signum, signal.SIG_IGN)
+            if self.on_start is not None:
+                self.on_start()
+            server = make_server(self.host, self.port, self.app,
+                                 threaded = True,
+                                 fd = self.socket.fileno())
+            server.serve_forever()
+        except SystemExit, e:
+            status = e.code or 0
+        except BaseException:
+            logging.exception('Worker %d failed.', n)
+            status = 1
+        try:
+            atexit._run_exitfuncs()
+        finally:
+            os._exit(status)
+
+def serve(app, host, port, workers = 1, on_start = None):
+    'Serve APP on HOST and PORT. With more than one worker, use a pre-forking server. ON_START runs in every process that serves requests.'
+    if workers > 1:
+        PreforkServer(app, host, port, workers, on_start).serve()
+        return
+    ## The kill script sends a SIGTERM, which would skip the exit
+    ## handlers unless it's turned into a normal exit.
+    signal.signal(signal.SIGTERM, _exit_normally)
+    if on_start is not None:
+        on_start()
+    app.run(host = host, port = port, threaded = True)
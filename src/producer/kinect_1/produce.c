@@ -56,10 +56,55 @@ void signal_cb(int signal) {
 }
 
 /*
-An empty callback that ignores any depth information provided.
+Sends SIZE bytes read from FRAME over the network. The X-Stream header
+tells the server whether the frame is video or depth, and the
+X-Sensor-Time header gives the timestamp the Kinect gave the frame,
+so the server can pair up depth and video frames taken together.
+*/
+void send_frame(FILE * frame, size_t size, const char * stream, uint32_t timestamp) {
+  CURL * curl = curl_easy_init();
+  curl_easy_setopt(curl, CURLOPT_URL, ADDR);
+  curl_easy_setopt(curl, CURLOPT_PORT, PORT);
+  curl_easy_setopt(curl, CURLOPT_UPLOAD, 1L);
+
+  char stream_header[32];
+  char time_header[32];
+  snprintf(stream_header, sizeof(stream_header), "X-Stream: %s", stream);
+  snprintf(time_header, sizeof(time_header), "X-Sensor-Time: %" PRIu32, timestamp);
+  struct curl_slist * headers = NULL;
+  headers = curl_slist_append(headers, stream_header);
+  headers = curl_slist_append(headers, time_header);
+  curl_easy_setopt(curl, CURLOPT_HTTPHEADER, headers);
+
+  curl_easy_setopt(curl, CURLOPT_READDATA, frame);
+  curl_easy_setopt(curl, CURLOPT_INFILESIZE_LARGE, (curl_off_t) size);
+  CURLcode result = curl_easy_perform(curl);
+  if (result == CURLE_COULDNT_CONNECT) {
+    syslog(LOG_ERR, "Failure: Could not connect to %s:%d\n", ADDR, PORT);
+  } else if (result != CURLE_OK) {
+    syslog(LOG_ERR, "Failure: %s\n", curl_easy_strerror(result));
+  } else {
+    double speed;
+    double time;
+    curl_easy_getinfo(curl, CURLINFO_SPEED_UPLOAD, &speed);
+    curl_easy_getinfo(curl, CURLINFO_TOTAL_TIME, &time);
+    printf("Speed: %.3f bytes per second during %.3f seconds.\n", speed, time);
+  }
+
+  curl_slist_free_all(headers);
+  curl_easy_cleanup(curl);
+}
+
+/*
+A callback that sends raw depth data over the network. Depth frames
+are 640 by 480 little endian 16 bit samples, top row first, and are
+sent as they are, with no header.
 */
 void depth_cb(freenect_device * dev, void * depth, uint32_t timestamp) {
-  //write(1, (uint8_t *) depth, depth_size);
+  FILE * frame = fmemopen(depth, depth_size, "rb");
+  if (frame == NULL) exit(errno);
+  send_frame(frame, depth_size, "depth", timestamp);
+  fclose(frame);
 }
 
 /*
@@ -157,33 +202,10 @@ A callback that takes raw sensor data, converts it into a BMP, and
 sends it over the network.
 */
 void video_cb(freenect_device * dev, void * video, uint32_t timestamp) {
-  CURL * curl = curl_easy_init();
-  curl_easy_setopt(curl, CURLOPT_URL, ADDR);
-  curl_easy_setopt(curl, CURLOPT_PORT, PORT);
-  curl_easy_setopt(curl, CURLOPT_UPLOAD, 1L);
-
   size_t size = 0;
-  
   FILE * bmp = video_to_bmp(video, &size);
-
-  curl_easy_setopt(curl, CURLOPT_READDATA, bmp);
-  curl_easy_setopt(curl, CURLOPT_INFILESIZE_LARGE, size);
-  CURLcode result = curl_easy_perform(curl);
-  if (result == CURLE_COULDNT_CONNECT) {
-    syslog(LOG_ERR, "Failure: Could not connect to %s:%d\n", ADDR, PORT);
-    return;
-  } else if (result != CURLE_OK) {
-    syslog(LOG_ERR, "Failure: %s\n", curl_easy_strerror(result));
-  }
-
-  double speed;
-  double time;
-  curl_easy_getinfo(curl, CURLINFO_SPEED_UPLOAD, &speed);
-  curl_easy_getinfo(curl, CURLINFO_TOTAL_TIME, &time);
-  printf("Speed: %.3f bytes per second during %.3f seconds.\n", speed, time);
-
+  send_frame(bmp, size, "video", timestamp);
   fclose(bmp);
-  curl_easy_cleanup(curl);
 }
 
 
@@ -233,6 +255,10 @@ int main(int argc, char **argv) {
 				freenect_find_video_mode(FREENECT_RESOLUTION_MEDIUM, FREENECT_VIDEO_RGB));
   if (ret < 0) return ret;
   printf("Video Mode Set\n");
+  ret = freenect_set_depth_mode(sensor,
+				freenect_find_depth_mode(FREENECT_RESOLUTION_MEDIUM, FREENECT_DEPTH_11BIT));
+  if (ret < 0) return ret;
+  printf("Depth Mode Set\n");
   freenect_set_depth_callback(sensor, depth_cb);
   freenect_set_video_callback(sensor, video_cb);
 
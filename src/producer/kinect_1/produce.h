@@ -2,6 +2,7 @@
 #include <inttypes.h>
 #include "libfreenect.h"
 
+void send_frame(FILE * frame, size_t size, const char * stream, uint32_t timestamp);
 void depth_cb(freenect_device * dev, void * depth, uint32_t timestamp);
 void video_cb(freenect_device * dev, void * video, uint32_t timestamp);
 void signal_cb(int signal);
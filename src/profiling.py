@@ -0,0 +1,341 @@
+'Per-request trace spans and a sampling profiler for the servers.'
+
+### The metrics say how long requests take, but not where the time
+### goes. This module has two ways to find out on a running server.
+### Trace mode times the stages of one of every so many requests. Code
+### marks a stage with a span, and spans can be nested. A request that
+### isn't traced pays for one attribute lookup per span. The sampling
+### profiler is a thread that looks at the stack of every other thread
+### many times a second, so it sees the writer and sender threads as
+### well as the request handlers. Both are turned on and off while the
+### server runs, through URLs under /debug or a SIGUSR2, and both give
+### their results in the folded stack format, one line for each stack
+### with its frames separated by semicolons and followed by its weight,
+### which flamegraph.pl, speedscope, and most other flame graph tools
+### load.
+
+import sys
+import os
+import os.path
+import re
+import time
+import itertools
+import collections
+import threading
+import signal
+import logging
+
+from flask import request
+from flask import jsonify
+from flask import Response
+from flask import abort
+
+## Spans are kept on the thread handling the request. Each open span is
+## a [name, start, time spent in its children] list. When a span ends,
+## its own time, less its children's, is added under its whole stack,
+## so a stage is never counted twice in a flame graph.
+_LOCAL = threading.local()
+
+class _Span(object):
+    'Times the stage NAME of the traced request on this thread.'
+    __slots__ = ('trace', 'name')
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+    def __enter__(self):
+        self.trace.open(self.name)
+    def __exit__(self, *exc_info):
+        self.trace.close()
+
+class _NoSpan(object):
+    'Stands in for a span when the request is not traced.'
+    __slots__ = ()
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+def span(name):
+    'A context manager that times the stage NAME if the current request is traced.'
+    trace = getattr(_LOCAL, 'trace', None)
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name)
+
+class Trace(object):
+    'The spans of one request.'
+    def __init__(self, name):
+        self.start = time.time()
+        self.open_spans = []
+        self.spans = [] # (stack, offset, duration, own time) of every span that ended, in seconds.
+        self.open(name)
+
+    def open(self, name):
+        self.open_spans.append([name, time.time(), 0.0])
+
+    def close(self):
+        name, start, children = self.open_spans.pop()
+        duration = time.time() - start
+        stack = ';'.join([entry[0] for entry in self.open_spans] + [name])
+        self.spans.append((stack, start - self.start, duration, duration - children))
+        if self.open_spans:
+            self.open_spans[-1][2] += duration
+
+    def finish(self):
+        'End every span still open, the request itself last.'
+        while self.open_spans:
+            self.close()
+
+    def describe(self):
+        'The spans as a list of dictionaries, in milliseconds, in the order they started.'
+        return [{'stage' : stack,
+                 'start_ms' : round(offset * 1000, 3),
+                 'ms' : round(duration * 1000, 3)}
+                for stack, offset, duration, _ in sorted(self.spans, key = lambda entry: entry[1])]
+
+## One of every SAMPLE requests is traced, and none are if SAMPLE is
+## zero. The own time of every span is added up by stack, in
+## microseconds, and the last few traces are kept whole.
+class Tracer(object):
+    'Traces sampled requests and adds up the time spent in each stage.'
+    KEEP = 100 # Whole traces kept.
+    def __init__(self, sample = 0):
+        self.sample = sample
+        self.counter = itertools.count()
+        self.stacks = collections.defaultdict(int)
+        self.recent = collections.deque(maxlen = self.KEEP)
+        self.lock = threading.Lock()
+
+    def begin(self, name):
+        'Start tracing the request NAME on this thread if it is sampled.'
+        sample = self.sample
+        if sample > 0 and next(self.counter) % sample == 0:
+            _LOCAL.trace = Trace(name)
+        else:
+            _LOCAL.trace = None
+
+    def end(self):
+        'Stop tracing the request on this thread.'
+        trace = getattr(_LOCAL, 'trace', None)
+        if trace is None:
+            return
+        _LOCAL.trace = None
+        trace.finish()
+        with self.lock:
+            for stack, _, _, own in trace.spans:
+                self.stacks[stack] += int(own * 1000000)
+            self.recent.append(trace)
+
+    def folded(self):
+        'The time spent in every stack of spans, in the folded stack format.'
+        with self.lock:
+            return ''.join('%s %d\n' % (stack, weight) for stack, weight in sorted(self.stacks.items()))
+
+    def reset(self, sample):
+        'Trace one of every SAMPLE requests from now on, and forget what was traced so far.'
+        with self.lock:
+            self.sample = sample
+            self.stacks.clear()
+            self.recent.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'pid' : os.getpid(),
+                    'sample' : self.sample,
+                    'traces' : [trace.describe() for trace in self.recent]}
+
+## Threads are named after what they do, with a number on the end for
+## each one of a kind. The number is dropped, so that every request
+## thread, for instance, is one root of the flame graph.
+def _thread_name(name):
+    return re.sub('-?[0-9]+$', '', name) or name
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class SamplingProfiler(object):
+    'Counts the stacks of every thread of this process every INTERVAL seconds.'
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.stacks = collections.defaultdict(int)
+        self.samples = 0
+        self.started = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        'Start sampling, forgetting any earlier samples.'
+        with self.lock:
+            if self.thread is not None:
+                return self
+            self.stacks.clear()
+            self.samples = 0
+            self.started = time.time()
+            self.stopped.clear()
+            self.thread = threading.Thread(target = self._run, name = 'SamplingProfiler')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        'Stop sampling. The samples are kept until the next start.'
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopped.set()
+            thread.join()
+
+    def _run(self):
+        own = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            names = dict((thread.ident, _thread_name(thread.name)) for thread in threading.enumerate())
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_frame_name(frame))
+                    frame = frame.f_back
+                frames.append(names.get(ident, 'unknown'))
+                stacks.append(';'.join(reversed(frames)))
+            with self.lock:
+                self.samples += 1
+                for stack in stacks:
+                    self.stacks[stack] += 1
+
+    def folded(self):
+        'The samples of every stack in the folded stack format.'
+        with self.lock:
+            return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def stats(self):
+        with self.lock:
+            return {'pid' : os.getpid(),
+                    'running' : self.thread is not None,
+                    'interval' : self.interval,
+                    'samples' : self.samples,
+                    'started' : self.started}
+
+## Everything is set up by configure, in every process that serves
+## requests, since the profiler's thread doesn't survive a fork. Until
+## then, nothing is traced and the /debug URLs aren't found. Profiles
+## are saved in DIRECTORY, named after the process, the time they were
+## stopped, and how many it saved before, so the workers of one server
+## don't overwrite each other's.
+TRACER = Tracer()
+PROFILER = None
+DIRECTORY = None
+_SAVED = itertools.count(1)
+
+def save_profile():
+    'Stop the profiler and save its samples. Returns the path they were saved to, or None if there is no directory to save them in.'
+    PROFILER.stop()
+    if DIRECTORY is None:
+        logging.info('Stopped the sampling profiler after %d samples. They can be read from /debug/profile.', PROFILER.samples)
+        return None
+    if not os.path.isdir(DIRECTORY):
+        os.makedirs(DIRECTORY)
+    path = os.path.join(DIRECTORY, '%d-%s-%d.folded' % (os.getpid(), time.strftime('%Y%m%dT%H%M%S'), next(_SAVED)))
+    with open(path, 'w') as f_obj:
+        f_obj.write(PROFILER.folded())
+    logging.info('Saved a profile of %d samples to %s.', PROFILER.samples, path)
+    return path
+
+## A SIGUSR2 starts the profiler if it's stopped, and stops it and saves
+## the profile if it's running. Joining the profiler's thread and
+## writing the file are done on a thread of their own, so the signal
+## handler returns right away. The handler is always installed, since
+## the signal's default action would kill the server; without a
+## directory, the samples are only kept for /debug/profile. With
+## several workers, the signal is sent to the parent process, which
+## passes it on to every worker. See prefork.py.
+## Two signals in quick succession start two threads, so the lock keeps
+## the second from seeing the profiler stopped before the first starts it.
+_TOGGLE_LOCK = threading.Lock()
+
+def toggle_profile():
+    'Start the profiler, or stop it and save its samples if it is running.'
+    with _TOGGLE_LOCK:
+        if PROFILER.running:
+            save_profile()
+        else:
+            PROFILER.start()
+            logging.info('Started the sampling profiler.')
+
+def _on_signal(signum, frame):
+    thread = threading.Thread(target = toggle_profile, name = 'ProfileToggle')
+    thread.daemon = True
+    thread.start()
+
+def configure(sample = 0, directory = None, interval = 0.005):
+    'Trace one of every SAMPLE requests, and let the profiler be toggled with SIGUSR2, saving profiles in DIRECTORY if not None.'
+    global PROFILER, DIRECTORY
+    TRACER.reset(sample)
+    PROFILER = SamplingProfiler(interval)
+    DIRECTORY = directory
+    signal.signal(signal.SIGUSR2, _on_signal)
+
+## The /debug URLs can slow the server down and show what it's doing,
+## so they only answer requests from the machine the server runs on.
+LOOPBACK = ('::1', '127.0.0.1', '::ffff:127.0.0.1')
+
+def instrument(app):
+    'Trace sampled requests answered by the Flask APP, and serve the controls for tracing and profiling under /debug.'
+    @app.before_request
+    def begin_trace():
+        TRACER.begin(request.endpoint or 'none')
+
+    @app.teardown_request
+    def end_trace(exception):
+        TRACER.end()
+
+    def check_access():
+        if PROFILER is None or request.remote_addr not in LOOPBACK:
+            abort(404)
+
+    ## A POST with a sample parameter changes how often requests are
+    ## traced, and starts the totals over.
+    @app.route('/debug/trace', methods = ('GET', 'POST'))
+    def trace():
+        'The last few traces, or change how often requests are traced.'
+        check_access()
+        if request.method == 'POST':
+            try:
+                sample = int(request.args.get('sample', TRACER.sample))
+                assert sample >= 0
+            except (ValueError, AssertionError):
+                return 'Bad value %s for query parameter sample.' % (request.args.get('sample'),), 400
+            TRACER.reset(sample)
+        return jsonify(TRACER.stats())
+
+    @app.route('/debug/trace/folded', methods = ('GET',))
+    def trace_folded():
+        'The time spent in every stage of the traced requests, in microseconds, in the folded stack format.'
+        check_access()
+        return Response(TRACER.folded(), mimetype = 'text/plain')
+
+    ## A POST starts the profiler, and a DELETE stops it and saves the
+    ## profile, if there is a directory to save it in. A GET returns the
+    ## samples so far, whether or not it's still running.
+    @app.route('/debug/profile', methods = ('GET', 'POST', 'DELETE'))
+    def profile():
+        'Start, stop, or read the sampling profiler of this process.'
+        check_access()
+        if request.method == 'POST':
+            PROFILER.start()
+            return jsonify(PROFILER.stats())
+        if request.method == 'DELETE':
+            path = save_profile()
+            if path is None:
+                return jsonify(PROFILER.stats())
+            return jsonify(path = path, **PROFILER.stats())
+        return Response(PROFILER.folded(), mimetype = 'text/plain')
@@ -0,0 +1,118 @@
+'Adapts how often sources may forward to how well their destinations keep up.'
+
+### The delay in a rule is picked by hand, and the filter can't tell if
+### the database it forwards to keeps up with it. In adaptive mode the
+### controller in this module watches every forward to each destination
+### and sets a rate, in frames a second for each source, that the
+### destination is given frames at. It follows additive increase,
+### multiplicative decrease; every window with forwards that were quick
+### and rarely failed raises the rate by a fixed step, and every window
+### with slow or failing forwards cuts it by a fraction. The rate stays
+### within configured bounds, and a rule's own delay is still the
+### shortest a source ever waits.
+
+import threading
+import time
+
+## Forwards are looked at a window at a time. A window is congested if
+## the mean time its forwards took is over the target latency, or if
+## more than MAX_ERROR_RATE of them failed. A window without any
+## forwards leaves the rate alone, so a destination nobody sends to
+## keeps the rate it last earned.
+class AdaptiveRate(object):
+    'The rate one destination is given frames at.'
+    def __init__(self, rate, min_rate, max_rate, increase, decrease):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.forwards = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.congested = 0 # Windows the rate was cut after.
+
+    def observe(self, latency, ok):
+        'Count a forward that took LATENCY seconds and worked if OK.'
+        self.forwards += 1
+        self.latency_total += latency
+        if not ok:
+            self.failures += 1
+
+    def adjust(self, target_latency, max_error_rate):
+        'Raise or cut the rate based on the forwards in the last window, and start a new one.'
+        if not self.forwards:
+            return
+        if (self.latency_total / self.forwards > target_latency or
+            float(self.failures) / self.forwards > max_error_rate):
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.congested += 1
+        else:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+        self.forwards = 0
+        self.failures = 0
+        self.latency_total = 0.0
+
+## Destinations are known by their URL, the same as in the forwarder.
+## A destination starts at the highest rate and only slows down once it
+## shows it can't keep up. A source whose rule has several destinations
+## is held to the slowest of them. Every worker process has its own
+## controller, and adapts to the forwards it makes itself.
+class RateController(object):
+    'Sets the rate each destination is given frames at from how its forwards went.'
+    def __init__(self, target_latency = 0.05, max_error_rate = 0.05, min_rate = 1.0, max_rate = 30.0,
+                 increase = 1.0, decrease = 0.5, window = 1.0, clock = time.time):
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.clock = clock
+        self.destinations = {}
+        self.window_start = clock()
+        self.lock = threading.Lock()
+
+    def _destination(self, url):
+        'The AdaptiveRate of the destination at URL. Must hold the lock.'
+        try:
+            return self.destinations[url]
+        except KeyError:
+            rate = self.destinations[url] = AdaptiveRate(self.max_rate, self.min_rate, self.max_rate,
+                                                         self.increase, self.decrease)
+            return rate
+
+    def _tick(self):
+        'Adjust every rate if the window is over. Must hold the lock.'
+        now = self.clock()
+        if now - self.window_start < self.window:
+            return
+        self.window_start = now
+        for rate in self.destinations.values():
+            rate.adjust(self.target_latency, self.max_error_rate)
+
+    def observe(self, url, latency, ok):
+        'Count a forward to the destination at URL that took LATENCY seconds and worked if OK.'
+        with self.lock:
+            self._destination(url).observe(latency, ok)
+            self._tick()
+
+    def delay(self, urls, floor = 0):
+        'The seconds a source must wait between forwards to the destinations at URLS. Never less than FLOOR.'
+        with self.lock:
+            self._tick()
+            rate = min(self._destination(url).rate for url in urls)
+        return max(floor, 1.0 / rate)
+
+    def rates(self):
+        'A dictionary of the rate of every destination, keyed by one item tuples of its URL.'
+        with self.lock:
+            return dict(((url,), rate.rate) for url, rate in self.destinations.items())
+
+    def stats(self, url):
+        'A dictionary describing the rate of the destination at URL.'
+        with self.lock:
+            rate = self._destination(url)
+            return {'rate' : rate.rate,
+                    'congested_windows' : rate.congested}
@@ -0,0 +1,203 @@
+'Tracks when each source last had data forwarded so the filter can enforce delays.'
+
+### The filter used to keep the time of the last forward for each
+### source in an in memory sqlite table, which meant running SQL and
+### converting times to and from strings on every request. The tracker
+### in this module keeps the same information in a dictionary, measures
+### time with a monotonic clock, and keeps sub-second precision.
+
+import threading
+import multiprocessing
+import logging
+import time
+import ctypes
+import ctypes.util
+import os
+
+from frame_stream import STREAMS
+
+## Python 2 has no monotonic clock in the time module. On Linux, the
+## C library's clock_gettime is called directly. Anywhere else, the
+## wall clock is used, which can jump if the system time is changed.
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _make_monotonic():
+    'Find the best available monotonic clock.'
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        'Seconds since some fixed point in the past.'
+        t = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _make_monotonic()
+
+## With a fixed delay, a source can send as soon as DELAY seconds have
+## passed since its last forward. In token bucket mode, a source earns
+## one token every DELAY seconds and can save up to BURST tokens, so it
+## can send a short burst after being quiet without going over the
+## average rate.
+def _take(tokens, then, now, delay, burst):
+    'Decide if a source with TOKENS saved at time THEN may send at NOW. Returns (allowed, tokens, time).'
+    if burst is None:
+        if now - then < delay:
+            return False, tokens, then
+        return True, tokens, now
+    tokens = min(burst, tokens + (now - then) / delay)
+    if tokens < 1:
+        return False, tokens, now
+    return True, tokens - 1, now
+
+## Every source has a two item list of the tokens it has saved up and
+## the time they were last counted. The check and the update happen
+## under one lock, so two request threads can't both see that a source
+## is allowed to send and both forward.
+class DelayTracker(object):
+    'Decides if a source may forward data based on when it last did.'
+    def __init__(self, clock = monotonic):
+        self.clock = clock
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def try_acquire(self, source, delay, burst = None):
+        'True if SOURCE may forward data now, in which case the forward is counted. DELAY is in seconds. BURST turns on token bucket mode.'
+        if delay <= 0:
+            return True
+        now = self.clock()
+        with self.lock:
+            state = self.sources.get(source)
+            if state is None:
+                self.sources[source] = [(burst or 1) - 1, now]
+                return True
+            allowed, state[0], state[1] = _take(state[0], state[1], now, delay, burst)
+            return allowed
+
+    def known_sources(self):
+        'A list of every source that has forwarded data.'
+        with self.lock:
+            return list(self.sources)
+
+    def forget(self, source):
+        'Drop everything known about SOURCE.'
+        with self.lock:
+            self.sources.pop(source, None)
+
+## When the filter runs on several worker processes, each worker would
+## have its own dictionary, and a source could send once per worker
+## every delay. The shared tracker keeps the same state in memory that
+## is made before the workers are forked, so every worker sees it. The
+## memory is a fixed size open addressing hash table keyed by the
+## source's address as a 128 bit number, with a lock shared by every
+## process. A source can also be an (address, stream) pair, in which
+## case the stream is kept as its place in STREAMS plus one, and zero
+## for an address on its own or a pair with no stream.
+## Removed sources leave a marker behind so that sources
+## stored after them can still be found. If the table ever fills up,
+## it's emptied, which only lets each source send once early.
+## The monotonic clock is the same in every process on a machine, so
+## times stored by one worker can be compared by another.
+_EMPTY = 0
+_REMOVED = -1
+
+class SharedDelayTracker(object):
+    'A delay tracker shared by every process forked after it is made.'
+    def __init__(self, capacity = 65536, clock = monotonic):
+        self.capacity = capacity
+        self.clock = clock
+        self.versions = multiprocessing.RawArray(ctypes.c_byte, capacity) # 4, 6, or one of the markers.
+        self.high = multiprocessing.RawArray(ctypes.c_uint64, capacity)
+        self.low = multiprocessing.RawArray(ctypes.c_uint64, capacity)
+        self.streams = multiprocessing.RawArray(ctypes.c_byte, capacity)
+        self.pairs = multiprocessing.RawArray(ctypes.c_byte, capacity) # 1 if the source is an (address, stream) pair.
+        self.tokens = multiprocessing.RawArray(ctypes.c_double, capacity)
+        self.stamps = multiprocessing.RawArray(ctypes.c_double, capacity)
+        self.lock = multiprocessing.Lock()
+
+    def _find(self, version, high, low, stream, pair):
+        'The slot of the source, or the negated slot plus one it should be stored in. Must hold the lock.'
+        slot = (low ^ (high * 0x9E3779B97F4A7C15)) % self.capacity
+        free = None
+        for _ in xrange(self.capacity):
+            found = self.versions[slot]
+            if found == _EMPTY:
+                return -1 - (slot if free is None else free)
+            if found == _REMOVED:
+                if free is None:
+                    free = slot
+            elif (found == version and self.high[slot] == high and self.low[slot] == low and
+                  self.streams[slot] == stream and self.pairs[slot] == pair):
+                return slot
+            slot = (slot + 1) % self.capacity
+        if free is None:
+            logging.warning('The shared delay table is full, emptying it.')
+            ctypes.memset(self.versions, _EMPTY, self.capacity)
+            return -1 - ((low ^ (high * 0x9E3779B97F4A7C15)) % self.capacity)
+        return -1 - free
+
+    @staticmethod
+    def _key(source):
+        if isinstance(source, tuple):
+            address, stream = source
+            code = STREAMS.index(stream) + 1 if stream is not None else 0
+            pair = 1
+        else:
+            address, code, pair = source, 0, 0
+        number = int(address)
+        return address.version, number >> 64, number & 0xFFFFFFFFFFFFFFFF, code, pair
+
+    def try_acquire(self, source, delay, burst = None):
+        'True if SOURCE may forward data now, in which case the forward is counted. DELAY is in seconds. BURST turns on token bucket mode.'
+        if delay <= 0:
+            return True
+        version, high, low, stream, pair = self._key(source)
+        now = self.clock()
+        with self.lock:
+            slot = self._find(version, high, low, stream, pair)
+            if slot < 0:
+                slot = -1 - slot
+                self.versions[slot] = version
+                self.high[slot] = high
+                self.low[slot] = low
+                self.streams[slot] = stream
+                self.pairs[slot] = pair
+                self.tokens[slot] = (burst or 1) - 1
+                self.stamps[slot] = now
+                return True
+            allowed, self.tokens[slot], self.stamps[slot] = _take(self.tokens[slot], self.stamps[slot],
+                                                                  now, delay, burst)
+            return allowed
+
+    def known_sources(self):
+        'A list of every source that has forwarded data.'
+        sources = []
+        with self.lock:
+            for slot in xrange(self.capacity):
+                version = self.versions[slot]
+                if version > 0:
+                    sources.append((version, (self.high[slot] << 64) | self.low[slot],
+                                    self.streams[slot], self.pairs[slot]))
+        import ipaddress # Only needed here, and rarely.
+        found = []
+        for version, number, stream, pair in sources:
+            address = ipaddress.IPv4Address(number) if version == 4 else ipaddress.IPv6Address(number)
+            found.append((address, STREAMS[stream - 1] if stream else None) if pair else address)
+        return found
+
+    def forget(self, source):
+        'Drop everything known about SOURCE.'
+        version, high, low, stream, pair = self._key(source)
+        with self.lock:
+            slot = self._find(version, high, low, stream, pair)
+            if slot >= 0:
+                self.versions[slot] = _REMOVED
@@ -0,0 +1,415 @@
+'Replays stored frames back through the pipeline, or exports them to an archive.'
+
+### Once a capture is in the save directory, this program can send it
+### again. It reads the records of the frames received in a range of
+### time, oldest first, reads each frame's image from wherever it was
+### stored, decodes it if it was compressed, and sends it to a filter or
+### database server the way the producer sent it. Frames are sent with
+### the same spacing they were received with, or that spacing divided
+### by a speed, by several senders at once so a slow answer doesn't
+### hold up the frames behind it. The same frames can instead be
+### written to one archive, either a tar file or a segment file with an
+### index, in one pass.
+### Images are read by a thread of their own, a number of frames ahead
+### of the senders, so the senders never wait on the disk. Frames are
+### read in the order they were received, which for segment files is
+### the order they're laid out on disk.
+
+import argparse
+import heapq
+import httplib
+import io
+import json
+import logging
+import os
+import os.path
+import socket
+import sys
+import tarfile
+import threading
+import time
+import urlparse
+import Queue
+
+from util import *
+from db_pool import connect
+from partitions import parse_partition
+from frame_store import FileStore, SegmentStore, SegmentLocation
+from benchmark import Results, percentile, print_summary
+import frame_codec
+
+## A frame's stream and sensor time are recorded for frames sent in a
+## frame stream, and in the table of each stream in newer databases.
+## Frames in older ones are video, unless they were stored with a depth
+## codec, and have no sensor time.
+class StoredFrame(object):
+    'The record of a stored frame, and its decoded image once it has been read.'
+    def __init__(self, file_name, origin_machine, time, location = None, codec = None, reference = None, stream = None,
+                 sensor_time = None):
+        self.file_name = file_name
+        self.origin_machine = origin_machine
+        self.time = time
+        self.sensor_time = sensor_time
+        self.location = location
+        self.codec = codec or 'raw'
+        self.reference = reference
+        self.stream = stream or ('depth' if frame_codec.needs_reference(self.codec) else 'video')
+        self.data = None
+
+FRAME_QUERY = '''SELECT frames.file_name, frames.origin_machine, frames.time, segment, offset, length, codec, reference,
+                        frame_sensors.stream, frame_sensors.sensor_time
+                 FROM frames
+                 LEFT JOIN segment_frames ON segment_frames.file_name = frames.file_name
+                 LEFT JOIN frame_codecs ON frame_codecs.file_name = frames.file_name
+                 LEFT JOIN frame_sensors ON frame_sensors.file_name = frames.file_name'''
+
+## The tables of each stream are joined on their whole index, so each
+## frame is a seek rather than a scan.
+STREAM_FRAME_QUERY = '''SELECT frames.file_name, frames.origin_machine, frames.time, segment, offset, length, codec, reference,
+                               COALESCE(frame_sensors.stream,
+                                        CASE WHEN depth_frames.file_name IS NOT NULL THEN 'depth'
+                                             WHEN video_frames.file_name IS NOT NULL THEN 'video' END),
+                               COALESCE(frame_sensors.sensor_time, depth_frames.sensor_time, video_frames.sensor_time)
+                        FROM frames
+                        LEFT JOIN segment_frames ON segment_frames.file_name = frames.file_name
+                        LEFT JOIN frame_codecs ON frame_codecs.file_name = frames.file_name
+                        LEFT JOIN frame_sensors ON frame_sensors.file_name = frames.file_name
+                        LEFT JOIN depth_frames ON depth_frames.origin_machine = frames.origin_machine
+                                              AND depth_frames.time = frames.time
+                                              AND depth_frames.file_name = frames.file_name
+                        LEFT JOIN video_frames ON video_frames.origin_machine = frames.origin_machine
+                                              AND video_frames.time = frames.time
+                                              AND video_frames.file_name = frames.file_name'''
+
+def frame_query(db):
+    'The query for the stored frames of DB, which only looks at the tables of each stream if DB has them.'
+    return STREAM_FRAME_QUERY if _table_exists(db, 'depth_frames') else FRAME_QUERY
+
+def make_stored_frame(row):
+    'The StoredFrame of a row returned by FRAME_QUERY or STREAM_FRAME_QUERY.'
+    file_name, origin_machine, time, segment, offset, length, codec, reference, stream, sensor_time = row
+    return StoredFrame(str(file_name),
+                       origin_machine,
+                       time,
+                       SegmentLocation(segment, offset, length) if segment is not None else None,
+                       codec,
+                       reference,
+                       stream,
+                       sensor_time)
+
+def database_paths(save_location, start = 0, end = None):
+    'The paths of every frames database in SAVE_LOCATION that could hold frames received in [START, END).'
+    paths = []
+    legacy_path = os.path.join(save_location, 'DB_FRAMES')
+    if os.path.exists(legacy_path):
+        paths.append(legacy_path)
+    directory = os.path.join(save_location, 'partitions')
+    if os.path.isdir(directory):
+        partitions = sorted((partition for partition in
+                             (parse_partition(os.path.join(directory, name)) for name in os.listdir(directory))
+                             if partition is not None),
+                            key = lambda partition: partition.start)
+        ## Late records are in the partition after their own, so the
+        ## partition after the range is read too.
+        paths.extend(partition.path for partition in partitions
+                     if partition.end > start and (end is None or partition.start < end))
+        if end is not None:
+            paths.extend([partition.path for partition in partitions if partition.start >= end][:1])
+    return paths
+
+def _table_exists(db, name):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def database_frames(path, start, end, origin_machine):
+    'Yield a (time, name, StoredFrame) triple for every frame in the database at PATH received in [START, END), oldest first.'
+    db = connect(path, readonly = True)
+    try:
+        if not _table_exists(db, 'frames'):
+            return
+        conditions = ['frames.time >= ?', 'frames.time < ?']
+        params = [start, end if end is not None else sys.maxint]
+        if origin_machine is not None:
+            conditions.append('frames.origin_machine = ?')
+            params.append(origin_machine)
+        cursor = db.execute('%s WHERE %s ORDER BY frames.time, frames.file_name' % (frame_query(db), ' AND '.join(conditions)), params)
+        for row in cursor:
+            frame = make_stored_frame(row)
+            yield frame.time, frame.file_name, frame
+    finally:
+        db.close()
+
+## Each database is already in time order, and late records put a
+## partition's first few frames before the last few of the partition
+## before it, so the databases are merged rather than read one by one.
+def session_frames(save_location, start = 0, end = None, origin_machine = None):
+    'Yield the StoredFrame of every frame in SAVE_LOCATION received in [START, END), from ORIGIN_MACHINE if not None, oldest first.'
+    for _, _, frame in heapq.merge(*[database_frames(path, start, end, origin_machine)
+                                     for path in database_paths(save_location, start, end)]):
+        yield frame
+
+def find_frame(save_location, file_name):
+    'The StoredFrame of the frame FILE_NAME, or None if there is no record of it.'
+    for path in database_paths(save_location):
+        db = connect(path, readonly = True)
+        try:
+            if not _table_exists(db, 'frames'):
+                continue
+            row = db.execute('%s WHERE frames.file_name = ?' % (frame_query(db),), (file_name,)).fetchone()
+        finally:
+            db.close()
+        if row is not None:
+            return make_stored_frame(row)
+    return None
+
+## A frame stored with a codec that needs a key frame is decoded against
+## the key frame its sender had for that stream at the time, which is
+## almost always the last frame of the stream from that sender read
+## without one. That frame is kept for every sender and stream, so a
+## video frame in between doesn't push out the depth key frame, and any
+## other key frame is looked up by name.
+class FrameReader(object):
+    'Reads and decodes the images of stored frames.'
+    def __init__(self, save_location):
+        self.save_location = save_location
+        self.files = FileStore(save_location)
+        self.segments = None
+        if os.path.isdir(os.path.join(save_location, 'segments')):
+            self.segments = SegmentStore(save_location)
+        self.keyframes = {} # Sender and stream to (name, decoded image) of its last frame read without a key frame.
+
+    def _stored(self, frame):
+        if frame.location is None:
+            return self.files.read(frame.file_name)
+        return str(self.segments.read(frame.file_name, frame.location))
+
+    def _keyframe(self, frame):
+        name, data = self.keyframes.get((frame.origin_machine, frame.stream), (None, None))
+        if name == frame.reference:
+            return data
+        key = find_frame(self.save_location, frame.reference)
+        if key is None:
+            raise KeyError(frame.reference)
+        return self.read(key)
+
+    def read(self, frame):
+        'The decoded image of FRAME.'
+        reference = None
+        if frame_codec.needs_reference(frame.codec):
+            reference = self._keyframe(frame)
+        data = frame_codec.decode(frame.codec, self._stored(frame), reference)
+        if reference is None:
+            self.keyframes[(frame.origin_machine, frame.stream)] = (frame.file_name, data)
+        return data
+
+    def close(self):
+        if self.segments is not None:
+            self.segments.close()
+
+_DONE = object()
+
+## The read ahead thread puts frames on a bounded queue, so it stays at
+## most READ_AHEAD frames in front of whatever is taking them off. A
+## frame that can't be read is logged and skipped.
+class ReadAhead(threading.Thread):
+    'A thread that reads the images of frames ahead of when they are needed.'
+    def __init__(self, frames, reader, read_ahead = 64):
+        threading.Thread.__init__(self, name = 'ReadAhead')
+        self.daemon = True
+        self.frames = frames
+        self.reader = reader
+        self.queue = Queue.Queue(read_ahead)
+        self.skipped = 0
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                try:
+                    frame.data = self.reader.read(frame)
+                except (IOError, OSError, KeyError, ValueError, frame_codec.UnknownCodecException), e:
+                    logging.error('Could not read frame %s. %s', frame.file_name, repr(e))
+                    self.skipped += 1
+                    continue
+                self.queue.put(frame)
+        finally:
+            self.queue.put(_DONE)
+
+    def __iter__(self):
+        while True:
+            frame = self.queue.get()
+            if frame is _DONE:
+                return
+            yield frame
+
+## Every sender keeps its own connection open between frames. Frames are
+## sent as single requests, with the X-Stream and X-Sensor-Time headers
+## the producer sends, so the database stores them as the kind of frame
+## they were and can pair them up again.
+class Sender(threading.Thread):
+    'A thread that sends frames from a queue to a server.'
+    def __init__(self, n, url, frames, results):
+        threading.Thread.__init__(self, name = 'Sender-%d' % (n,))
+        self.daemon = True
+        self.url = urlparse.urlparse(url)
+        self.frames = frames
+        self.results = results
+
+    def connect(self):
+        return httplib.HTTPConnection(self.url.hostname, self.url.port or 80, timeout = 30)
+
+    def run(self):
+        connection = None
+        while True:
+            frame = self.frames.get()
+            if frame is _DONE:
+                return
+            sent = time.time()
+            try:
+                if connection is None:
+                    connection = self.connect()
+                headers = {'Content-Type' : 'application/octet-stream',
+                           'X-Stream' : frame.stream}
+                if frame.sensor_time is not None:
+                    headers['X-Sensor-Time'] = str(frame.sensor_time)
+                connection.request('PUT', self.url.path or '/', frame.data, headers)
+                response = connection.getresponse()
+                body = response.read()
+                self.results.record(time.time() - sent,
+                                    len(frame.data),
+                                    response.status == 200 and body != 'Failure',
+                                    error = response.status >= 500)
+            except (socket.error, httplib.HTTPException):
+                self.results.record(time.time() - sent, len(frame.data), False, error = True)
+                connection = None
+
+## Frames are handed to the senders when they're due, which is the time
+## since the first frame was received divided by the speed. A speed of
+## zero sends every frame as soon as it has been read. If the senders
+## fall behind, frames are handed over as soon as one is free, and how
+## late each frame was is reported.
+def replay(frames, url, senders = 4, speed = 1.0):
+    'Send FRAMES to the server at URL with SENDERS senders, SPEED times as fast as they were received. Returns a summary.'
+    results = Results()
+    queue = Queue.Queue(senders)
+    threads = [Sender(n, url, queue, results) for n in range(senders)]
+    for thread in threads:
+        thread.start()
+    lateness = []
+    first = None
+    start = time.time()
+    for frame in frames:
+        if speed > 0:
+            if first is None:
+                first = frame.time
+            due = start + (frame.time - first) / 1000.0 / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            queue.put(frame)
+            lateness.append(max(0.0, time.time() - due))
+        else:
+            queue.put(frame)
+    for _ in threads:
+        queue.put(_DONE)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies = sorted(results.latencies)
+    lateness.sort()
+    return {'url' : url,
+            'senders' : senders,
+            'speed' : speed,
+            'duration' : elapsed,
+            'sent' : results.sent,
+            'accepted' : results.accepted,
+            'rejected' : results.rejected,
+            'errors' : results.errors,
+            'throughput' : results.accepted / elapsed if elapsed else 0.0,
+            'megabytes_per_second_sent' : results.bytes_sent / elapsed / 1e6 if elapsed else 0.0,
+            'latency_p50' : percentile(latencies, 0.5),
+            'latency_p99' : percentile(latencies, 0.99),
+            'lateness_p99' : percentile(lateness, 0.99)}
+
+## An exported frame keeps the meta data it was stored with in an index
+## of JSON lines, one per frame, in the order they were received. A tar
+## archive has a member named after each frame and the index as its
+## last member. A segment archive is every frame one after another, the
+## same as a segment of the store, and the index is written next to it
+## with the offset and length of each frame.
+def index_entry(frame):
+    return {'file_name' : frame.file_name,
+            'origin_machine' : frame.origin_machine,
+            'time' : frame.time,
+            'stream' : frame.stream,
+            'sensor_time' : frame.sensor_time}
+
+def export_tar(frames, path):
+    'Write FRAMES to a tar archive at PATH. Returns the number of frames written.'
+    index = io.BytesIO()
+    count = 0
+    with tarfile.open(path, 'w') as archive:
+        for frame in frames:
+            info = tarfile.TarInfo(frame.file_name + '.bmp')
+            info.size = len(frame.data)
+            info.mtime = frame.time // 1000
+            archive.addfile(info, io.BytesIO(frame.data))
+            index.write(json.dumps(index_entry(frame), sort_keys = True) + '\n')
+            count += 1
+        info = tarfile.TarInfo('index.jsonl')
+        info.size = index.tell()
+        info.mtime = int(time.time())
+        index.seek(0)
+        archive.addfile(info, index)
+    return count
+
+def export_segment(frames, path):
+    'Write FRAMES one after another to a segment archive at PATH, with its index at PATH.index.jsonl. Returns the number of frames written.'
+    count = 0
+    offset = 0
+    with open(path, 'wb') as segment, open(path + '.index.jsonl', 'w') as index:
+        for frame in frames:
+            segment.write(frame.data)
+            entry = index_entry(frame)
+            entry['offset'] = offset
+            entry['length'] = len(frame.data)
+            index.write(json.dumps(entry, sort_keys = True) + '\n')
+            offset += len(frame.data)
+            count += 1
+    return count
+
+EXPORTERS = {'tar' : export_tar, 'segment' : export_segment}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Send stored Kinect frames to a filter or database server again, or export them to an archive.')
+    parser.add_argument('--save', help = 'The save directory the frames are stored in.', type = str, default = default_save_location())
+    parser.add_argument('--url', help = 'The server to send frames to.', type = str, default = None)
+    parser.add_argument('--export', help = 'The archive to write frames to instead of sending them.', type = str, default = None)
+    parser.add_argument('--format', help = 'The kind of archive to export to.', choices = sorted(EXPORTERS), default = 'tar')
+    parser.add_argument('--start', help = 'Only frames received at or after this many milliseconds since the epoch.', type = int, default = 0)
+    parser.add_argument('--end', help = 'Only frames received before this many milliseconds since the epoch.', type = int, default = None)
+    parser.add_argument('--origin', help = 'Only frames sent from this address.', type = str, default = None)
+    parser.add_argument('--speed', help = 'How many times faster than they were received frames are sent. Zero sends them as fast as possible.', type = float, default = 1.0)
+    parser.add_argument('--senders', help = 'The number of frames sent at once.', type = int, default = 4)
+    parser.add_argument('--read-ahead', help = 'The most frames read before they are sent.', type = int, default = 64)
+    parser.add_argument('--log-level', help = 'The lowest level of message logged.', choices = LOG_LEVELS, default = 'INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level = getattr(logging, args.log_level))
+    if (args.url is None) == (args.export is None):
+        parser.error('Give exactly one of --url and --export.')
+    origin = args.origin
+    if origin is not None:
+        if not is_valid_ipv6_address(origin):
+            parser.error('--origin must be an IPv6 address, not %s.' % (origin,))
+        ## Senders are saved in the form the server sees them in.
+        origin = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, origin))
+    reader = FrameReader(args.save)
+    frames = ReadAhead(session_frames(args.save, args.start, args.end, origin), reader, args.read_ahead)
+    frames.start()
+    if args.export is not None:
+        started = time.time()
+        count = EXPORTERS[args.format](frames, args.export)
+        print 'Exported %d frames to %s in %.1f seconds.' % (count, args.export, time.time() - started)
+    else:
+        print_summary(replay(frames, args.url, args.senders, args.speed))
+    if frames.skipped:
+        print 'Skipped %d frames that could not be read.' % (frames.skipped,)
+    reader.close()
@@ -0,0 +1,44 @@
+'A longest prefix match index over IPv6 networks.'
+
+### Rules can apply to a whole subnet instead of a single address, and
+### the most specific rule that covers an address wins. The index in
+### this module keeps one hash table for every prefix length that is
+### in use. A lookup masks the address down to each of those lengths,
+### longest first, and stops at the first table that has a match. That
+### is at most one dictionary lookup per prefix length, no matter how
+### many rules there are.
+
+ADDRESS_BITS = 128
+ALL_ONES = (1 << ADDRESS_BITS) - 1
+
+def prefix_mask(length):
+    'The integer mask that keeps the first LENGTH bits of an IPv6 address.'
+    return ALL_ONES ^ (ALL_ONES >> length)
+
+class PrefixIndex(object):
+    'Maps IPv6 networks to values and finds the value of the longest network containing an address.'
+    def __init__(self):
+        self.tables = {} # Prefix length to {network address as an int : value}.
+        self.lengths = [] # (prefix length, mask) pairs, longest prefix first.
+
+    def insert(self, network, value):
+        'Map the ipaddress NETWORK to VALUE, replacing any value it already had.'
+        length = network.prefixlen
+        if length not in self.tables:
+            self.tables[length] = {}
+            self.lengths = sorted(((n, prefix_mask(n)) for n in self.tables),
+                                  reverse = True)
+        self.tables[length][int(network.network_address)] = value
+
+    def lookup(self, address, default = None):
+        'The value of the longest network containing the ipaddress ADDRESS, or DEFAULT if none do.'
+        n = int(address)
+        for length, mask in self.lengths:
+            try:
+                return self.tables[length][n & mask]
+            except KeyError:
+                pass
+        return default
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
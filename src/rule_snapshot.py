@@ -0,0 +1,86 @@
+'Saves parsed rule tables so a rule file only has to be parsed once.'
+
+### Parsing a rule file means checking every address in it and building
+### the prefix index, which takes a while for a file with many
+### thousands of rules, and is done again whenever the filter starts
+### and by every worker whenever the file changes. The snapshots in
+### this module are the parsed rule table pickled to a file named after
+### a hash of the rule file's contents. If a snapshot of the same
+### contents exists, the table is loaded from it instead of parsing the
+### file. A changed rule file has a different hash, so a stale snapshot
+### is never used; it's just left behind until it's cleaned up.
+### Snapshots are pickles, and loading a pickle can run code, so the
+### snapshot directory must only be writable by whoever runs the filter.
+
+import os
+import os.path
+import hashlib
+import cPickle
+import tempfile
+import logging
+
+## Snapshots hold the filter's own classes, so one saved by a different
+## version of the filter might not load, or might load into the wrong
+## shape. The version is part of the hash, and is raised whenever the
+## rule classes change.
+VERSION = 1
+KEEP = 8 # Snapshots of other rule files kept in the directory.
+
+class RuleSnapshots(object):
+    'A directory of parsed rule tables.'
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+
+    def path(self, text):
+        'The path of the snapshot of a rule file holding TEXT.'
+        digest = hashlib.sha1('%d\n%s' % (VERSION, text)).hexdigest()
+        return os.path.join(self.directory, digest + '.rules')
+
+    def load(self, file_path, parse):
+        'The rule table of the file at FILE_PATH. PARSE is called with the path and text of the file if there is no snapshot of it.'
+        with open(file_path, 'rb') as f_obj:
+            text = f_obj.read()
+        path = self.path(text)
+        try:
+            with open(path, 'rb') as f_obj:
+                return cPickle.load(f_obj)
+        except IOError:
+            pass
+        except Exception, e:
+            logging.warning('Could not load rule snapshot %s, parsing the rule file instead. %s', path, repr(e))
+        table = parse(file_path, text)
+        try:
+            self.save(path, table)
+        except (IOError, OSError, TypeError, cPickle.PicklingError), e:
+            logging.warning('Could not save rule snapshot %s. %s', path, repr(e))
+        return table
+
+    def save(self, path, table):
+        'Save TABLE as the snapshot at PATH.'
+        fd, temp_path = tempfile.mkstemp(dir = self.directory, suffix = '.part')
+        try:
+            with os.fdopen(fd, 'wb') as f_obj:
+                cPickle.dump(table, f_obj, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+        self.clean(path)
+
+    def clean(self, current):
+        'Delete old snapshots, keeping the one at CURRENT and the KEEP newest others.'
+        snapshots = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.rules') and path != current:
+                try:
+                    snapshots.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass # Cleaned up by another worker.
+        for _, path in sorted(snapshots, reverse = True)[KEEP:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
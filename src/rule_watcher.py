@@ -0,0 +1,68 @@
+'Watches a rule file and reloads it when it changes.'
+
+### Without a watcher, the only way to change routing rules is to
+### restart the filter, which drops anything in flight. The watcher in
+### this module checks the rule file on a background thread. When the
+### file changes, it's parsed again and, if it's valid, handed off to
+### be swapped in. If it isn't valid, the rules already in use are
+### kept and the parsing error is logged.
+
+import os
+import threading
+import logging
+
+## A file is considered changed when its modification time, size, or
+## inode changes. Checking the inode catches editors that save by
+## writing a new file and renaming it over the old one.
+def file_signature(path):
+    'Something that changes whenever the file at PATH changes, or None if it does not exist.'
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_mtime, info.st_size, info.st_ino)
+
+class RuleWatcher(object):
+    'Polls a rule file and reloads it when it changes.'
+    def __init__(self, path, load, on_reload, interval = 1.0):
+        'LOAD parses the file at PATH into a rule table, and ON_RELOAD is given each new table.'
+        self.path = path
+        self.load = load
+        self.on_reload = on_reload
+        self.interval = interval
+        self.signature = file_signature(path)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        'Start polling the rule file.'
+        self.thread = threading.Thread(target = self._run, name = 'RuleWatcher')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        'Stop polling the rule file.'
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def check(self):
+        'Reload the rule file if it has changed. True if a new table was swapped in.'
+        signature = file_signature(self.path)
+        if signature == self.signature or signature is None:
+            return False
+        self.signature = signature
+        try:
+            table = self.load(self.path)
+        except Exception, e:
+            logging.error('Could not reload rule file %s, keeping the old rules. %s', self.path, repr(e))
+            return False
+        self.on_reload(table)
+        logging.info('Reloaded rule file %s.', self.path)
+        return True
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
@@ -1,8 +1,60 @@
 /* Create a table for representing frame objects. Each frame
    includes an ASCII UUID consisting of the characters
    [0-9a-f\-], an ASCII hexidecimal IPv6 addresses limited
-   to 45 characters, and a 23 character date represented with
-   a subset of ISO8601.
+   to 45 characters, and the time the frame was received in
+   milliseconds since the Unix epoch.
 */
-create table frames(file_name varchar(36), origin_machine varchar(45), time varchar(23));
+create table if not exists frames(file_name varchar(36), origin_machine varchar(45), time integer);
 
+/* Frames are looked up by name, and listed by sender and time
+   or by time alone. The listing indexes include the name so a
+   listing can be answered from the index without reading the
+   table.
+*/
+create index if not exists frames_by_name on frames(file_name);
+create index if not exists frames_by_origin_time on frames(origin_machine, time, file_name);
+create index if not exists frames_by_time on frames(time, file_name);
+
+/* Create a table for finding frames saved in segment files. Each
+   row gives the name of the segment a frame was appended to, the
+   byte offset it starts at, and its length in bytes. Frames saved
+   one file per frame have no row here.
+*/
+create table if not exists segment_frames(file_name varchar(36), segment varchar(64), offset integer, length integer);
+create index if not exists segment_frames_by_name on segment_frames(file_name);
+
+/* Create a table for decoding compressed frames. Each row gives
+   the codec a frame was stored with, and the name of the key frame
+   it was encoded against if the codec needs one. Frames stored as
+   they were sent have no row here.
+*/
+create table if not exists frame_codecs(file_name varchar(36), codec varchar(16), reference varchar(36));
+create index if not exists frame_codecs_by_name on frame_codecs(file_name);
+
+/* Create a table for what the sender said about frames sent in a
+   frame stream. Each row gives the stream the frame is from, video
+   or depth, the timestamp the sensor gave it, and its size in
+   pixels. Frames sent one per request have no row here.
+*/
+create table if not exists frame_sensors(file_name varchar(36), stream varchar(8), sensor_time integer, width integer, height integer);
+create index if not exists frame_sensors_by_name on frame_sensors(file_name);
+
+/* Create a table for each stream a sensor sends. Every frame has a
+   row in the table of its stream, with its sender, the time it was
+   received in milliseconds since the Unix epoch, and the timestamp
+   the sensor gave it, if the sender sent one. Depth and video frames are paired by finding, for each
+   frame of one stream, the frame of the other stream from the same
+   sender received around the same time with the closest sensor
+   timestamp.
+*/
+create table if not exists video_frames(file_name varchar(36), origin_machine varchar(45), time integer, sensor_time integer);
+create index if not exists video_frames_by_origin_time on video_frames(origin_machine, time, file_name);
+create table if not exists depth_frames(file_name varchar(36), origin_machine varchar(45), time integer, sensor_time integer);
+create index if not exists depth_frames_by_origin_time on depth_frames(origin_machine, time, file_name);
+
+/* 
+   Create a table for representing delay objects. ASCII hexidecimal
+   IPv6 addresses limited to 45 characters, and a 23 character date
+   represented with a subset of ISO8601.
+*/
+create table if not exists delay(origin_machine varchar(45), time_elapsed varchar(23));
@@ -8,21 +8,48 @@
 ### the database, and some validators.
 
 import os.path
+import io
 import sqlite3
 import socket
-import datetime
 import re
 import uuid
 import argparse
 import logging
+import time as clock
+import atexit
+import contextlib
+import zlib
+import bisect
 
 from flask import Flask
 from flask import request
 from flask import g
+from flask import jsonify
+from flask import Response
+from flask import send_file
+from flask import abort
 
 from util import *
+from frame_writer import FrameWriter
+from db_pool import ConnectionPool, connect
+from partitions import PartitionSet, PartitionMaintainer
+from frame_store import FileStore, SegmentStore, SegmentLocation
+from compressor import Compressor
+from frame_journal import FrameJournal, ChecksumReader, FSYNC_POLICIES
+import frame_journal
+import frame_codec
+import frame_stream
+import prefork
+import metrics
+import profiling
+from profiling import span
 
 app = Flask(__name__) # Create the web application.
+metrics.instrument(app) # Count and time requests, and serve /metrics.
+profiling.instrument(app) # Trace sampled requests, and serve /debug.
+
+FRAME_WRITE_SECONDS = metrics.histogram('kinect_frame_write_seconds', 'Time taken to write a frame image to disk.')
+FRAME_BYTES = metrics.counter('kinect_frame_bytes_written_total', 'Bytes of frame images written to disk.')
 
 ## The get_db and close_connection functions make it possible
 ## to access the database inside request handlers. When the
@@ -34,25 +61,39 @@ app = Flask(__name__) # Create the web application.
 ## exists or doesn't already exist. If a handle already
 ## exists, get_db just returns it. If a handle does not
 ## exist, close_connection does nothing.
-    
+## Handles are borrowed from a pool of open connections
+## instead of being opened for every request, and they're
+## given back to the pool when the request is finished. See
+## db_pool.py for details.
+
+POOL = None
+
 def get_db():
     'Get a reference to the database.'
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-    db.row_factory = make_frame_data # Changes the way queries are represented.
+        db = g._database = POOL.acquire()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    'Close the database if open.'
+    'Give the database back to the pool if borrowed.'
     db = getattr(g, '_database', None)
     if db is not None:
-        db.commit()
-        db.close()
+        g._database = None
+        try:
+            if exception is None:
+                db.commit()
+            else:
+                db.rollback()
+        except sqlite3.Error, e:
+            logging.error('Could not finish transaction. %s', e)
+            POOL.release(db, discard = True)
+        else:
+            POOL.release(db)
 
-## The get_db function mentioned earlier does more than just
-## return a handle; it also changes the row_factory. The row
+## The connections in the pool do more than just return
+## rows; they're opened with a different row_factory. The row
 ## factory is a function called on the results of a query
 ## before returning them. The sqlite3 queries are tuples
 ## containing row values by default, but the order of the
@@ -67,35 +108,74 @@ def close_connection(exception):
 ## at the SQL script used to initialize the database and
 ## create tables.
 
+## A frame saved in a segment file also has a location; which segment
+## it's in, where, and how long it is. See frame_store.py for details.
+## A compressed frame also has the codec it was stored with, and the
+## key frame it was encoded against if the codec needs one. See
+## frame_codec.py for details.
+## A frame stored as it was sent also has the length and CRC-32 of its
+## image, which the journal keeps so the image can be checked if the
+## server stops before the frame is safely stored. See frame_journal.py
+## for details.
+## Every frame is from one of a sensor's streams, video or depth, and
+## may have the timestamp the sensor gave it.
+
 class FrameMetaData(object):
     'Meta data about a frame.'
-    def __init__(self, file_name, origin_machine, time):
+    def __init__(self, file_name, origin_machine, time, location = None, codec = 'raw', reference = None, header = None,
+                 checksum = None, length = None, stream = 'video', sensor_time = None):
         self.file_name = file_name
         self.origin_machine = origin_machine
         self.time = time        
+        self.stream = stream
+        self.sensor_time = sensor_time
+        self.location = location
+        self.codec = codec
+        self.reference = reference
+        self.header = header # The FrameHeader of frames sent in a frame stream.
+        self.checksum = checksum
+        self.length = length
 
 def make_frame_data(cursor, row):
     'A factory function that takes a frame SQL row tuple and returns a FrameMetaData instance.'
     return FrameMetaData(row[0], row[1], row[2])
 
+def plain_cursor(db):
+    'A cursor on DB that returns rows as tuples instead of FrameMetaData instances.'
+    cursor = db.cursor()
+    cursor.row_factory = None
+    return cursor
+
 ## The init_db function initializes the database with a
-## given scehem. It will be called automatically if no
-## file with the expected path is found. It can also be
-## ran from an interpreter to reset the database.
+## given scehem. It is called every time the server starts.
+## The schema only creates tables that don't already exist,
+## so an older database gets any tables it's missing.
+## The version of the schema is kept in sqlite's user_version.
+## A database from before frame times were saved as numbers
+## has version zero and a frames table, and it's migrated
+## before the rest of the schema is applied.
+SCHEMA_VERSION = 1
+
 def init_db():
     'Initialize the database with an empty table.'
     with app.app_context():
-	try:
+        try:
             db = get_db()
-	except sqlite3.OperationalError, e:
+        except sqlite3.OperationalError, e:
             logging.debug('Does the project directory %s exist?', default_save_location())
             raise e
+        cursor = plain_cursor(db)
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        has_frames = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'frames'").fetchone()
+        if version < 1 and has_frames:
+            logging.info('Migrating frame times to milliseconds since the epoch.')
+            with app.open_resource('migrate_epoch.sql', mode = 'r') as f:
+                cursor.executescript(f.read())
         with app.open_resource('schema.sql', mode = 'r') as f:
-            db.cursor().executescript(f.read())
+            cursor.executescript(f.read())
+        cursor.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION,))
         db.commit()
 
-
-
 ## The following two functions are predicates used to check
 ## that the data being saved in the database is valid before
 ## it's actually saved. Ideally, these functions and the
@@ -115,12 +195,12 @@ def is_valid_uuid(file_name):
     return re.match(_UUID_RE, file_name)
 
 def is_valid_time(time):
-    'True if TIME is a valid string in a simple subset of ISO8601.'
-    try:
-        datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S')
-        return True
-    except ValueError:
-        return False        
+    'True if TIME is a valid number of milliseconds since the epoch.'
+    return isinstance(time, (int, long)) and time >= 0
+
+def epoch_milliseconds():
+    'The current time in milliseconds since the Unix epoch.'
+    return int(clock.time() * 1000)
 
 
 ## The next two functions are used to save a piece of frame data.
@@ -132,54 +212,738 @@ def is_valid_time(time):
 ## has better read performance for the size of files being used. [0]
 ## [0] https://www.sqlite.org/intern-v-extern-blob.html
 
+## Records are not inserted by the request handler. They are handed
+## to the frame writer, which saves them in batches on its own thread.
+## See frame_writer.py for details.
+WRITER = None
+
+## Every record is logged in the journal before it's queued, so it can
+## be saved after a crash even if its batch never was.
+JOURNAL = None
+
 def save_frame_record(frame):
     'Save a record containing metadata about a FRAME to the database.'
-    assert is_valid_ipv6_address(frame.origin_machine)
-    assert is_valid_uuid(frame.file_name)
-    assert is_valid_time(frame.time)
-    curr = get_db().execute('INSERT INTO frames values(?, ?, ?)',
-                            (frame.file_name, frame.origin_machine, frame.time))
-    logging.info('Saved record to database.')
-
-def save_frame_image(data, file_name):
-    'Save the image DATA of the frame to a file with FILE_NAME.'
-    path = os.path.join(SAVE_LOCATION, file_name)
-    logging.info('Frame image save to %s', path)
-    with file(path, 'wb') as f_obj:
-        f_obj.write(data)
-    logging.info('Saved image to %s', path)
+    with span('validate'):
+        assert is_valid_ipv6_address(frame.origin_machine)
+        assert is_valid_uuid(frame.file_name)
+        assert is_valid_time(frame.time)
+    if JOURNAL is not None:
+        with span('journal'):
+            JOURNAL.stored(frame)
+    with span('queue record'):
+        WRITER.put(frame)
+    FRAME_LOG('Queued record for database.')
+
+## Where the image is saved depends on the storage backend the server
+## was started with, either one file per frame or segment files.
+STORE = None
+
+def save_frame_image(data, file_name, stream_type = 'video'):
+    'Save the image DATA of the frame to a file with FILE_NAME. Returns the location it was saved to.'
+    return save_frame_stream(io.BytesIO(data), len(data), file_name, stream_type)
+
+def save_frame_stream(stream, length, file_name, stream_type = 'video'):
+    'Save LENGTH bytes of image data of STREAM_TYPE read from STREAM as FILE_NAME. LENGTH is None if unknown. Returns the location it was saved to.'
+    FRAME_LOG('Frame image save to %s', file_name)
+    start = clock.time()
+    location = STORE.save(stream, length, file_name, stream_type)
+    FRAME_WRITE_SECONDS.observe(clock.time() - start)
+    if length:
+        FRAME_BYTES.inc(length)
+    FRAME_LOG('Saved image to %s', file_name)
+    return location
+
+## When compression is turned on, frames are written to a staging
+## directory instead and handed to the compressor, which stores them
+## and saves their records once they're encoded. Video and depth frames
+## are encoded differently. See compressor.py for details.
+COMPRESSOR = None
 
 ## Every PUT or POST request is handled the same way. The body of the
 ## request is saved in a new file and information about the request
-## and file is stored in the database. The following function is bound
-## to the root URL.
+## and file is stored in the database. The body is copied to the file
+## as it's read instead of being read into memory first. The record is
+## only saved once the whole image is on disk, so a sender that hangs
+## up halfway through doesn't leave a record without an image. The
+## frame is begun in the journal before its image is written, so if
+## the server stops part way, whatever was written is found and set
+## aside when it starts again. That includes a compressed frame, which
+## is begun before it's staged.
+def store_frame(frame, stream, length):
+    'Store LENGTH bytes of image read from STREAM as FRAME, and save its record once it is stored.'
+    if JOURNAL is not None:
+        with span('journal'):
+            JOURNAL.begin(frame.file_name)
+    if COMPRESSOR is None:
+        reader = ChecksumReader(stream)
+        try:
+            with span('read and write image'):
+                frame.location = save_frame_stream(reader, length, frame.file_name, frame.stream)
+        except:
+            if JOURNAL is not None:
+                JOURNAL.abort(frame.file_name)
+            raise
+        frame.checksum = reader.checksum
+        frame.length = reader.length
+        with span('save record'):
+            save_frame_record(frame)
+    else:
+        try:
+            with span('read and stage image'):
+                write_stream_atomically(stream, COMPRESSOR.staging_path(frame.file_name), length)
+        except:
+            if JOURNAL is not None:
+                JOURNAL.abort(frame.file_name)
+            raise
+        with span('submit'):
+            COMPRESSOR.submit(frame)
+
+## A sender says which stream a frame is from with the X-Stream header,
+## and gives the sensor's timestamp for it with the X-Sensor-Time
+## header. The filter passes both headers on. A frame from a sender
+## that doesn't send them is taken to be a depth frame if it is exactly
+## the size of one, and video otherwise.
+class BadStreamHeaderException(Exception):
+    'A request has an invalid stream or sensor time header.'
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+    def __repr__(self):
+        return 'Bad value %s for header %s.' % (self.value, self.key)
+
+DEPTH_FRAME_SIZE = 640 * 480 * 2
+
+def request_stream():
+    'The (stream, sensor time) the headers of the current request give its frame.'
+    stream = request.headers.get('X-Stream')
+    if stream is None:
+        stream = 'depth' if request.content_length == DEPTH_FRAME_SIZE else 'video'
+    elif stream not in frame_stream.STREAMS:
+        raise BadStreamHeaderException('X-Stream', stream)
+    sensor_time = request.headers.get('X-Sensor-Time')
+    if sensor_time is not None:
+        try:
+            sensor_time = int(sensor_time)
+            assert sensor_time >= 0
+        except (ValueError, AssertionError):
+            raise BadStreamHeaderException('X-Sensor-Time', sensor_time)
+    return stream, sensor_time
+
+## The following function is bound to the root URL.
 @app.route('/', methods = ('POST', 'PUT'))
 def save():
     'Save the following frame data.'
     file_name = str(uuid.uuid4()) # Create a random UUID.
-    save_frame_record(FrameMetaData(file_name,
-                                    request.remote_addr,
-                                    time = datetime.datetime.now().replace(microsecond = 0).isoformat()))
-    save_frame_image(request.data, file_name)
+    try:
+        with span('headers'):
+            stream, sensor_time = request_stream()
+        frame = FrameMetaData(file_name,
+                              request.remote_addr,
+                              time = epoch_milliseconds(),
+                              stream = stream,
+                              sensor_time = sensor_time)
+        store_frame(frame, request.stream, request.content_length)
+    except (IncompleteWriteException, BadStreamHeaderException), e:
+        logging.error(repr(e))
+        return 'Failure', 400
     return 'Success'
 
+## A frame stream is a request body holding any number of frames, each
+## with a small header of its own, usually sent chunked over one long
+## lived connection. Every frame is stored as soon as it has arrived, as
+## if it had been sent on its own, and the header is saved with its
+## record. The answer says how many frames were saved, and why the
+## stream was cut short if it was. See frame_stream.py for details.
+@app.route('/stream', methods = ('POST', 'PUT'))
+def save_stream():
+    'Save every frame in the following frame stream.'
+    saved = 0
+    try:
+        for header, pixels in frame_stream.read_frames(request.stream):
+            image = frame_stream.frame_image(header, pixels)
+            frame = FrameMetaData(str(uuid.uuid4()),
+                                  request.remote_addr,
+                                  time = epoch_milliseconds(),
+                                  header = header,
+                                  stream = header.stream,
+                                  sensor_time = header.sensor_time)
+            store_frame(frame, io.BytesIO(image), len(image))
+            saved += 1
+    except (frame_stream.BadFrameHeaderException, frame_stream.TruncatedStreamException), e:
+        logging.error(repr(e))
+        return jsonify(saved = saved, error = repr(e)), 400
+    return jsonify(saved = saved)
+
+## Frames are read back out with GET requests. The /frames URL lists
+## the meta data of frames received between two times, optionally from
+## just one sender, oldest first. Times are milliseconds since the
+## epoch. The start time is included and the end time isn't. A listing
+## is split into pages of at most LIMIT frames. Each page comes with a
+## cursor, which is passed back to get the next page, and is null on
+## the last page. The cursor is the time and name of the last frame on
+## the page, so getting the next page is a seek in the index no matter
+## how deep into the listing it is.
+MAX_PAGE_SIZE = 1000
+
+class BadQueryException(Exception):
+    'A query parameter has an invalid value.'
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+    def __repr__(self):
+        return 'Bad value %s for query parameter %s.' % (self.value, self.key)
+
+def query_int(key, default):
+    'The integer value of the query parameter KEY, or DEFAULT if it was not given.'
+    value = request.args.get(key)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadQueryException(key, value)
+
+## With a partitioned database, frames are looked up in every partition
+## that could hold them. See partitions.py for details. Without one,
+## the only database is the one in the pool.
+PARTITIONS = None
+
+def frame_pools(start = 0, end = None):
+    'The connection pools of every database that could hold frames received in [START, END), oldest first.'
+    if PARTITIONS is None:
+        return [POOL]
+    return [PARTITIONS.pool(path) for path in PARTITIONS.between(start, end)]
+
+@contextlib.contextmanager
+def borrowed(pool):
+    'Borrow a connection from POOL for the body of a with statement.'
+    db = pool.acquire()
+    try:
+        yield db
+    except sqlite3.Error:
+        pool.release(db, discard = True)
+        raise
+    except:
+        pool.release(db)
+        raise
+    else:
+        pool.release(db)
+
+def find_frame_pool(file_name):
+    'The connection pool of the database holding the record of the frame FILE_NAME, or None if there is no record.'
+    for pool in reversed(frame_pools()):
+        with borrowed(pool) as db:
+            if frame_exists(db, file_name):
+                return pool
+    return None
+
+def find_frames(db, origin_machine, start, end, after, limit):
+    'At most LIMIT frames received in [START, END), after the (time, name) pair AFTER if not None, from ORIGIN_MACHINE if not None.'
+    conditions = ['time >= ?', 'time < ?']
+    params = [start, end]
+    if origin_machine is not None:
+        conditions.append('origin_machine = ?')
+        params.append(origin_machine)
+    if after is not None:
+        conditions.append('(time > ? OR (time = ? AND file_name > ?))')
+        params.extend((after[0], after[0], after[1]))
+    params.append(limit)
+    return db.execute('SELECT file_name, origin_machine, time FROM frames WHERE %s ORDER BY time, file_name LIMIT ?' % (' AND '.join(conditions),),
+                      params).fetchall()
+
+def find_frame_location(db, file_name):
+    'The segment location of the frame FILE_NAME, or None if it is not in a segment.'
+    row = plain_cursor(db).execute('SELECT segment, offset, length FROM segment_frames WHERE file_name = ?',
+                                   (file_name,)).fetchone()
+    return SegmentLocation(*row) if row else None
+
+def find_frame_codec(db, file_name):
+    'The codec the frame FILE_NAME was stored with and the key frame it was encoded against.'
+    row = plain_cursor(db).execute('SELECT codec, reference FROM frame_codecs WHERE file_name = ?',
+                                   (file_name,)).fetchone()
+    return row if row else ('raw', None)
+
+def read_frame(db, file_name):
+    'The decoded image data of the frame FILE_NAME.'
+    location = find_frame_location(db, file_name)
+    if location is None:
+        with open(os.path.join(SAVE_LOCATION, file_name), 'rb') as f_obj:
+            data = f_obj.read()
+    else:
+        data = STORE.read(file_name, location)
+    codec, reference = find_frame_codec(db, file_name)
+    return frame_codec.decode(codec,
+                              data,
+                              read_reference(db, reference) if reference else None)
+
+def read_reference(db, file_name):
+    'The decoded image data of the key frame FILE_NAME, which might be in a different partition than DB.'
+    if frame_exists(db, file_name):
+        return read_frame(db, file_name)
+    pool = find_frame_pool(file_name)
+    if pool is None:
+        raise KeyError(file_name)
+    with borrowed(pool) as other:
+        return read_frame(other, file_name)
+
+def frame_exists(db, file_name):
+    'True if there is a record of the frame FILE_NAME.'
+    return plain_cursor(db).execute('SELECT 1 FROM frames WHERE file_name = ?',
+                                    (file_name,)).fetchone() is not None
+
+@app.route('/frames', methods = ('GET',))
+def list_frames():
+    'List the meta data of frames received in a range of time.'
+    try:
+        origin_machine = request.args.get('origin')
+        if origin_machine is not None:
+            if not is_valid_ipv6_address(origin_machine):
+                raise BadQueryException('origin', origin_machine)
+            ## Senders are saved in the form the server sees them in,
+            ## so the given address is put in the same form.
+            origin_machine = socket.inet_ntop(socket.AF_INET6,
+                                              socket.inet_pton(socket.AF_INET6, origin_machine))
+        start = query_int('start', 0)
+        end = query_int('end', epoch_milliseconds() + 1)
+        limit = min(query_int('limit', 100), MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise BadQueryException('limit', limit)
+        after = request.args.get('cursor')
+        if after is not None:
+            try:
+                after_time, after_name = after.split('.', 1)
+                after = (int(after_time), after_name)
+            except ValueError:
+                raise BadQueryException('cursor', after)
+    except BadQueryException, e:
+        logging.error(repr(e))
+        return repr(e), 400
+    ## Partitions hold frames in time order, apart from late records
+    ## in the partition after their own, so once a page is full only
+    ## the next partition still needs a look.
+    frames = []
+    full = False
+    for pool in frame_pools(start, end):
+        with borrowed(pool) as db:
+            frames.extend(find_frames(db, origin_machine, start, end, after, limit))
+        if full:
+            break
+        full = len(frames) >= limit
+    frames.sort(key = lambda frame: (frame.time, frame.file_name))
+    del frames[limit:]
+    cursor = '%d.%s' % (frames[-1].time, frames[-1].file_name) if len(frames) == limit else None
+    return jsonify(frames = [{'file_name' : frame.file_name,
+                              'origin_machine' : frame.origin_machine,
+                              'time' : frame.time}
+                             for frame in frames],
+                   cursor = cursor)
+
+## The /pairs URL lists the depth frames from one sender received
+## between two times, oldest first, each with the video frame that goes
+## with it. The video frame is the one from the same sender received at
+## most WINDOW milliseconds before or after the depth frame whose
+## sensor timestamp is closest to the depth frame's. Frames without a
+## sensor timestamp are paired by the time they were received instead.
+## The sensor's clock is 32 bits and wraps around, so timestamps are
+## compared modulo 2^32. A depth frame with no video frame in its window
+## is paired with null. Pages and cursors work the same as /frames.
+PAIR_WINDOW = 100
+SENSOR_CLOCK = 2 ** 32
+
+def find_stream_frames(db, stream, origin_machine, start, end, after, limit):
+    'At most LIMIT (file name, time, sensor time) rows of STREAM from ORIGIN_MACHINE received in [START, END), after the (time, name) pair AFTER if not None.'
+    conditions = ['origin_machine = ?', 'time >= ?', 'time < ?']
+    params = [origin_machine, start, end]
+    if after is not None:
+        conditions.append('(time > ? OR (time = ? AND file_name > ?))')
+        params.extend((after[0], after[0], after[1]))
+    params.append(limit)
+    return plain_cursor(db).execute('SELECT file_name, time, sensor_time FROM %s_frames WHERE %s ORDER BY time, file_name LIMIT ?' % (stream, ' AND '.join(conditions)),
+                                    params).fetchall()
+
+def frame_distance(first, second):
+    'How far apart the (file name, time, sensor time) rows FIRST and SECOND are, by sensor time if both have one.'
+    if first[2] is None or second[2] is None:
+        return abs(first[1] - second[1])
+    difference = (first[2] - second[2]) % SENSOR_CLOCK
+    return min(difference, SENSOR_CLOCK - difference)
+
+def pair_frames(depth, video, window):
+    'A (depth row, video row or None) pair for every row of DEPTH, with the closest row of VIDEO received within WINDOW milliseconds of it.'
+    times = [row[1] for row in video]
+    pairs = []
+    for row in depth:
+        candidates = video[bisect.bisect_left(times, row[1] - window):bisect.bisect_right(times, row[1] + window)]
+        pairs.append((row, min(candidates, key = lambda other: frame_distance(row, other)) if candidates else None))
+    return pairs
+
+@app.route('/pairs', methods = ('GET',))
+def list_pairs():
+    'List the depth frames from one sender received in a range of time, each paired with its video frame.'
+    try:
+        origin_machine = request.args.get('origin')
+        if origin_machine is None or not is_valid_ipv6_address(origin_machine):
+            raise BadQueryException('origin', origin_machine)
+        origin_machine = socket.inet_ntop(socket.AF_INET6,
+                                          socket.inet_pton(socket.AF_INET6, origin_machine))
+        start = query_int('start', 0)
+        end = query_int('end', epoch_milliseconds() + 1)
+        limit = min(query_int('limit', 100), MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise BadQueryException('limit', limit)
+        window = query_int('window', PAIR_WINDOW)
+        if window < 0:
+            raise BadQueryException('window', window)
+        after = request.args.get('cursor')
+        if after is not None:
+            try:
+                after_time, after_name = after.split('.', 1)
+                after = (int(after_time), after_name)
+            except ValueError:
+                raise BadQueryException('cursor', after)
+    except BadQueryException, e:
+        logging.error(repr(e))
+        return repr(e), 400
+    depth = []
+    full = False
+    for pool in frame_pools(start, end):
+        with borrowed(pool) as db:
+            depth.extend(find_stream_frames(db, 'depth', origin_machine, start, end, after, limit))
+        if full:
+            break
+        full = len(depth) >= limit
+    depth.sort(key = lambda row: (row[1], row[0]))
+    del depth[limit:]
+    video = []
+    if depth:
+        video_start, video_end = depth[0][1] - window, depth[-1][1] + window + 1
+        for pool in frame_pools(video_start, video_end):
+            with borrowed(pool) as db:
+                video.extend(find_stream_frames(db, 'video', origin_machine, video_start, video_end, None, -1))
+        video.sort(key = lambda row: (row[1], row[0]))
+    def describe(row):
+        return None if row is None else {'file_name' : row[0], 'time' : row[1], 'sensor_time' : row[2]}
+    cursor = '%d.%s' % (depth[-1][1], depth[-1][0]) if len(depth) == limit else None
+    return jsonify(pairs = [{'depth' : describe(depth_row), 'video' : describe(video_row)}
+                            for depth_row, video_row in pair_frames(depth, video, window)],
+                   origin_machine = origin_machine,
+                   cursor = cursor)
+
+## The /frames/ URL followed by the name of a frame returns the image
+## data of the frame. Frames in their own file are sent straight from
+## the file. Frames in a segment are sent a chunk at a time from the
+## mapped segment, so neither needs the whole frame in memory. Only
+## compressed frames are decoded into memory before they're sent.
+@app.route('/frames/<file_name>', methods = ('GET',))
+def get_frame(file_name):
+    'Send the image data of the frame FILE_NAME.'
+    if not is_valid_uuid(file_name):
+        abort(404)
+    pool = find_frame_pool(file_name)
+    if pool is None:
+        abort(404)
+    with borrowed(pool) as db:
+        if find_frame_codec(db, file_name)[0] != 'raw':
+            return Response(read_frame(db, file_name), mimetype = 'image/bmp')
+        location = find_frame_location(db, file_name)
+    if location is None:
+        return send_file(os.path.join(SAVE_LOCATION, file_name), mimetype = 'image/bmp')
+    data = STORE.read(file_name, location)
+    def chunks():
+        for offset in range(0, len(data), CHUNK_SIZE):
+            yield str(data[offset:offset + CHUNK_SIZE])
+    return Response(chunks(),
+                    mimetype = 'image/bmp',
+                    headers = {'Content-Length' : str(len(data))})
+
+## The pool keeps counts of how its connections are being used.
+## They're served as JSON so they can be checked on a running server.
+## A partitioned database has a pool for every partition that has been
+## opened, and their counts are served by partition name.
+@app.route('/pool', methods = ('GET',))
+def pool_stats():
+    'Statistics about the database connection pool.'
+    if PARTITIONS is None:
+        return jsonify(POOL.stats())
+    return jsonify(dict((os.path.basename(path), pool.stats())
+                        for path, pool in PARTITIONS.pools.items()))
+
+def pool_connections():
+    'The number of database connections in use and idle, across every pool.'
+    pools = [POOL] if PARTITIONS is None else PARTITIONS.pools.values()
+    counts = {('in_use',) : 0, ('idle',) : 0}
+    for pool in pools:
+        stats = pool.stats()
+        for state in ('in_use', 'idle'):
+            counts[(state,)] += stats[state]
+    return counts
+
+## When a partition is deleted, so are the images of its frames. Frames
+## in their own file are removed one by one. A segment file is removed
+## once nothing was written to it after the end of the partition, since
+## every frame in it is then at least as old as the partition.
+def delete_partition_images(partition):
+    'Delete the images of the frames recorded in PARTITION.'
+    db = connect(partition.path, readonly = True)
+    try:
+        names = [row[0] for row in db.execute('SELECT file_name FROM frames WHERE file_name NOT IN (SELECT file_name FROM segment_frames)')]
+        segments = [row[0] for row in db.execute('SELECT DISTINCT segment FROM segment_frames')]
+    finally:
+        db.close()
+    for name in names:
+        try:
+            os.remove(os.path.join(SAVE_LOCATION, name))
+        except OSError:
+            pass
+    if isinstance(STORE, SegmentStore):
+        for segment in segments:
+            STORE.remove(segment, before = partition.end / 1000.0)
+
+## When the server starts, the frames the journals of the last run
+## left unfinished are dealt with before any new frames come in. A
+## frame whose image is all there and matches its checksum gets its
+## record saved if it never was. A frame whose image is missing, short,
+## or doesn't match loses its record, if it has one, and whatever was
+## written of its image is moved to the quarantine directory, where it
+## can be looked at but is never served. A frame in a segment has
+## nothing to move, and just leaves a hole in its segment. A frame that
+## was waiting to be compressed is only in the staging directory.
+def journal_frame(record):
+    'The FrameMetaData of a RECORD logged in a journal.'
+    return FrameMetaData(str(record['name']),
+                         record['origin'],
+                         record['time'],
+                         location = SegmentLocation(*record['segment']) if 'segment' in record else None,
+                         codec = record['codec'],
+                         reference = record['reference'],
+                         header = frame_stream.FrameHeader(*record['header']) if 'header' in record else None,
+                         checksum = record['checksum'],
+                         length = record['length'],
+                         stream = record.get('stream', 'video'),
+                         sensor_time = record.get('sensor_time'))
+
+def image_is_whole(frame):
+    'True if the stored image of FRAME is all there and matches the checksum it was stored with.'
+    try:
+        data = STORE.read(frame.file_name, frame.location)
+    except (IOError, OSError, ValueError):
+        return False
+    if frame.location is not None and len(data) != frame.location.length:
+        return False
+    if frame.length is not None and len(data) != frame.length:
+        return False
+    return frame.checksum is None or zlib.crc32(data) == frame.checksum
+
+def quarantine_image(file_name):
+    'Move whatever was written of the image of the frame FILE_NAME to the quarantine directory.'
+    directory = os.path.join(SAVE_LOCATION, 'quarantine')
+    staging = os.path.join(SAVE_LOCATION, 'staging')
+    for parent, name in ((SAVE_LOCATION, file_name), (SAVE_LOCATION, '.' + file_name + '.part'),
+                         (staging, file_name), (staging, '.' + file_name + '.part')):
+        path = os.path.join(parent, name)
+        if os.path.exists(path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            os.rename(path, os.path.join(directory, name))
+
+def delete_frame_record(file_name):
+    'Delete the record of the frame FILE_NAME, wherever it is.'
+    pool = find_frame_pool(file_name)
+    if pool is None:
+        return
+    db = sqlite3.connect(pool.db_path)
+    try:
+        for table in ('frames', 'segment_frames', 'frame_codecs', 'frame_sensors', 'video_frames', 'depth_frames'):
+            db.execute('DELETE FROM %s WHERE file_name = ?' % (table,), (file_name,))
+        db.commit()
+    finally:
+        db.close()
+
+def finish_frames(unfinished, writer):
+    'Save the records of the whole frames in the list UNFINISHED with WRITER, and set aside the rest.'
+    repaired = []
+    for entry in unfinished:
+        if entry.record is None:
+            logging.warning('Frame %s was never finished, moving it to quarantine.', entry.name)
+            quarantine_image(entry.name)
+            continue
+        frame = journal_frame(entry.record)
+        if image_is_whole(frame):
+            if find_frame_pool(frame.file_name) is None:
+                repaired.append(frame)
+        else:
+            logging.warning('The image of frame %s is damaged, moving it to quarantine.', frame.file_name)
+            delete_frame_record(frame.file_name)
+            quarantine_image(frame.file_name)
+    writer.save(repaired)
+    if repaired:
+        logging.info('Saved the records of %d frames the last run stored but never saved.', len(repaired))
+
+def recover_frames():
+    'Finish or set aside the frames left unfinished by the journals of the last run.'
+    writer = FrameWriter(DB_PATH, route = frame_route())
+    handled = frame_journal.recover(os.path.join(SAVE_LOCATION, 'journal'),
+                                    lambda unfinished: finish_frames(unfinished, writer))
+    if handled:
+        logging.info('Recovered %d unfinished frames.', handled)
+    STORE.close()
+    POOL.close()
+    if PARTITIONS is not None:
+        PARTITIONS.close()
+
+def frame_route():
+    'The function that picks the database a record is saved to, or None if there is only one.'
+    if PARTITIONS is None:
+        return None
+    return lambda frame: PARTITIONS.writable_path(frame.time)
+
 ## Start the server if this file is run as a command.    
-if __name__ == '__main__':
-    logging.basicConfig(level = logging.DEBUG)
-    parser = argparse.ArgumentParser(description = 'A database service for saving sensor data.')
-    parser.add_argument('--port', help = 'The port to run the server on.', type = is_port_number, default = 5000)
-    parser.add_argument('--save', help = 'The directory to save data to.', type = str, default = default_save_location()) ## TODO! The type argument should not accept invalid paths.
-    args = parser.parse_args()
+## Setting up the server is split in two. Everything that has to
+## happen once, like bringing the database up to date, is done by
+## configure before any worker processes are forked. Everything that
+## starts threads or worker processes is done by start, in every
+## process that serves requests. No database connection is left open
+## by configure, since a sqlite connection can't be used on both sides
+## of a fork.
+def configure(args):
+    'Set up the parts of the server shared by every worker from the parsed command line ARGS.'
+    global SAVE_LOCATION, DB_PATH, POOL, STORE, PARTITIONS
+    logging.basicConfig(level = getattr(logging, args.log_level))
+    FRAME_LOG.configure(getattr(logging, args.frame_log_level), args.frame_log_sample)
     SAVE_LOCATION = args.save
 
     ## Retrieve and load the database file. Initialize a
     ## new database if one doesn't already exist in the
-    ## expected place.
+    ## expected place, and add any missing tables to one
+    ## that does.
+    ## With a partitioned database, the single database is only
+    ## brought up to date if it's left over from before partitioning,
+    ## and its frames are still served. Each partition gets the schema
+    ## when it's made.
     DB_PATH = os.path.join(SAVE_LOCATION, 'DB_FRAMES')
-    try:
-        with file(DB_PATH) as f_obj:
-            pass
-    except IOError:
+    POOL = ConnectionPool(DB_PATH,
+                          max_size = args.pool_size,
+                          row_factory = make_frame_data)
+    if args.partition == 'none' or os.path.exists(DB_PATH):
         init_db()
+        POOL.close()
+    if args.partition != 'none':
+        with app.open_resource('schema.sql', mode = 'r') as f:
+            schema = f.read() + '\nPRAGMA user_version = %d;\n' % (SCHEMA_VERSION,)
+        PARTITIONS = PartitionSet(SAVE_LOCATION,
+                                  period = args.partition,
+                                  schema = schema,
+                                  legacy_path = DB_PATH,
+                                  pool_size = args.pool_size,
+                                  row_factory = make_frame_data)
+
+    ## Segment files are named after the process that started them, so
+    ## workers never append to each other's segments.
+    ## With the frame policy, every image is synced as it's saved.
+    if args.store == 'segments':
+        STORE = SegmentStore(SAVE_LOCATION,
+                             max_size = args.segment_size * 1024 * 1024,
+                             max_age = args.segment_age,
+                             fsync = args.fsync == 'frame')
+    else:
+        STORE = FileStore(SAVE_LOCATION, fsync = args.fsync == 'frame')
+
+    ## Whatever the last run left unfinished is dealt with once, before
+    ## any worker starts logging frames of its own.
+    recover_frames()
 
-    app.run(host = '::', port = args.port)
+    ## With several workers, their metrics are merged through files in
+    ## a directory of their own, which is emptied of the last run's.
+    if args.workers > 1:
+        metrics.clear_shared(metrics_directory(args))
+
+def metrics_directory(args):
+    'The directory the workers share their metrics through.'
+    return os.path.join(SAVE_LOCATION, 'metrics-%d' % (args.port,))
+
+def start(args):
+    'Start the frame writer and compressor of this process from the parsed command line ARGS.'
+    global COMPRESSOR, WRITER, JOURNAL
+    profiling.configure(args.trace_sample,
+                        args.profile_directory or os.path.join(SAVE_LOCATION, 'profiles'),
+                        args.profile_interval)
+    ## Every worker has its own journal. It's closed after the writer,
+    ## so the last batch is marked committed first. Its syncing thread
+    ## is only started once the compressor's worker processes are.
+    JOURNAL = FrameJournal(os.path.join(SAVE_LOCATION, 'journal'),
+                           STORE,
+                           policy = args.fsync,
+                           interval = args.fsync_interval)
+    atexit.register(JOURNAL.close)
+
+    ## The worker processes are started before any threads, since
+    ## forking a process with threads running isn't safe.
+    if args.video_codec != 'raw' or args.depth_codec != 'raw':
+        COMPRESSOR = Compressor(SAVE_LOCATION,
+                                STORE,
+                                save_frame_record,
+                                video_codec = args.video_codec,
+                                depth_codec = args.depth_codec,
+                                processes = args.compress_processes,
+                                keyframe_interval = args.keyframe_interval,
+                                journal = JOURNAL).start()
+    JOURNAL.start()
+    if prefork.WORKER is not None:
+        atexit.register(metrics.share(metrics_directory(args), prefork.WORKER).stop)
+
+    ## Start the frame writer and make sure any queued records are
+    ## saved when the server shuts down. Every worker has its own
+    ## writer; sqlite lets one of them commit at a time and the others
+    ## wait for the lock.
+    WRITER = FrameWriter(DB_PATH,
+                         batch_size = args.batch_size,
+                         batch_latency = args.batch_latency,
+                         route = frame_route(),
+                         journal = JOURNAL).start()
+    atexit.register(WRITER.close)
+    metrics.gauge('kinect_writer_queue_depth', 'Frame records waiting to be saved.',
+                  function = WRITER.queue.qsize)
+    metrics.gauge('kinect_db_pool_connections', 'Database connections by state.', ('state',),
+                  function = pool_connections)
+
+    ## Every worker checks the partitions, but only one at a time does
+    ## anything. Deleting a partition also deletes its images, but an
+    ## archived partition keeps them, so it can be brought back.
+    if PARTITIONS is not None:
+        maintainer = PartitionMaintainer(PARTITIONS,
+                                         retention = args.retention_days * 86400 if args.retention_days else None,
+                                         archive = args.archive,
+                                         on_expire = delete_partition_images).start()
+        atexit.register(maintainer.stop)
+    if COMPRESSOR is not None:
+        atexit.register(COMPRESSOR.close) # Runs before the writer is closed.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'A database service for saving sensor data.')
+    parser.add_argument('--port', help = 'The port to run the server on.', type = is_port_number, default = 5000)
+    parser.add_argument('--save', help = 'The directory to save data to.', type = str, default = default_save_location()) ## TODO! The type argument should not accept invalid paths.
+    parser.add_argument('--batch-size', help = 'The most records saved to the database in one transaction.', type = int, default = 64)
+    parser.add_argument('--batch-latency', help = 'The most seconds a record waits before its batch is saved.', type = float, default = 0.05)
+    parser.add_argument('--store', help = 'How frame images are stored, one file per frame or appended to segment files.', choices = ('files', 'segments'), default = 'files')
+    parser.add_argument('--segment-size', help = 'The most megabytes in a segment file before a new one is started.', type = int, default = 1024)
+    parser.add_argument('--segment-age', help = 'The most seconds a segment file is appended to before a new one is started.', type = float, default = 3600.0)
+    parser.add_argument('--video-codec', help = 'The codec video frames are stored with. Anything but raw turns on compression.', choices = frame_codec.available_codecs(), default = 'raw')
+    parser.add_argument('--depth-codec', help = 'The codec depth frames are stored with. Anything but raw turns on compression.', choices = frame_codec.available_codecs(), default = 'raw')
+    parser.add_argument('--compress-processes', help = 'The number of processes compressing frames. Defaults to the number of CPUs.', type = int, default = None)
+    parser.add_argument('--keyframe-interval', help = 'The number of frames encoded against each depth key frame.', type = int, default = 30)
+    parser.add_argument('--fsync', help = 'When stored images are synced to disk; as each frame is saved, before each batch of records is committed, or every fsync-interval seconds.', choices = FSYNC_POLICIES, default = 'periodic')
+    parser.add_argument('--fsync-interval', help = 'Seconds between syncs with the periodic fsync policy.', type = float, default = 1.0)
+    parser.add_argument('--pool-size', help = 'The most database connections kept open at once.', type = int, default = 8)
+    parser.add_argument('--log-level', help = 'The lowest level of message logged.', choices = LOG_LEVELS, default = 'DEBUG')
+    parser.add_argument('--frame-log-level', help = 'The level messages logged for every frame are logged at.', choices = LOG_LEVELS, default = 'INFO')
+    parser.add_argument('--frame-log-sample', help = 'Only log one of every this many per frame messages.', type = int, default = 1)
+    parser.add_argument('--workers', help = 'The number of processes serving requests.', type = int, default = 1)
+    parser.add_argument('--trace-sample', help = 'Time the stages of one of every this many requests. Zero traces none.', type = int, default = 0)
+    parser.add_argument('--profile-directory', help = 'The directory profiles are saved in. Defaults to profiles in the save directory.', type = str, default = None)
+    parser.add_argument('--profile-interval', help = 'Seconds between samples of the profiler.', type = float, default = 0.005)
+    parser.add_argument('--partition', help = 'Split the database into one file per hour or day of frames.', choices = ('none', 'hour', 'day'), default = 'none')
+    parser.add_argument('--retention-days', help = 'Remove database partitions older than this many days. Keeps them forever if not given.', type = float, default = None)
+    parser.add_argument('--archive', help = 'Compress removed database partitions into this directory instead of deleting them and their images.', type = str, default = None)
+    args = parser.parse_args()
+    configure(args)
+    prefork.serve(app, '::', args.port, args.workers, lambda: start(args))
@@ -10,6 +10,10 @@
 import os
 import os.path
 import socket
+import logging
+import errno
+import ctypes
+import ctypes.util
 
 class UndefinedEnvironmentVariableException(Exception):
     'An environment variable was referenced that does not exist.'
@@ -26,6 +30,15 @@ class UnsupportedSystemException(Exception):
         return 'The detected operating system, %s, is not supported.'
         
 
+class IncompleteWriteException(Exception):
+    'A stream ended before all of the expected data was read from it.'
+    def __init__(self, path, expected, received):
+        self.path = path
+        self.expected = expected
+        self.received = received
+    def __repr__(self):
+        return 'Expected %d bytes for %s but only received %d.' % (self.expected, self.path, self.received)
+
 def default_save_location():
     'The default location to save files on this machine.'    
     if os.name == 'posix':
@@ -73,3 +86,111 @@ def is_port_number(n):
     if not (0 <= int(n) <= (2 << 15) - 1):
         raise argparse.ArgumentError('not a valid port number, out of range')
     return int(n)
+
+## Frames are written to disk straight from the request body, a chunk
+## at a time, so a request never needs more memory than one chunk no
+## matter how big the frame is. The file is written under a temporary
+## name and renamed once it's complete, so a file with a frame's real
+## name is never half written. When the size is known ahead of time,
+## the disk space is reserved up front so the file isn't fragmented as
+## it grows.
+CHUNK_SIZE = 64 * 1024
+
+def _find_posix_fallocate():
+    'Find a posix_fallocate function, or None if the system has none.'
+    if hasattr(os, 'posix_fallocate'):
+        return os.posix_fallocate
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        c_posix_fallocate = libc.posix_fallocate64
+    except (OSError, AttributeError, TypeError):
+        return None
+    c_posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    def posix_fallocate(fd, offset, length):
+        'Reserve disk space for LENGTH bytes of the file FD starting at OFFSET.'
+        error = c_posix_fallocate(fd, offset, length)
+        if error != 0:
+            raise OSError(error, os.strerror(error))
+    return posix_fallocate
+
+_posix_fallocate = _find_posix_fallocate()
+
+def preallocate(fd, length):
+    'Reserve LENGTH bytes of disk for the open file FD if the file system supports it.'
+    if _posix_fallocate is None or not length:
+        return
+    try:
+        _posix_fallocate(fd, 0, length)
+    except OSError, e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise
+
+def write_fully(fd, data):
+    'Write all of DATA to the file FD, even if it takes more than one write.'
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def fsync_path(path):
+    'Sync the file or directory at PATH to disk.'
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+## With SYNC set, the file and its name are both on disk by the time
+## this returns. Otherwise they get there whenever the system gets to
+## them, which can be after the record of the frame is saved.
+def write_stream_atomically(stream, path, length = None, chunk_size = CHUNK_SIZE, sync = False):
+    'Copy STREAM into a new file at PATH a chunk at a time. LENGTH is the number of bytes expected, or None if unknown. Syncs the file to disk if SYNC is set. Returns the number of bytes written.'
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, '.' + name + '.part')
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    try:
+        preallocate(fd, length)
+        written = 0
+        while length is None or written < length:
+            chunk = stream.read(chunk_size if length is None else min(chunk_size, length - written))
+            if not chunk:
+                break
+            write_fully(fd, chunk)
+            written += len(chunk)
+        if length is not None and written != length:
+            raise IncompleteWriteException(path, length, written)
+        if sync:
+            os.fsync(fd)
+    except:
+        os.close(fd)
+        os.unlink(temp_path)
+        raise
+    os.close(fd)
+    os.rename(temp_path, path)
+    if sync:
+        fsync_path(directory or '.')
+    return written
+
+## Some messages are logged for every frame. At frame rate, writing
+## them out costs more than anything else the servers do. They go
+## through the frame logger, which logs them at a level that can be
+## turned down and can be told to only log every Nth message.
+class FrameLogger(object):
+    'Logs per frame messages at a configurable level and rate.'
+    def __init__(self, level = logging.INFO, sample = 1):
+        self.configure(level, sample)
+    def configure(self, level, sample):
+        'Log at LEVEL, and only log one of every SAMPLE messages.'
+        self.level = level
+        self.sample = max(1, sample)
+        self.count = 0
+    def __call__(self, message, *args):
+        ## The count isn't locked, so a message may be skipped or
+        ## repeated now and then when threads race. That's fine for
+        ## sampling.
+        self.count += 1
+        if self.count % self.sample == 0:
+            logging.log(self.level, message, *args)
+
+FRAME_LOG = FrameLogger()
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
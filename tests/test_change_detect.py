@@ -0,0 +1,101 @@
+'Tests for the frame change detector in change_detect.py.'
+
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import change_detect
+from change_detect import ChangeDetector
+from frame_stream import FrameHeader, bmp_header
+
+WIDTH = 64
+HEIGHT = 48
+
+def video(brightness, changed_rows = 0, changed_brightness = 0):
+    'A WIDTH by HEIGHT BMP of one BRIGHTNESS, with its first CHANGED_ROWS rows at CHANGED_BRIGHTNESS.'
+    rows = [chr(changed_brightness) * WIDTH * 3] * changed_rows + [chr(brightness) * WIDTH * 3] * (HEIGHT - changed_rows)
+    return bmp_header(WIDTH, HEIGHT) + ''.join(rows)
+
+def depth(value, changed_rows = 0, changed_value = 0):
+    'A Kinect sized depth frame of VALUE, with its first CHANGED_ROWS rows at CHANGED_VALUE.'
+    width, height = change_detect.DEPTH_WIDTH, change_detect.DEPTH_HEIGHT
+    return (struct.pack('<H', changed_value) * width * changed_rows +
+            struct.pack('<H', value) * width * (height - changed_rows))
+
+def count(frame_sample):
+    'The number of pixels in FRAME_SAMPLE.'
+    values = frame_sample.values
+    return values.size if hasattr(values, 'size') else len(values)
+
+## Every test runs once with NumPy, if it's installed, and once without.
+class WithoutNumpyTest(unittest.TestCase):
+    use_numpy = False
+
+    def setUp(self):
+        change_detect._import_numpy()
+        self.numpy = change_detect.numpy
+        if self.use_numpy and self.numpy is None:
+            self.skipTest('NumPy is not installed.')
+        if not self.use_numpy:
+            change_detect.numpy = None
+        self.detector = ChangeDetector()
+
+    def tearDown(self):
+        change_detect.numpy = self.numpy
+
+    def test_first_frame_is_all_change(self):
+        self.assertEqual(self.detector.change('a', self.detector.sample(video(10))), 1.0)
+
+    def test_video_change(self):
+        self.detector.remember('a', self.detector.sample(video(100)))
+        self.assertEqual(self.detector.change('a', self.detector.sample(video(101))), 0.0)
+        self.assertEqual(self.detector.change('a', self.detector.sample(video(200))), 1.0)
+        self.assertAlmostEqual(self.detector.change('a', self.detector.sample(video(100, 24, 200))), 0.5)
+
+    def test_depth_change(self):
+        self.detector.remember('a', self.detector.sample(depth(1000)))
+        self.assertEqual(self.detector.change('a', self.detector.sample(depth(1010))), 0.0)
+        self.assertAlmostEqual(self.detector.change('a', self.detector.sample(depth(1000, 120, 2000))), 0.25)
+
+    def test_stream_header(self):
+        header = FrameHeader('depth', 16, 16, 2, 0)
+        first = self.detector.sample(struct.pack('<H', 0) * 256, header)
+        second = self.detector.sample(struct.pack('<H', 2000) * 256, header)
+        self.assertEqual(change_detect.change(first, second), 1.0)
+        self.assertEqual(count(first), 4)
+
+    def test_kinds_are_not_compared(self):
+        self.detector.remember('a', self.detector.sample(depth(0)))
+        self.assertEqual(self.detector.change('a', self.detector.sample(video(0))), 1.0)
+
+    def test_unknown_layout(self):
+        self.assertEqual(self.detector.sample('not a frame'), None)
+        self.detector.remember('a', None)
+        self.assertEqual(self.detector.known_sources(), [])
+
+    def test_sources_are_separate(self):
+        self.detector.remember(('::1', 'depth'), self.detector.sample(depth(0)))
+        self.assertEqual(self.detector.change(('::1', 'video'), self.detector.sample(depth(0))), 1.0)
+        self.detector.forget(('::1', 'depth'))
+        self.assertEqual(self.detector.known_sources(), [])
+
+    def test_sample_size(self):
+        self.assertEqual(count(self.detector.sample(video(10))), (WIDTH // 8) * (HEIGHT // 8))
+        self.assertEqual(count(self.detector.sample(depth(10))), 80 * 60)
+
+class WithNumpyTest(WithoutNumpyTest):
+    use_numpy = True
+
+    def test_same_as_without_numpy(self):
+        frames = (video(10, 7, 90), video(12, 30, 11))
+        with_numpy = change_detect.change(*[self.detector.sample(frame) for frame in frames])
+        change_detect.numpy = None
+        without_numpy = change_detect.change(*[self.detector.sample(frame) for frame in frames])
+        self.assertAlmostEqual(with_numpy, without_numpy)
+        self.assertTrue(0 < with_numpy < 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'Tests for compressing frames on a worker pool in compressor.py.'
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import frame_codec
+from compressor import Compressor
+from frame_store import FileStore
+
+class Frame(object):
+    'Just enough of a frame to be compressed.'
+    def __init__(self, file_name, stream, origin_machine = '::1'):
+        self.file_name = file_name
+        self.origin_machine = origin_machine
+        self.stream = stream
+        self.location = None
+        self.codec = None
+        self.reference = None
+
+def depth(value):
+    return struct.pack('<4H', value, value + 1, value + 2, value + 3)
+
+class CompressorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FileStore(self.directory)
+        self.saved = []
+        self.compressor = Compressor(self.directory, self.store, self.saved.append,
+                                     video_codec = 'depth-delta', depth_codec = 'depth-delta',
+                                     processes = 1, keyframe_interval = 2).start()
+
+    def tearDown(self):
+        self.compressor.close()
+        shutil.rmtree(self.directory)
+
+    def submit(self, file_name, stream, data, origin_machine = '::1'):
+        with open(self.compressor.staging_path(file_name), 'wb') as f_obj:
+            f_obj.write(data)
+        self.compressor.submit(Frame(file_name, stream, origin_machine))
+
+    def test_key_frames_kept_per_stream(self):
+        for n, stream in enumerate(('video', 'depth', 'video', 'depth')):
+            self.submit('f%d' % n, stream, depth(n))
+        self.assertEqual(sorted(self.compressor.keyframes), [('::1', 'depth'), ('::1', 'video')])
+        self.compressor.close()
+        saved = dict((frame.file_name, (frame.codec, frame.reference)) for frame in self.saved)
+        self.assertEqual(saved, {'f0' : ('zlib', None),
+                                 'f1' : ('zlib', None),
+                                 'f2' : ('depth-delta', 'f0'),
+                                 'f3' : ('depth-delta', 'f1')})
+
+    def test_stored_frames_decode(self):
+        for n in range(5):
+            self.submit('f%d' % n, 'depth', depth(1000 * n))
+        self.compressor.close()
+        stored = {}
+        for frame in sorted(self.saved, key = lambda frame: frame.file_name):
+            data = self.store.read(frame.file_name, frame.location)
+            reference = stored[frame.reference] if frame.reference else None
+            stored[frame.file_name] = frame_codec.decode(frame.codec, data, reference)
+        self.assertEqual(stored, dict(('f%d' % n, depth(1000 * n)) for n in range(5)))
+        self.assertEqual(os.listdir(self.compressor.keyframe_directory), [])
+
+if __name__ == '__main__':
+    unittest.main()
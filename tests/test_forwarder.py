@@ -0,0 +1,191 @@
+'Tests for the frame queue and destinations in forwarder.py.'
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import BaseHTTPServer
+
+import ipaddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from forwarder import FrameQueue, Destination, Forwarder, QueueFullException, destination_url
+
+class FrameQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def spilled(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_spills_in_order_with_headers(self):
+        queue = FrameQueue(size = 1, spill_directory = self.directory, spill_size = 2)
+        queue.put('a', headers = {'X-Stream' : 'depth'})
+        queue.put('b', headers = {'X-Sensor-Time' : '5'})
+        queue.put('c')
+        self.assertEqual(queue.stats(), {'queued_memory' : 1, 'queued_disk' : 2})
+        self.assertEqual(len(self.spilled()), 2)
+        self.assertEqual([queue.get() for _ in range(3)],
+                         [('a', {'X-Stream' : 'depth'}), ('b', {'X-Sensor-Time' : '5'}), ('c', None)])
+        self.assertEqual(self.spilled(), [])
+
+    def test_drop_newest_when_full(self):
+        queue = FrameQueue(size = 1, spill_directory = self.directory, spill_size = 1)
+        queue.put('a')
+        queue.put('b')
+        self.assertRaises(QueueFullException, queue.put, 'c')
+        self.assertEqual(len(queue), 2)
+
+    def test_drop_oldest_removes_spilled_file(self):
+        queue = FrameQueue(size = 0, overflow = 'drop-oldest', spill_directory = self.directory, spill_size = 1)
+        self.assertEqual(queue.put('a'), 0)
+        self.assertEqual(queue.put('b'), 1)
+        self.assertEqual(len(self.spilled()), 1)
+        self.assertEqual(queue.get(), ('b', None))
+        self.assertEqual(self.spilled(), [])
+
+    def test_closed_queue_gives_none_once_empty(self):
+        queue = FrameQueue()
+        queue.put('a')
+        queue.close()
+        self.assertEqual(queue.get(), ('a', None))
+        self.assertEqual(queue.get(), None)
+
+## The destination is a server on the loopback address that answers
+## with the status codes in STATUSES, one per request, and remembers
+## every request it got.
+class Server(BaseHTTPServer.HTTPServer):
+    address_family = socket.AF_INET6
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.received.append((body, self.headers.getheader('X-Stream')))
+        self.send_response(self.server.statuses.pop(0) if self.server.statuses else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    def log_message(self, *args):
+        pass
+
+class DestinationTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('::1', 0), Handler)
+        self.server.received = []
+        self.server.statuses = []
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = destination_url(ipaddress.ip_address(u'::1'), self.server.server_address[1])
+        self.destination = Destination(url, timeout = 5.0, retries = 2, backoff = 0.01)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries_after_server_error(self):
+        self.server.statuses = [503, 500]
+        self.assertTrue(self.destination.deliver('frame', {'X-Stream' : 'depth'}))
+        self.assertEqual(self.server.received, [('frame', 'depth')] * 3)
+        self.assertEqual(self.destination.stats()['retried'], 2)
+
+    def test_gives_up_after_retries(self):
+        self.server.statuses = [503] * 3
+        self.assertFalse(self.destination.deliver('frame'))
+        self.assertEqual(len(self.server.received), 3)
+        self.assertEqual(self.destination.stats()['dropped'], 1)
+
+    def test_sender_threads_deliver_spilled_frames(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.destination.queue = FrameQueue(size = 1, spill_directory = directory, spill_size = 4)
+            self.server.statuses = [503]
+            self.destination.enqueue('a', {'X-Stream' : 'video'})
+            self.destination.enqueue('b', {'X-Stream' : 'depth'})
+            self.destination.start(1)
+            deadline = time.time() + 5
+            while len(self.server.received) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            self.destination.close()
+            self.assertEqual(self.server.received, [('a', 'video'), ('a', 'video'), ('b', 'depth')])
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+class Rule(object):
+    'Just enough of a routing rule to forward with.'
+    def __init__(self, port, async_forward = False):
+        self.destinations = [(ipaddress.ip_address(u'::1'), port)]
+        self.strategy = 'replicate'
+        self.async_forward = async_forward
+
+def unused_port():
+    'A port on the loopback address nothing is listening on.'
+    sock = socket.socket(socket.AF_INET6)
+    sock.bind(('::1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+## The forwarder is never started, so frames it queues stay queued.
+class ForwardTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('::1', 0), Handler)
+        self.server.received = []
+        self.server.statuses = []
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def queued(self, forwarder, port):
+        return forwarder.destination(ipaddress.ip_address(u'::1'), port).queue
+
+    def test_taken(self):
+        forwarder = Forwarder(timeout = 5.0)
+        self.assertTrue(forwarder.forward(Rule(self.port), 'frame'))
+        self.assertEqual(len(self.queued(forwarder, self.port)), 0)
+
+    def test_turned_away(self):
+        self.server.statuses = [400]
+        forwarder = Forwarder(timeout = 5.0)
+        self.assertFalse(forwarder.forward(Rule(self.port), 'frame'))
+        self.assertEqual(len(self.queued(forwarder, self.port)), 0)
+
+    def test_queued_after_server_error(self):
+        self.server.statuses = [503]
+        forwarder = Forwarder(timeout = 5.0)
+        self.assertTrue(forwarder.forward(Rule(self.port), 'frame', headers = {'X-Stream' : 'depth'}))
+        self.assertEqual(self.queued(forwarder, self.port).get(), ('frame', {'X-Stream' : 'depth'}))
+
+    def test_queued_after_failed_send(self):
+        port = unused_port()
+        forwarder = Forwarder(timeout = 5.0)
+        self.assertTrue(forwarder.forward(Rule(port), 'frame'))
+        self.assertEqual(len(self.queued(forwarder, port)), 1)
+
+    def test_failed_send_with_full_queue(self):
+        port = unused_port()
+        forwarder = Forwarder(timeout = 0.1, queue_size = 0)
+        self.assertFalse(forwarder.forward(Rule(port), 'frame'))
+        self.assertEqual(forwarder.stats()['dropped'], 1)
+
+    def test_server_error_with_full_queue(self):
+        self.server.statuses = [503]
+        forwarder = Forwarder(timeout = 0.1, queue_size = 0)
+        self.assertFalse(forwarder.forward(Rule(self.port), 'frame'))
+        self.assertEqual(forwarder.stats()['dropped'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+'Tests for the lossless frame codecs in frame_codec.py.'
+
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import frame_codec
+from frame_codec import MissingReferenceException, UnknownCodecException
+
+def depth(samples):
+    return struct.pack('<%dH' % len(samples), *samples)
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = depth(range(0, 60000, 7))
+        for codec in frame_codec.available_codecs():
+            if not frame_codec.needs_reference(codec):
+                self.assertEqual(frame_codec.decode(codec, frame_codec.encode(codec, data)), data)
+
+    def test_depth_delta_round_trip(self):
+        reference = depth([1000, 2000, 65535, 0, 1234])
+        data = depth([1001, 1990, 0, 65535, 1234])
+        encoded = frame_codec.encode('depth-delta', data, reference)
+        self.assertEqual(frame_codec.decode('depth-delta', encoded, reference), data)
+
+    def test_depth_delta_without_numpy(self):
+        numpy, frame_codec.numpy = frame_codec.numpy, None
+        try:
+            reference = depth([5, 65535, 7])
+            data = depth([65535, 5, 7])
+            encoded = frame_codec.encode('depth-delta', data, reference)
+            self.assertEqual(frame_codec.decode('depth-delta', encoded, reference), data)
+        finally:
+            frame_codec.numpy = numpy
+
+    def test_depth_delta_needs_reference(self):
+        data = depth([1, 2, 3])
+        self.assertRaises(MissingReferenceException, frame_codec.encode, 'depth-delta', data)
+        self.assertRaises(MissingReferenceException, frame_codec.encode, 'depth-delta', data, depth([1, 2]))
+        self.assertRaises(MissingReferenceException, frame_codec.decode, 'depth-delta', data)
+
+    def test_can_delta(self):
+        self.assertTrue(frame_codec.can_delta('abcd', 'efgh'))
+        self.assertFalse(frame_codec.can_delta('abcd', None))
+        self.assertFalse(frame_codec.can_delta('abc', 'efg'))
+
+    def test_unknown_codec(self):
+        self.assertRaises(UnknownCodecException, frame_codec.encode, 'lzma', 'data')
+        self.assertRaises(UnknownCodecException, frame_codec.decode, 'lzma', 'data')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+'Tests for the write ahead journal of stored frames in frame_journal.py.'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import frame_journal
+from frame_journal import FrameJournal
+
+class Frame(object):
+    'Just enough of a frame record to be logged.'
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.origin_machine = '::1'
+        self.time = 1000
+        self.codec = 'raw'
+        self.reference = None
+        self.checksum = 0
+        self.length = 0
+        self.stream = 'video'
+        self.sensor_time = None
+        self.location = None
+        self.header = None
+
+class Store(object):
+    'A frame store that remembers what it was asked to sync.'
+    def __init__(self):
+        self.synced = []
+    def sync(self, frames):
+        self.synced.extend(name for name, _ in frames)
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = Store()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, policy = 'batch'):
+        return FrameJournal(self.directory, self.store, policy = policy)
+
+    def unfinished(self):
+        found = []
+        for paths in frame_journal.journals(self.directory):
+            found.extend(frame_journal.unfinished_frames(paths))
+        return dict((entry.name, entry.record) for entry in found)
+
+    def test_begun_frame_is_unfinished(self):
+        journal = self.journal()
+        journal.begin('a')
+        journal.close()
+        self.assertEqual(self.unfinished(), {'a' : None})
+
+    def test_stored_frame_keeps_its_record(self):
+        journal = self.journal()
+        journal.begin('a')
+        journal.stored(Frame('a'))
+        journal.close()
+        unfinished = self.unfinished()
+        self.assertEqual(list(unfinished), ['a'])
+        self.assertEqual(unfinished['a']['origin'], '::1')
+
+    def test_committed_and_aborted_frames_are_finished(self):
+        journal = self.journal()
+        for name in ('a', 'b', 'c'):
+            journal.begin(name)
+        journal.stored(Frame('a'))
+        journal.before_commit([Frame('a')])
+        journal.committed([Frame('a')])
+        journal.abort('b')
+        journal.close()
+        self.assertEqual(self.unfinished(), {'c' : None})
+        self.assertEqual(self.store.synced, ['a'])
+
+    def test_periodic_commit_needs_a_sync(self):
+        journal = self.journal('periodic')
+        journal.begin('a')
+        journal.stored(Frame('a'))
+        journal.committed([Frame('a')])
+        self.assertEqual(self.unfinished().keys(), ['a'])
+        journal.sync()
+        self.assertEqual(self.unfinished(), {})
+        journal.close()
+
+    def test_journal_removed_once_everything_is_committed(self):
+        journal = self.journal()
+        journal.begin('a')
+        journal.stored(Frame('a'))
+        journal.committed([Frame('a')])
+        journal.close()
+        self.assertEqual(frame_journal.journals(self.directory), [])
+
+    def test_damaged_line_is_skipped(self):
+        journal = self.journal()
+        journal.begin('a')
+        journal.close()
+        path = frame_journal.journals(self.directory)[0][0]
+        with open(path, 'ab') as f_obj:
+            f_obj.write('{"begin" : "b')
+        self.assertEqual(self.unfinished(), {'a' : None})
+
+    def test_recover_hands_over_and_deletes(self):
+        journal = self.journal()
+        journal.begin('a')
+        journal.begin('b')
+        journal.stored(Frame('b'))
+        journal.close()
+        finished = []
+        self.assertEqual(frame_journal.recover(self.directory, finished.extend), 2)
+        self.assertEqual(sorted((entry.name, entry.record is None) for entry in finished),
+                         [('a', True), ('b', False)])
+        self.assertEqual(frame_journal.journals(self.directory), [])
+        self.assertEqual(frame_journal.recover(self.directory, finished.extend), 0)
+
+    def test_frame_spanning_files(self):
+        journal = FrameJournal(self.directory, self.store, max_size = 1)
+        journal.begin('a')
+        journal.stored(Frame('a')) # Starts a new file.
+        journal.begin('b')
+        journal.close()
+        self.assertEqual(len(frame_journal.journals(self.directory)[0]), 2)
+        self.assertEqual(sorted(self.unfinished()), ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
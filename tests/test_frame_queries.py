@@ -0,0 +1,139 @@
+'Tests for listing frames and pairs of frames across database partitions in sql_server.py.'
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sql_server
+from sql_server import FrameMetaData
+from partitions import PartitionSet
+from frame_writer import FrameWriter
+
+HOUR = 3600 * 1000
+ORIGIN = '2001:db8::1'
+
+## Every test gets a fresh partitioned database, without the writer or
+## anything else start would make, since the listings only read it.
+class QueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(os.path.dirname(sql_server.__file__), 'schema.sql')) as f_obj:
+            schema = f_obj.read()
+        self.partitions = PartitionSet(self.directory, period = 'hour', schema = schema,
+                                       legacy_path = os.path.join(self.directory, 'DB_FRAMES'),
+                                       row_factory = sql_server.make_frame_data)
+        self.saved = (getattr(sql_server, 'SAVE_LOCATION', None), sql_server.PARTITIONS)
+        sql_server.SAVE_LOCATION = self.directory
+        sql_server.PARTITIONS = self.partitions
+        self.writer = FrameWriter(None, route = lambda frame: self.partitions.writable_path(frame.time))
+        self.client = sql_server.app.test_client()
+
+    def tearDown(self):
+        sql_server.SAVE_LOCATION, sql_server.PARTITIONS = self.saved
+        self.partitions.close()
+        shutil.rmtree(self.directory)
+
+    def save(self, frames):
+        self.writer.save(frames)
+
+    def save_late(self, frames, time_ms):
+        'Save FRAMES to the partition of TIME_MS, as if their own was sealed when they were written.'
+        FrameWriter(self.partitions.writable_path(time_ms)).save(frames)
+
+    def get(self, path):
+        answer = self.client.get(path)
+        self.assertEqual(answer.status_code, 200, answer.data)
+        return json.loads(answer.data)
+
+    def pages(self, path, key):
+        'Every item under KEY of every page of the listing at PATH.'
+        items = []
+        cursor = None
+        while True:
+            page = self.get(path + ('&cursor=%s' % cursor if cursor else ''))
+            items.extend(page[key])
+            cursor = page['cursor']
+            if cursor is None:
+                return items
+
+def frame(n, time_ms, origin = ORIGIN, stream = 'video', sensor_time = None):
+    return FrameMetaData('00000000-0000-0000-0000-%012d' % n, origin, time_ms,
+                         stream = stream, sensor_time = sensor_time)
+
+class ListFramesTest(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        self.frames = [frame(n, (n // 3) * HOUR + n, origin = ORIGIN if n % 2 else '2001:db8::2')
+                       for n in range(12)]
+        self.save(self.frames)
+
+    def names(self, frames):
+        return [item['file_name'] for item in frames]
+
+    def test_pages_span_partitions(self):
+        self.assertEqual(len(self.partitions.partitions()), 4)
+        for limit in (1, 2, 5, 12, 100):
+            listed = self.pages('/frames?start=0&limit=%d' % limit, 'frames')
+            self.assertEqual(self.names(listed), [f.file_name for f in self.frames])
+
+    def test_range_and_origin(self):
+        listed = self.pages('/frames?start=%d&end=%d&origin=2001:0db8::1&limit=2' % (HOUR, 3 * HOUR), 'frames')
+        self.assertEqual(self.names(listed), [f.file_name for f in self.frames[3:9] if f.origin_machine == ORIGIN])
+
+    def test_late_records_are_listed_in_order(self):
+        late = [frame(100, 2 * HOUR - 1), frame(101, HOUR + 4)]
+        self.save_late(late, 2 * HOUR)
+        listed = self.pages('/frames?start=%d&end=%d&limit=2' % (HOUR, 2 * HOUR), 'frames')
+        self.assertEqual(self.names(listed),
+                         [f.file_name for f in self.frames[3:5] + [late[1]] + self.frames[5:6] + [late[0]]])
+
+    def test_bad_queries(self):
+        for query in ('limit=0', 'limit=x', 'cursor=nodot', 'origin=192.0.2.1'):
+            self.assertEqual(self.client.get('/frames?' + query).status_code, 400)
+
+## Depth frames every 100 milliseconds, each followed by its video
+## frame 60 milliseconds later. The video frame of the depth frame
+## before is closer in received time, but not in sensor time.
+class ListPairsTest(QueryTestCase):
+    def setUp(self):
+        QueryTestCase.setUp(self)
+        start = HOUR - 350
+        self.depth = [frame(n, start + 100 * n, stream = 'depth', sensor_time = 1000 * n) for n in range(8)]
+        self.video = [frame(100 + n, start + 100 * n + 60, stream = 'video', sensor_time = 1000 * n - 10)
+                      for n in range(8)]
+        self.save(self.depth + self.video)
+
+    def pairs(self, query):
+        return [(pair['depth']['file_name'], pair['video'] and pair['video']['file_name'])
+                for pair in self.pages('/pairs?origin=%s&%s' % (ORIGIN, query), 'pairs')]
+
+    def test_pages_span_partitions(self):
+        self.assertEqual(len(self.partitions.partitions()), 2)
+        expected = [(d.file_name, v.file_name) for d, v in zip(self.depth, self.video)]
+        for limit in (1, 3, 8, 100):
+            self.assertEqual(self.pairs('limit=%d' % limit), expected)
+
+    def test_closest_sensor_time_wins(self):
+        ## The video frame received before the depth frame is only 40
+        ## milliseconds away, but its sensor time is 1010 away.
+        pairs = self.pairs('start=%d&window=70&limit=2' % self.depth[1].time)
+        self.assertEqual(pairs[0], (self.depth[1].file_name, self.video[1].file_name))
+
+    def test_no_video_in_window(self):
+        self.assertEqual(self.pairs('window=10&limit=3'), [(d.file_name, None) for d in self.depth])
+
+    def test_sensor_clock_wraps(self):
+        self.assertEqual(sql_server.frame_distance(('a', 0, 2 ** 32 - 5), ('b', 0, 5)), 10)
+        self.assertEqual(sql_server.frame_distance(('a', 10, None), ('b', 3, 5)), 7)
+
+    def test_origin_is_required(self):
+        self.assertEqual(self.client.get('/pairs').status_code, 400)
+        self.assertEqual(self.client.get('/pairs?origin=%s&window=-1' % ORIGIN).status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
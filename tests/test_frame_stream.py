@@ -0,0 +1,79 @@
+'Tests for reading and writing frame streams in frame_stream.py.'
+
+import io
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import frame_stream
+from frame_stream import FrameHeader, BadFrameHeaderException, TruncatedStreamException
+
+def frame(stream, width, height, pixel_size, sensor_time, fill = 'x'):
+    'The bytes of one frame of a frame stream.'
+    header = FrameHeader(stream, width, height, pixel_size, sensor_time)
+    return header.pack() + fill * header.length
+
+class HeaderTest(unittest.TestCase):
+    def test_round_trip(self):
+        header = frame_stream.unpack_header(FrameHeader('depth', 640, 480, 2, 123456789).pack())
+        self.assertEqual((header.stream, header.width, header.height, header.pixel_size, header.sensor_time, header.length),
+                         ('depth', 640, 480, 2, 123456789, 640 * 480 * 2))
+
+    def test_bad_magic(self):
+        data = 'XX' + FrameHeader('video', 2, 2, 3, 0).pack()[2:]
+        self.assertRaises(BadFrameHeaderException, frame_stream.unpack_header, data)
+
+    def test_unknown_stream(self):
+        data = frame_stream.HEADER.pack(frame_stream.MAGIC, len(frame_stream.STREAMS), 3, 2, 2, 0, 12)
+        self.assertRaises(BadFrameHeaderException, frame_stream.unpack_header, data)
+
+    def test_length_must_match_size(self):
+        data = frame_stream.HEADER.pack(frame_stream.MAGIC, 0, 3, 2, 2, 0, 11)
+        self.assertRaises(BadFrameHeaderException, frame_stream.unpack_header, data)
+
+    def test_video_pixels_must_be_3_bytes(self):
+        data = FrameHeader('video', 2, 2, 4, 0).pack()
+        self.assertRaises(BadFrameHeaderException, frame_stream.unpack_header, data)
+
+class ReadFramesTest(unittest.TestCase):
+    def test_reads_every_frame(self):
+        data = frame('video', 2, 2, 3, 1, 'v') + frame('depth', 2, 2, 2, 2, 'd')
+        frames = list(frame_stream.read_frames(io.BytesIO(data)))
+        self.assertEqual([(header.stream, header.sensor_time, pixels) for header, pixels in frames],
+                         [('video', 1, 'v' * 12), ('depth', 2, 'd' * 8)])
+
+    def test_empty_stream(self):
+        self.assertEqual(list(frame_stream.read_frames(io.BytesIO(''))), [])
+
+    def test_truncated_header(self):
+        data = frame('video', 2, 2, 3, 1)[:5]
+        self.assertRaises(TruncatedStreamException, list, frame_stream.read_frames(io.BytesIO(data)))
+
+    def test_truncated_pixels(self):
+        data = frame('video', 2, 2, 3, 1)[:-1]
+        self.assertRaises(TruncatedStreamException, list, frame_stream.read_frames(io.BytesIO(data)))
+
+    def test_video_image_gets_bmp_header(self):
+        header = FrameHeader('video', 2, 2, 3, 0)
+        image = frame_stream.frame_image(header, 'p' * 12)
+        self.assertTrue(image.startswith('BM'))
+        self.assertEqual(len(image), 54 + 16)
+        self.assertEqual(frame_stream.frame_image(FrameHeader('depth', 2, 2, 2, 0), 'd' * 8), 'd' * 8)
+
+    def test_video_rows_are_padded(self):
+        header = FrameHeader('video', 3, 2, 3, 0)
+        image = frame_stream.frame_image(header, 'a' * 9 + 'b' * 9)
+        self.assertEqual(image[54:], 'a' * 9 + '\0' * 3 + 'b' * 9 + '\0' * 3)
+        file_size, = struct.unpack_from('<I', image, 2)
+        image_size, = struct.unpack_from('<I', image, 34)
+        self.assertEqual((file_size, image_size), (len(image), 24))
+
+    def test_video_rows_without_padding(self):
+        header = FrameHeader('video', 4, 1, 3, 0)
+        self.assertEqual(frame_stream.frame_image(header, 'p' * 12)[54:], 'p' * 12)
+
+if __name__ == '__main__':
+    unittest.main()
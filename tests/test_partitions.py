@@ -0,0 +1,141 @@
+'Tests for the time partitioned frames database in partitions.py.'
+
+import os
+import sys
+import gzip
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from partitions import PartitionSet, PartitionMaintainer, parse_partition
+from db_pool import connect
+
+HOUR = 3600 * 1000
+SCHEMA = 'CREATE TABLE IF NOT EXISTS frames(file_name, origin_machine, time);'
+
+class PartitionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.partitions = PartitionSet(self.directory, period = 'hour', schema = SCHEMA,
+                                       legacy_path = os.path.join(self.directory, 'DB_FRAMES'), grace = 60.0)
+
+    def tearDown(self):
+        self.partitions.close()
+        for name in os.listdir(self.partitions.directory):
+            os.chmod(os.path.join(self.partitions.directory, name), 0644)
+        shutil.rmtree(self.directory)
+
+    def add(self, time_ms):
+        'Save a frame received at TIME_MS to its partition. Returns the path of the partition.'
+        path = self.partitions.writable_path(time_ms)
+        db = connect(path)
+        try:
+            db.execute('INSERT INTO frames VALUES (?, ?, ?)', ('frame-%d' % time_ms, '::1', time_ms))
+            db.commit()
+        finally:
+            db.close()
+        return path
+
+    def names(self):
+        return [os.path.basename(partition.path) for partition in self.partitions.partitions()]
+
+class PartitionSetTest(PartitionTestCase):
+    def test_named_by_period(self):
+        self.add(0)
+        self.add(HOUR + 5)
+        self.add(HOUR - 1)
+        self.assertEqual(self.names(), ['frames-1970010100.db', 'frames-1970010101.db'])
+        partition = self.partitions.for_time(HOUR + 5)
+        self.assertEqual((partition.start, partition.end), (HOUR, 2 * HOUR))
+        self.assertEqual(parse_partition(partition.path).start, HOUR)
+        self.assertEqual(parse_partition('/tmp/frames.db'), None)
+
+    def test_between_includes_the_next_partition(self):
+        for n in range(4):
+            self.add(n * HOUR)
+        paths = [os.path.basename(path) for path in self.partitions.between(HOUR, 2 * HOUR)]
+        self.assertEqual(paths, ['frames-1970010101.db', 'frames-1970010102.db'])
+        self.assertEqual(len(self.partitions.between(HOUR)), 3)
+
+    def test_between_searches_legacy_database_first(self):
+        self.add(0)
+        connect(self.partitions.legacy_path).close()
+        self.assertEqual(self.partitions.between(0)[0], self.partitions.legacy_path)
+
+    def test_late_record_goes_to_current_partition(self):
+        path = self.add(0)
+        self.assertTrue(self.partitions.seal(parse_partition(path)))
+        self.assertNotEqual(self.partitions.writable_path(5), path)
+
+class SealTest(PartitionTestCase):
+    def test_seal_makes_read_only(self):
+        path = self.add(0)
+        partition = parse_partition(path)
+        self.assertTrue(self.partitions.seal(partition))
+        self.assertTrue(partition.sealed())
+        self.assertEqual(os.listdir(self.partitions.directory), ['frames-1970010100.db'])
+        pool = self.partitions.pool(path)
+        self.assertTrue(pool.readonly)
+        db = pool.acquire()
+        try:
+            self.assertEqual(db.execute('SELECT count(*) FROM frames').fetchone()[0], 1)
+            self.assertRaises(sqlite3.OperationalError, db.execute, 'INSERT INTO frames VALUES (1, 2, 3)')
+        finally:
+            pool.release(db)
+
+    def test_seal_waits_while_in_use(self):
+        path = self.add(0)
+        partition = parse_partition(path)
+        db = connect(path)
+        db.execute('SELECT count(*) FROM frames').fetchone()
+        try:
+            self.assertFalse(self.partitions.seal(partition))
+            self.assertFalse(partition.sealed())
+        finally:
+            db.close()
+        self.assertTrue(self.partitions.seal(partition))
+
+class MaintainerTest(PartitionTestCase):
+    def test_seals_after_grace(self):
+        self.add(0)
+        self.add(HOUR)
+        maintainer = PartitionMaintainer(self.partitions)
+        maintainer.check(now = (HOUR + 30 * 1000) / 1000.0)
+        self.assertEqual([partition.sealed() for partition in self.partitions.partitions()], [False, False])
+        maintainer.check(now = (HOUR + 60 * 1000) / 1000.0)
+        self.assertEqual([partition.sealed() for partition in self.partitions.partitions()], [True, False])
+
+    def test_retention_deletes(self):
+        for n in range(3):
+            self.add(n * HOUR)
+        expired = []
+        maintainer = PartitionMaintainer(self.partitions, retention = 3600, on_expire = expired.append)
+        maintainer.check(now = 3 * HOUR / 1000.0)
+        self.assertEqual(self.names(), ['frames-1970010102.db'])
+        self.assertEqual([partition.start for partition in expired], [0, HOUR])
+
+    def test_retention_archives(self):
+        self.add(0)
+        self.add(2 * HOUR)
+        archive = os.path.join(self.directory, 'archive')
+        expired = []
+        maintainer = PartitionMaintainer(self.partitions, retention = 3600, archive = archive, on_expire = expired.append)
+        maintainer.check(now = 2 * HOUR / 1000.0)
+        self.assertEqual(self.names(), ['frames-1970010102.db'])
+        self.assertEqual(expired, [])
+        self.assertEqual(os.listdir(archive), ['frames-1970010100.db.gz'])
+        copy = os.path.join(self.directory, 'copy.db')
+        with gzip.open(os.path.join(archive, 'frames-1970010100.db.gz'), 'rb') as source:
+            with open(copy, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+        db = sqlite3.connect(copy)
+        try:
+            self.assertEqual(db.execute('SELECT file_name FROM frames').fetchall(), [('frame-0',)])
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+'Tests for the request tracer and sampling profiler in profiling.py.'
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import unittest
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import profiling
+from profiling import Tracer, SamplingProfiler, span
+
+def folded(text):
+    'The weight of every stack in the folded stack format TEXT.'
+    return dict((line.rsplit(' ', 1)[0], int(line.rsplit(' ', 1)[1])) for line in text.splitlines())
+
+class TracerTest(unittest.TestCase):
+    def traced_request(self, tracer):
+        tracer.begin('upload')
+        with span('read'):
+            time.sleep(0.002)
+            with span('write'):
+                time.sleep(0.002)
+        tracer.end()
+
+    def test_spans_are_nested_and_timed(self):
+        tracer = Tracer(sample = 1)
+        self.traced_request(tracer)
+        stacks = folded(tracer.folded())
+        self.assertEqual(sorted(stacks), ['upload', 'upload;read', 'upload;read;write'])
+        self.assertTrue(stacks['upload;read;write'] >= 1500)
+        self.assertTrue(stacks['upload;read'] >= 1500)
+        trace = tracer.stats()['traces'][0]
+        self.assertEqual([entry['stage'] for entry in trace], ['upload', 'upload;read', 'upload;read;write'])
+        self.assertEqual(tracer.stats()['pid'], os.getpid())
+
+    def test_only_sampled_requests_are_traced(self):
+        tracer = Tracer(sample = 3)
+        for _ in range(6):
+            self.traced_request(tracer)
+        self.assertEqual(len(tracer.stats()['traces']), 2)
+
+    def test_span_outside_trace_does_nothing(self):
+        tracer = Tracer(sample = 0)
+        self.traced_request(tracer)
+        self.assertEqual(tracer.folded(), '')
+        with span('anything'):
+            pass
+
+    def test_reset_forgets(self):
+        tracer = Tracer(sample = 1)
+        self.traced_request(tracer)
+        tracer.reset(0)
+        self.assertEqual(tracer.folded(), '')
+        self.assertEqual(tracer.stats()['traces'], [])
+
+class SamplingProfilerTest(unittest.TestCase):
+    def test_samples_other_threads(self):
+        profiler = SamplingProfiler(interval = 0.001).start()
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            pass
+        profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertTrue(profiler.stats()['samples'] > 0)
+        stacks = folded(profiler.folded())
+        self.assertTrue(any(stack.startswith('MainThread;') and 'test_samples_other_threads' in stack
+                            for stack in stacks))
+
+class DebugURLTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        profiling.configure(sample = 1, directory = self.directory, interval = 0.001)
+        self.app = Flask(__name__)
+        profiling.instrument(self.app)
+        @self.app.route('/')
+        def index():
+            with span('work'):
+                return 'ok'
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        profiling.PROFILER.stop()
+        profiling.configure()
+        shutil.rmtree(self.directory)
+
+    def get(self, path, address = '::1', method = 'get'):
+        return getattr(self.client, method)(path, environ_base = {'REMOTE_ADDR' : address})
+
+    def test_requests_are_traced(self):
+        self.get('/')
+        self.assertEqual(sorted(folded(self.get('/debug/trace/folded').data)), ['index', 'index;work'])
+
+    def test_only_local_requests(self):
+        self.assertEqual(self.get('/debug/trace', address = '2001:db8::1').status_code, 404)
+        self.assertEqual(self.get('/debug/trace').status_code, 200)
+
+    def test_change_sample(self):
+        self.assertEqual(self.get('/debug/trace?sample=-1', method = 'post').status_code, 400)
+        self.assertEqual(json.loads(self.get('/debug/trace?sample=5', method = 'post').data)['sample'], 5)
+
+    def test_profile_saved_on_delete(self):
+        self.assertTrue(json.loads(self.get('/debug/profile', method = 'post').data)['running'])
+        time.sleep(0.05)
+        answer = json.loads(self.get('/debug/profile', method = 'delete').data)
+        self.assertFalse(answer['running'])
+        self.assertEqual(os.path.dirname(answer['path']), self.directory)
+        self.assertTrue(os.path.getsize(answer['path']) > 0)
+
+def wait_for(predicate, timeout = 10.0):
+    'Wait until PREDICATE is true. Returns its last value.'
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+class SignalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+        if profiling.PROFILER is not None:
+            profiling.PROFILER.stop()
+        profiling.configure()
+        shutil.rmtree(self.directory)
+
+    def profiles(self):
+        return [name for name in os.listdir(self.directory) if name.endswith('.folded')]
+
+    def test_signal_without_directory_does_not_kill(self):
+        profiling.configure(directory = None, interval = 0.001)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(wait_for(lambda: profiling.PROFILER.running))
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(wait_for(lambda: not profiling.PROFILER.running))
+
+    def test_signal_saves_profile(self):
+        profiling.configure(directory = self.directory, interval = 0.001)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(wait_for(lambda: profiling.PROFILER.running))
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(wait_for(lambda: len(self.profiles()) == 1))
+
+    ## The server runs in a process of its own, which forks two workers
+    ## that each save a profile when the parent is signalled twice.
+    def test_prefork_parent_relays_signal(self):
+        sock = socket.socket(socket.AF_INET6)
+        sock.bind(('::1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = subprocess.Popen([sys.executable, '-c', SERVER, SOURCE, self.directory, str(port)])
+        try:
+            self.assertTrue(wait_for(lambda: len([name for name in os.listdir(self.directory)
+                                                  if name.startswith('ready')]) == 2))
+            server.send_signal(signal.SIGUSR2)
+            time.sleep(0.2)
+            server.send_signal(signal.SIGUSR2)
+            self.assertTrue(wait_for(lambda: len(self.profiles()) == 2), os.listdir(self.directory))
+            self.assertEqual(server.poll(), None)
+        finally:
+            server.terminate()
+            server.wait()
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+## A server whose workers mark themselves ready once they can be
+## signalled. Given the source directory, profile directory, and port.
+SERVER = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+from flask import Flask
+import prefork, profiling
+def start():
+    profiling.configure(directory = sys.argv[2], interval = 0.001)
+    open(os.path.join(sys.argv[2], 'ready-%d' % os.getpid()), 'w').close()
+prefork.serve(Flask(__name__), '::1', int(sys.argv[3]), 2, start)
+"""
+
+if __name__ == '__main__':
+    unittest.main()
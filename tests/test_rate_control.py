@@ -0,0 +1,88 @@
+'Tests for the adaptive rate controller in rate_control.py.'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rate_control import AdaptiveRate, RateController
+
+class Clock(object):
+    'A clock that only moves when told to.'
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+URL = 'http://[::1]:5001/'
+OTHER = 'http://[::1]:5002/'
+
+class AdaptiveRateTest(unittest.TestCase):
+    def setUp(self):
+        self.rate = AdaptiveRate(10.0, 1.0, 12.0, 1.0, 0.5)
+
+    def test_quick_window_adds(self):
+        self.rate.observe(0.01, True)
+        self.rate.adjust(0.05, 0.05)
+        self.assertEqual(self.rate.rate, 11.0)
+        self.rate.observe(0.01, True)
+        self.rate.adjust(0.05, 0.05)
+        self.rate.observe(0.01, True)
+        self.rate.adjust(0.05, 0.05)
+        self.assertEqual(self.rate.rate, 12.0) # Never over the max rate.
+
+    def test_slow_window_multiplies(self):
+        self.rate.observe(0.2, True)
+        self.rate.adjust(0.05, 0.05)
+        self.assertEqual(self.rate.rate, 5.0)
+        self.assertEqual(self.rate.congested, 1)
+        for _ in range(5):
+            self.rate.observe(0.2, True)
+            self.rate.adjust(0.05, 0.05)
+        self.assertEqual(self.rate.rate, 1.0) # Never under the min rate.
+
+    def test_failing_window_multiplies(self):
+        for ok in (True, True, True, False):
+            self.rate.observe(0.01, ok)
+        self.rate.adjust(0.05, 0.2)
+        self.assertEqual(self.rate.rate, 5.0)
+
+    def test_empty_window_keeps_rate(self):
+        self.rate.adjust(0.05, 0.05)
+        self.assertEqual(self.rate.rate, 10.0)
+        self.assertEqual(self.rate.congested, 0)
+
+class RateControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.controller = RateController(target_latency = 0.05, max_error_rate = 0.05, min_rate = 1.0,
+                                         max_rate = 8.0, increase = 1.0, decrease = 0.5, window = 1.0,
+                                         clock = self.clock)
+
+    def test_starts_at_max_rate(self):
+        self.assertEqual(self.controller.delay([URL]), 1.0 / 8.0)
+
+    def test_adjusts_once_a_window(self):
+        self.controller.observe(URL, 0.5, True)
+        self.clock.now = 0.5
+        self.controller.observe(URL, 0.5, True)
+        self.assertEqual(self.controller.rates(), {(URL,) : 8.0})
+        self.clock.now = 1.0
+        self.assertEqual(self.controller.delay([URL]), 1.0 / 4.0)
+        self.assertEqual(self.controller.stats(URL), {'rate' : 4.0, 'congested_windows' : 1})
+        self.controller.observe(URL, 0.01, True)
+        self.clock.now = 2.0
+        self.assertEqual(self.controller.delay([URL]), 1.0 / 5.0)
+
+    def test_slowest_destination_wins(self):
+        self.controller.observe(URL, 0.01, True)
+        self.controller.observe(OTHER, 0.01, False)
+        self.clock.now = 1.0
+        self.assertEqual(self.controller.delay([URL, OTHER]), 1.0 / 4.0)
+
+    def test_rule_delay_is_the_floor(self):
+        self.assertEqual(self.controller.delay([URL], floor = 2.0), 2.0)
+
+if __name__ == '__main__':
+    unittest.main()
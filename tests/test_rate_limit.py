@@ -0,0 +1,111 @@
+'Tests for the delay trackers in rate_limit.py.'
+
+import os
+import sys
+import unittest
+
+import ipaddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rate_limit import DelayTracker, SharedDelayTracker, monotonic
+
+class Clock(object):
+    'A clock that only moves when told to.'
+    def __init__(self):
+        self.now = 100.0
+    def __call__(self):
+        return self.now
+
+SOURCE = ipaddress.ip_address(u'2001:db8::1')
+OTHER = ipaddress.ip_address(u'2001:db8::2')
+
+class DelayTrackerTest(unittest.TestCase):
+    def make(self, clock):
+        return DelayTracker(clock)
+
+    def setUp(self):
+        self.clock = Clock()
+        self.tracker = self.make(self.clock)
+
+    def test_fixed_delay(self):
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0))
+        self.assertFalse(self.tracker.try_acquire(SOURCE, 1.0))
+        self.clock.now += 0.5
+        self.assertFalse(self.tracker.try_acquire(SOURCE, 1.0))
+        self.assertTrue(self.tracker.try_acquire(OTHER, 1.0))
+        self.clock.now += 0.5
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0))
+
+    def test_no_delay(self):
+        for _ in range(3):
+            self.assertTrue(self.tracker.try_acquire(SOURCE, 0))
+        self.assertEqual(self.tracker.known_sources(), [])
+
+    def test_token_bucket_burst(self):
+        ## A new source starts with a full bucket.
+        for _ in range(3):
+            self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0, 3))
+        self.assertFalse(self.tracker.try_acquire(SOURCE, 1.0, 3))
+        ## One token is earned every delay.
+        self.clock.now += 1.0
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0, 3))
+        self.assertFalse(self.tracker.try_acquire(SOURCE, 1.0, 3))
+        ## A quiet source saves up no more than the burst.
+        self.clock.now += 10.0
+        for _ in range(3):
+            self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0, 3))
+        self.assertFalse(self.tracker.try_acquire(SOURCE, 1.0, 3))
+
+    def test_token_bucket_keeps_fractions(self):
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0, 1))
+        self.clock.now += 0.6
+        self.assertFalse(self.tracker.try_acquire(SOURCE, 1.0, 1))
+        self.clock.now += 0.6
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0, 1))
+
+    def test_streams_are_separate(self):
+        self.assertTrue(self.tracker.try_acquire((SOURCE, 'depth'), 1.0))
+        self.assertTrue(self.tracker.try_acquire((SOURCE, 'video'), 1.0))
+        self.assertTrue(self.tracker.try_acquire((SOURCE, None), 1.0))
+        self.assertFalse(self.tracker.try_acquire((SOURCE, 'depth'), 1.0))
+        self.assertEqual(sorted(self.tracker.known_sources()),
+                         sorted([(SOURCE, 'depth'), (SOURCE, 'video'), (SOURCE, None)]))
+
+    def test_forget(self):
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0))
+        self.tracker.forget(SOURCE)
+        self.assertEqual(self.tracker.known_sources(), [])
+        self.assertTrue(self.tracker.try_acquire(SOURCE, 1.0))
+
+class SharedDelayTrackerTest(DelayTrackerTest):
+    def make(self, clock):
+        return SharedDelayTracker(16, clock)
+
+    def test_ipv4_sources(self):
+        source = ipaddress.ip_address(u'192.0.2.1')
+        self.assertTrue(self.tracker.try_acquire(source, 1.0))
+        self.assertEqual(self.tracker.known_sources(), [source])
+
+    def test_forgotten_slots_are_passed_over(self):
+        ## Fill the table, so every source collides with another.
+        sources = [ipaddress.ip_address(u'2001:db8::%x' % n) for n in range(1, 17)]
+        for source in sources:
+            self.assertTrue(self.tracker.try_acquire(source, 1.0))
+        self.tracker.forget(sources[0])
+        for source in sources[1:]:
+            self.assertFalse(self.tracker.try_acquire(source, 1.0))
+        self.assertEqual(len(self.tracker.known_sources()), 15)
+
+    def test_full_table_is_emptied(self):
+        for n in range(1, 18):
+            self.assertTrue(self.tracker.try_acquire(ipaddress.ip_address(u'2001:db8::%x' % n), 1.0))
+        self.assertEqual(len(self.tracker.known_sources()), 1)
+
+class MonotonicTest(unittest.TestCase):
+    def test_never_goes_back(self):
+        times = [monotonic() for _ in range(100)]
+        self.assertEqual(times, sorted(times))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+'Tests for reading stored frames in replay.py.'
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import frame_codec
+import replay
+from replay import FrameReader, StoredFrame
+
+class FrameReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.looked_up = []
+        self.find_frame = replay.find_frame
+        replay.find_frame = self._find_frame
+        self.reader = FrameReader(self.directory)
+
+    def tearDown(self):
+        replay.find_frame = self.find_frame
+        self.reader.close()
+        shutil.rmtree(self.directory)
+
+    def _find_frame(self, save_location, file_name):
+        self.looked_up.append(file_name)
+        return StoredFrame(file_name, '::1', 0, stream = 'depth')
+
+    def store(self, file_name, data, codec = 'raw', reference = None, stream = None):
+        'Returns the record of the frame FILE_NAME stored with DATA.'
+        with open(os.path.join(self.directory, file_name), 'wb') as f_obj:
+            f_obj.write(data)
+        return StoredFrame(file_name, '::1', 0, codec = codec, reference = reference, stream = stream)
+
+    def test_video_frame_keeps_depth_key_frame(self):
+        key = '\x10\x00\x20\x00'
+        delta = frame_codec.encode('depth-delta', '\x11\x00\x22\x00', key)
+        self.assertEqual(self.reader.read(self.store('key', key, stream = 'depth')), key)
+        self.assertEqual(self.reader.read(self.store('video', 'vvvv', stream = 'video')), 'vvvv')
+        frame = self.store('delta', delta, codec = 'depth-delta', reference = 'key')
+        self.assertEqual(self.reader.read(frame), '\x11\x00\x22\x00')
+        self.assertEqual(self.looked_up, [])
+
+    def test_other_key_frame_is_looked_up(self):
+        self.store('old', '\x01\x00')
+        self.reader.read(self.store('key', '\x02\x00', stream = 'depth'))
+        delta = frame_codec.encode('depth-delta', '\x03\x00', '\x01\x00')
+        frame = self.store('delta', delta, codec = 'depth-delta', reference = 'old')
+        self.assertEqual(self.reader.read(frame), '\x03\x00')
+        self.assertEqual(self.looked_up, ['old'])
+
+if __name__ == '__main__':
+    unittest.main()
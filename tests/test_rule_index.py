@@ -0,0 +1,49 @@
+'Tests for the longest prefix match index in rule_index.py.'
+
+import os
+import sys
+import unittest
+
+import ipaddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rule_index import PrefixIndex, prefix_mask
+
+def network(text):
+    return ipaddress.ip_network(unicode(text))
+
+def address(text):
+    return ipaddress.ip_address(unicode(text))
+
+class PrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = PrefixIndex()
+        self.index.insert(network('2001:db8::/32'), 'wide')
+        self.index.insert(network('2001:db8:1::/48'), 'narrow')
+        self.index.insert(network('2001:db8:1::5/128'), 'host')
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(self.index.lookup(address('2001:db8:1::5')), 'host')
+        self.assertEqual(self.index.lookup(address('2001:db8:1::6')), 'narrow')
+        self.assertEqual(self.index.lookup(address('2001:db8:2::1')), 'wide')
+
+    def test_no_match_gives_default(self):
+        self.assertEqual(self.index.lookup(address('2001:db9::1')), None)
+        self.assertEqual(self.index.lookup(address('::1'), 'default'), 'default')
+
+    def test_insert_replaces(self):
+        self.index.insert(network('2001:db8:1::/48'), 'replaced')
+        self.assertEqual(self.index.lookup(address('2001:db8:1::6')), 'replaced')
+        self.assertEqual(len(self.index), 3)
+
+    def test_prefix_lengths_longest_first(self):
+        self.assertEqual([length for length, _ in self.index.lengths], [128, 48, 32])
+
+    def test_prefix_mask(self):
+        self.assertEqual(prefix_mask(0), 0)
+        self.assertEqual(prefix_mask(128), (1 << 128) - 1)
+        self.assertEqual(prefix_mask(1), 1 << 127)
+
+if __name__ == '__main__':
+    unittest.main()